@@ -1,3 +1,17 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import PendingSheetRow, UploadJob
+
+
+@admin.register(UploadJob)
+class UploadJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'status', 'rows_done', 'created_at', 'finished_at')
+    list_filter = ('kind', 'status')
+    readonly_fields = ('created_at', 'started_at', 'finished_at')
+
+
+@admin.register(PendingSheetRow)
+class PendingSheetRowAdmin(admin.ModelAdmin):
+    list_display = ('id', 'sheet_id', 'gid', 'status', 'attempts', 'created_at', 'sent_at')
+    list_filter = ('status',)
+    readonly_fields = ('created_at', 'sent_at')
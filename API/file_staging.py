@@ -0,0 +1,235 @@
+"""
+Upload-once staging for the File Upload page.
+
+get_file_columns stores the uploaded file under FILE_STAGING_DIR in a directory named
+after the SHA-256 of its content and returns that hash as file_token; the page then
+sends only the token with upload_to_sheet (and with resumed uploads). The first full
+read converts the file to column chunks - per column the factorized codes and the
+distinct values, in a compressed NumPy .npz file (no pickle, no pyarrow) - so later
+uploads of the same file skip the CSV/Excel parser and a resume skips whole chunks
+without reading them. Entries not used for FILE_STAGING_TTL seconds are removed.
+
+FILE_STAGING_DIR defaults to the system temp directory, the only writable place on
+serverless hosts; when staging fails, the page falls back to sending the file itself.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from .sheet_upload import iter_file_chunks, sniff_file
+
+_TOKEN_RE = re.compile(r'^[0-9a-f]{64}$')
+_convert_locks = {}
+_locks_lock = threading.Lock()
+_last_cleanup = 0.0
+
+
+def _staging_dir():
+    from django.conf import settings
+    path = getattr(settings, 'FILE_STAGING_DIR', None) or os.path.join(tempfile.gettempdir(), 'sitecap_staging')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _staging_ttl():
+    from django.conf import settings
+    return getattr(settings, 'FILE_STAGING_TTL', 3600)
+
+
+COLUMNAR_FORMAT = 'npz'
+
+
+def _write_chunk(path, chunk):
+    """Store a chunk (str values or missing) as codes + distinct values per column position."""
+    arrays = {}
+    for position in range(chunk.shape[1]):
+        codes, uniques = pd.factorize(chunk.iloc[:, position])  # missing -> -1
+        arrays[f'codes{position}'] = codes.astype(np.int32)
+        arrays[f'values{position}'] = np.asarray(uniques, dtype=str)
+    with open(path, 'wb') as out:
+        np.savez_compressed(out, **arrays)
+
+
+def _read_chunk(path, columns):
+    with np.load(path, allow_pickle=False) as data:
+        values = {}
+        for position in range(len(columns)):
+            # code -1 picks the appended NaN
+            lookup = np.append(data[f'values{position}'].astype(object), np.nan)
+            values[position] = lookup[data[f'codes{position}']]
+    return pd.DataFrame(values, dtype=object).set_axis(columns, axis=1)
+
+
+def _write_json(path, data):
+    tmp = f"{path}.tmp{threading.get_ident()}"
+    with open(tmp, 'w', encoding='utf-8') as out:
+        json.dump(data, out)
+    os.replace(tmp, path)
+
+
+class StagedFile:
+    """One staged upload: the original file, its manifest and (once converted) its column chunks."""
+
+    def __init__(self, token, path):
+        self.token = token
+        self.path = path
+        with open(os.path.join(path, 'manifest.json'), encoding='utf-8') as manifest:
+            self.manifest = json.load(manifest)
+
+    @property
+    def filename(self):
+        return self.manifest['filename']
+
+    @property
+    def original_path(self):
+        return os.path.join(self.path, 'original' + os.path.splitext(self.filename)[1].lower())
+
+    def _save_manifest(self):
+        _write_json(os.path.join(self.path, 'manifest.json'), self.manifest)
+
+    def touch(self):
+        os.utime(self.path)
+
+    def sniff(self):
+        """sniff_file() result for the original, computed once."""
+        if 'sniff' not in self.manifest:
+            with open(self.original_path, 'rb') as f:
+                self.manifest['sniff'] = sniff_file(f, self.filename)
+            self._save_manifest()
+        return self.manifest['sniff']
+
+    def _convert(self):
+        """Parse the original once and write it as column chunks (columns stored by position)."""
+        tmp_dir = tempfile.mkdtemp(prefix='chunks-', dir=self.path)
+        try:
+            columns = None
+            chunks = []
+            with open(self.original_path, 'rb') as f:
+                for i, chunk in enumerate(iter_file_chunks(f, self.filename)):
+                    if columns is None:
+                        columns = [c if isinstance(c, (str, int)) else str(c) for c in chunk.columns]
+                    name = f"{i:05d}.{COLUMNAR_FORMAT}"
+                    _write_chunk(os.path.join(tmp_dir, name), chunk)
+                    chunks.append({'file': name, 'rows': len(chunk)})
+            chunk_dir = os.path.join(self.path, 'chunks')
+            shutil.rmtree(chunk_dir, ignore_errors=True)
+            os.replace(tmp_dir, chunk_dir)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        self.manifest['columnar'] = {
+            'format': COLUMNAR_FORMAT,
+            'columns': columns or [],
+            'row_count': sum(c['rows'] for c in chunks),
+            'chunks': chunks,
+        }
+        self._save_manifest()
+
+    def _ensure_columnar(self):
+        if self.manifest.get('columnar', {}).get('format') == COLUMNAR_FORMAT:
+            return self.manifest['columnar']
+        with _locks_lock:
+            lock = _convert_locks.setdefault(self.token, threading.Lock())
+        with lock:
+            # Another request may have converted the file while we waited
+            self.manifest = StagedFile(self.token, self.path).manifest
+            if self.manifest.get('columnar', {}).get('format') != COLUMNAR_FORMAT:
+                self._convert()  # not converted yet, or by an older version
+        return self.manifest['columnar']
+
+    def iter_chunks(self, skip_rows=0):
+        """Yield the file as DataFrames (str values or missing), starting after skip_rows data rows."""
+        columnar = self._ensure_columnar()
+        chunk_dir = os.path.join(self.path, 'chunks')
+        for info in columnar['chunks']:
+            if skip_rows >= info['rows']:
+                skip_rows -= info['rows']  # whole chunk already uploaded: not even read
+                continue
+            chunk = _read_chunk(os.path.join(chunk_dir, info['file']), columnar['columns'])
+            if skip_rows:
+                chunk = chunk.iloc[skip_rows:]
+                skip_rows = 0
+            yield chunk
+
+
+def stage_upload(upload):
+    """Store a Django UploadedFile (streamed in chunks) and return its StagedFile."""
+    cleanup_staging()
+    root = _staging_dir()
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(prefix='upload-', dir=root)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in upload.chunks():
+                digest.update(chunk)
+                out.write(chunk)
+        token = digest.hexdigest()
+        path = os.path.join(root, token)
+        if os.path.isfile(os.path.join(path, 'manifest.json')):
+            os.remove(tmp_path)  # same content staged before
+        else:
+            os.makedirs(path, exist_ok=True)
+            ext = os.path.splitext(upload.name or '')[1].lower()
+            os.replace(tmp_path, os.path.join(path, 'original' + ext))
+            _write_json(os.path.join(path, 'manifest.json'), {
+                'filename': upload.name,
+                'size': upload.size,
+                'staged_at': time.time(),
+            })
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    staged = StagedFile(token, path)
+    staged.touch()
+    return staged
+
+
+def get_staged_file(token):
+    """Return the StagedFile for a token, or None if it is unknown or has expired."""
+    if not token or not _TOKEN_RE.match(token):
+        return None
+    path = os.path.join(_staging_dir(), token)
+    try:
+        if time.time() - os.path.getmtime(path) > _staging_ttl():
+            return None
+        staged = StagedFile(token, path)
+    except (OSError, ValueError):
+        return None
+    staged.touch()
+    return staged
+
+
+def cleanup_staging(force=False):
+    """Delete staged files unused for FILE_STAGING_TTL seconds (at most once a minute unless forced)."""
+    global _last_cleanup
+    now = time.time()
+    if not force and now - _last_cleanup < 60:
+        return 0
+    _last_cleanup = now
+    root = _staging_dir()
+    ttl = _staging_ttl()
+    removed = 0
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            if now - os.path.getmtime(path) <= ttl:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+                with _locks_lock:
+                    _convert_locks.pop(name, None)
+            else:
+                os.remove(path)  # leftover temp file of an interrupted upload
+            removed += 1
+        except OSError:
+            pass
+    return removed
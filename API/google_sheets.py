@@ -0,0 +1,246 @@
+"""
+Process-wide cache of Google Sheets handles (File Upload and Voucher Data Entry pages).
+
+Building a worksheet handle from scratch means reading the service account key,
+authorizing a gspread client, and two metadata round trips (open_by_key and
+get_worksheet_by_id). The registry keeps credentials and the authorized client per
+scope set, and spreadsheet / worksheet handles per (sheet id, gid), so later requests
+go straight to the real read or write. The client's authorized session refreshes the
+access token by itself when it expires. Entries unused for GOOGLE_SHEETS_IDLE_TTL
+seconds are dropped; invalidate() drops a sheet's handles after an error (renamed or
+deleted tab, lost permission) so the next request opens it again.
+
+Header rows are cached separately per (sheet id, gid) for GOOGLE_SHEETS_HEADER_TTL
+seconds and fetched with a single-row range read.
+"""
+import json
+import os
+import re
+import threading
+import time
+
+READ_SCOPES = ('https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive.readonly')
+WRITE_SCOPES = ('https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive')
+
+
+def load_google_creds(scopes):
+    """Get Google credentials from file path or JSON env var (for Vercel/serverless)."""
+    from django.conf import settings
+    # Option 1: JSON string in env (for Vercel - paste entire key.json content)
+    json_str = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS_JSON')
+    if json_str:
+        try:
+            info = json.loads(json_str)
+            from google.oauth2.service_account import Credentials
+            return Credentials.from_service_account_info(info, scopes=list(scopes))
+        except (json.JSONDecodeError, KeyError):
+            pass
+    # Option 2: File path (local / .env)
+    creds_path = getattr(settings, 'GOOGLE_SHEETS_CREDENTIALS_PATH', None) or os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
+    if creds_path and not os.path.isabs(creds_path):
+        base = getattr(settings, 'BASE_DIR', None)
+        if base:
+            creds_path = os.path.join(base, creds_path)
+    if creds_path and os.path.isfile(creds_path):
+        from google.oauth2.service_account import Credentials
+        return Credentials.from_service_account_file(creds_path, scopes=list(scopes))
+    return None
+
+
+def extract_google_sheet_id(url):
+    """Extract spreadsheet ID from Google Sheet URL (edit or published)."""
+    # Published to web: /d/e/2PACX-xxx...
+    m = re.search(r'/d/e/([a-zA-Z0-9_-]+)', url)
+    if m:
+        return ('published', m.group(1))
+    # Standard edit URL: /d/1xxx...
+    m = re.search(r'/d/([a-zA-Z0-9_-]+)', url)
+    if m:
+        return ('edit', m.group(1))
+    return None
+
+
+def extract_gid(url):
+    """Extract worksheet gid from Google Sheet URL (?gid=123 or #gid=123). Uses that tab instead of first sheet."""
+    if not url:
+        return None
+    m = re.search(r'[?#]gid=(\d+)', url)
+    if m:
+        try:
+            return int(m.group(1))
+        except ValueError:
+            return None
+    return None
+
+
+def get_worksheet(sh, gid=None):
+    """
+    Return worksheet by gid if given, else first sheet. A failed gid lookup raises (e.g.
+    gspread's WorksheetNotFound) instead of writing to the first tab by mistake.
+    """
+    if gid is None:
+        return sh.sheet1
+    return sh.get_worksheet_by_id(gid)
+
+
+class SheetsRegistry:
+    """Credentials, gspread clients and spreadsheet/worksheet handles with idle eviction."""
+
+    def __init__(self, idle_ttl=900):
+        self.idle_ttl = idle_ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> [value, last_used]
+        self._open_locks = {}  # key -> lock, so one request opens a handle while others wait
+
+    def _lookup(self, key, factory):
+        now = time.time()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[1] = now
+                return entry[0]
+            open_lock = self._open_locks.setdefault(key, threading.Lock())
+        with open_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    return entry[0]
+            value = factory()
+            if value is not None:
+                with self._lock:
+                    self._entries[key] = [value, time.time()]
+            return value
+
+    def _evict_idle(self, now):
+        for key in [k for k, (_, last_used) in self._entries.items() if now - last_used > self.idle_ttl]:
+            del self._entries[key]
+            self._open_locks.pop(key, None)
+
+    def credentials(self, scopes=WRITE_SCOPES):
+        """Service account credentials (key read once), or None when not configured."""
+        scopes = tuple(scopes)
+        return self._lookup(('creds', scopes), lambda: load_google_creds(scopes))
+
+    def client(self, scopes=WRITE_SCOPES):
+        scopes = tuple(scopes)
+
+        def authorize():
+            import gspread
+            creds = self.credentials(scopes)
+            if creds is None:
+                raise ValueError('Google Sheet credentials not configured.')
+            return gspread.authorize(creds)
+        return self._lookup(('client', scopes), authorize)
+
+    def spreadsheet(self, sheet_id, scopes=WRITE_SCOPES):
+        scopes = tuple(scopes)
+        return self._lookup(('spreadsheet', scopes, sheet_id), lambda: self.client(scopes).open_by_key(sheet_id))
+
+    def worksheet(self, sheet_id, gid=None, scopes=WRITE_SCOPES):
+        """Worksheet by gid (first sheet when gid is None), opened once and reused; lookup errors are not cached."""
+        scopes = tuple(scopes)
+        return self._lookup(
+            ('worksheet', scopes, sheet_id, gid),
+            lambda: get_worksheet(self.spreadsheet(sheet_id, scopes), gid),
+        )
+
+    def invalidate(self, sheet_id=None):
+        """Forget the handles of one sheet (or everything, credentials included, when sheet_id is None)."""
+        with self._lock:
+            for key in list(self._entries):
+                if sheet_id is None or (key[0] in ('spreadsheet', 'worksheet') and key[2] == sheet_id):
+                    del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            kinds = {}
+            for key in self._entries:
+                kinds[key[0]] = kinds.get(key[0], 0) + 1
+        return kinds
+
+
+class HeaderCache:
+    """Header rows keyed by (source, sheet id, gid) with a short TTL and explicit invalidation."""
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._headers = {}  # key -> (headers, fetched_at)
+
+    def get(self, key, fetch, refresh=False):
+        """Cached headers for key, calling fetch() when missing, expired or refresh is set."""
+        if not refresh:
+            with self._lock:
+                cached = self._headers.get(key)
+            if cached is not None and time.time() - cached[1] < self.ttl:
+                return list(cached[0])
+        headers = fetch()
+        with self._lock:
+            if headers:
+                self._headers[key] = (list(headers), time.time())
+            else:
+                self._headers.pop(key, None)  # an empty header row may be filled in any moment
+        return headers
+
+    def invalidate(self, sheet_id=None, gid=None):
+        """Forget the headers of a sheet (one tab when gid is given), or all of them."""
+        with self._lock:
+            for key in list(self._headers):
+                if sheet_id is None or (key[1] == sheet_id and (gid is None or key[2] == gid)):
+                    del self._headers[key]
+
+
+_registry = None
+_header_cache = None
+_registry_lock = threading.Lock()
+
+
+def get_sheets_registry():
+    """Return the process-wide registry, configured from settings."""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                from django.conf import settings
+                _registry = SheetsRegistry(idle_ttl=getattr(settings, 'GOOGLE_SHEETS_IDLE_TTL', 900))
+    return _registry
+
+
+def get_header_cache():
+    """Return the process-wide header cache, configured from settings."""
+    global _header_cache
+    if _header_cache is None:
+        with _registry_lock:
+            if _header_cache is None:
+                from django.conf import settings
+                _header_cache = HeaderCache(ttl=getattr(settings, 'GOOGLE_SHEETS_HEADER_TTL', 60))
+    return _header_cache
+
+
+def get_google_creds(scopes):
+    """Cached service account credentials for the scopes, or None when not configured."""
+    return get_sheets_registry().credentials(scopes)
+
+
+def open_worksheet(sheet_id, gid=None, scopes=WRITE_SCOPES):
+    """Cached worksheet handle for (sheet id, gid)."""
+    return get_sheets_registry().worksheet(sheet_id, gid, scopes)
+
+
+def get_sheet_headers(sheet_id, gid=None, scopes=READ_SCOPES, refresh=False):
+    """First row of a worksheet (range read of row 1 only), cached per (sheet id, gid)."""
+    return get_header_cache().get(
+        ('api', sheet_id, gid), lambda: open_worksheet(sheet_id, gid, scopes).row_values(1), refresh
+    )
+
+
+def invalidate_headers(sheet_id, gid=None):
+    """Drop cached header rows of a sheet, e.g. after its columns were changed."""
+    get_header_cache().invalidate(sheet_id, gid)
+
+
+def invalidate_sheet(sheet_id):
+    """Drop cached handles and headers of a sheet after an error so the next request opens it again."""
+    get_sheets_registry().invalidate(sheet_id)
+    get_header_cache().invalidate(sheet_id)
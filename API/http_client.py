@@ -0,0 +1,264 @@
+"""
+Shared HTTP client for all outbound integrations (Bol.com, onOffice, Google, OCR.space).
+
+Each host gets its own requests.Session with a keep-alive connection pool, so a burst of
+calls reuses warm connections instead of repeating DNS + TLS handshakes. Idempotent
+requests are retried with jittered exponential backoff on 429/5xx (other methods only
+when the caller passes idempotent=True) and the number of in-flight requests per host
+is capped; a streamed response keeps its slot until it is closed.
+
+AsyncHTTPClient is the asyncio counterpart (built on httpx) used by the async views.
+"""
+import asyncio
+import random
+import threading
+import weakref
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class HTTPClient:
+    """Per-host pooled sessions with retries, default timeouts and concurrency limits."""
+
+    def __init__(self, timeout=(5, 30), max_per_host=8, retries=3, backoff_factor=0.5,
+                 backoff_jitter=0.5, status_forcelist=(429, 500, 502, 503, 504)):
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.backoff_jitter = backoff_jitter
+        self.status_forcelist = tuple(status_forcelist)
+        self._sessions = {}
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _host_key(url):
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}".lower()
+
+    def _build_session(self, allowed_methods=Retry.DEFAULT_ALLOWED_METHODS):
+        retry = Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=self.retries,
+            status=self.retries,
+            backoff_factor=self.backoff_factor,
+            backoff_jitter=self.backoff_jitter,
+            status_forcelist=self.status_forcelist,
+            allowed_methods=allowed_methods,  # None retries every method (see idempotent in request())
+            respect_retry_after_header=True,
+            raise_on_status=False,  # hand the last response back so callers can raise_for_status()
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_per_host, max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def session_for(self, url, idempotent=False):
+        """
+        Return the pooled session (and its concurrency semaphore) for the URL's host.
+        With idempotent=True the session retries every method, POST included; both
+        sessions of a host share one semaphore.
+        """
+        key = self._host_key(url)
+        with self._lock:
+            if key not in self._semaphores:
+                self._semaphores[key] = threading.BoundedSemaphore(self.max_per_host)
+            session = self._sessions.get((key, idempotent))
+            if session is None:
+                session = self._sessions[(key, idempotent)] = self._build_session(
+                    allowed_methods=None if idempotent else Retry.DEFAULT_ALLOWED_METHODS
+                )
+            return session, self._semaphores[key]
+
+    def request(self, method, url, idempotent=False, **kwargs):
+        """
+        Send a request. Pass idempotent=True for a non-idempotent method (POST) that is
+        safe to repeat, to have it retried like a GET. With stream=True the host slot is
+        held until the response is closed, since the body is still being downloaded.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        session, semaphore = self.session_for(url, idempotent)
+        if not kwargs.get("stream"):
+            with semaphore:
+                return session.request(method, url, **kwargs)
+
+        semaphore.acquire()
+        try:
+            response = session.request(method, url, **kwargs)
+        except BaseException:
+            semaphore.release()
+            raise
+        release = _ReleaseOnce(semaphore)
+        ref = weakref.ref(response)  # no self-reference, so refcounting can still free it
+
+        def close_and_release():
+            try:
+                resp = ref()
+                if resp is not None:
+                    type(resp).close(resp)
+            finally:
+                release()
+
+        response.close = close_and_release
+        # A response that is dropped without close() gives its slot back when collected
+        weakref.finalize(response, release)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+            self._semaphores.clear()
+
+
+class _ReleaseOnce:
+    """Releases a semaphore on the first call only (close() and the finalizer may both run)."""
+
+    def __init__(self, semaphore):
+        self._semaphore = semaphore
+        self._lock = threading.Lock()
+        self._released = False
+
+    def __call__(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._semaphore.release()
+
+
+class AsyncHTTPClient:
+    """
+    asyncio version of HTTPClient on top of httpx.AsyncClient, with the same timeouts,
+    retry policy and per-host concurrency limits. httpx clients are bound to the event
+    loop they were created on, so one client is kept per running loop.
+    """
+
+    def __init__(self, timeout=(5, 30), max_per_host=8, retries=3, backoff_factor=0.5,
+                 backoff_jitter=0.5, status_forcelist=(429, 500, 502, 503, 504)):
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.backoff_jitter = backoff_jitter
+        self.status_forcelist = tuple(status_forcelist)
+        self._loops = weakref.WeakKeyDictionary()
+
+    def _httpx_timeout(self, timeout):
+        if isinstance(timeout, (tuple, list)):
+            connect, read = timeout
+            return httpx.Timeout(read, connect=connect)
+        return httpx.Timeout(timeout)
+
+    def _state(self):
+        loop = asyncio.get_running_loop()
+        state = self._loops.get(loop)
+        if state is None:
+            client = httpx.AsyncClient(
+                timeout=self._httpx_timeout(self.timeout),
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=self.max_per_host * 4),
+                # Connection errors are retried by the transport, 429/5xx in request()
+                transport=httpx.AsyncHTTPTransport(retries=self.retries),
+            )
+            state = self._loops[loop] = {"client": client, "semaphores": {}}
+        return state
+
+    def _backoff(self, attempt, response):
+        retry_after = response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        return self.backoff_factor * (2 ** attempt) + random.uniform(0, self.backoff_jitter)
+
+    async def request(self, method, url, idempotent=False, **kwargs):
+        """Send a request; 429/5xx are retried for idempotent methods, or when idempotent=True."""
+        state = self._state()
+        if "timeout" in kwargs:
+            kwargs["timeout"] = self._httpx_timeout(kwargs["timeout"])
+        key = HTTPClient._host_key(url)
+        semaphore = state["semaphores"].get(key)
+        if semaphore is None:
+            semaphore = state["semaphores"][key] = asyncio.Semaphore(self.max_per_host)
+        retries = self.retries if idempotent or method.upper() in Retry.DEFAULT_ALLOWED_METHODS else 0
+        for attempt in range(retries + 1):
+            async with semaphore:
+                response = await state["client"].request(method, url, **kwargs)
+            if response.status_code not in self.status_forcelist or attempt == retries:
+                return response
+            await asyncio.sleep(self._backoff(attempt, response))
+        return response
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def aclose(self):
+        state = self._loops.pop(asyncio.get_running_loop(), None)
+        if state is not None:
+            await state["client"].aclose()
+
+
+_client = None
+_async_client = None
+_client_lock = threading.Lock()
+
+
+def _client_settings():
+    from django.conf import settings
+    return dict(
+        timeout=getattr(settings, 'HTTP_CLIENT_TIMEOUT', (5, 30)),
+        max_per_host=getattr(settings, 'HTTP_CLIENT_MAX_PER_HOST', 8),
+        retries=getattr(settings, 'HTTP_CLIENT_RETRIES', 3),
+        backoff_factor=getattr(settings, 'HTTP_CLIENT_BACKOFF_FACTOR', 0.5),
+    )
+
+
+def get_http_client():
+    """Return the process-wide HTTP client, configured from settings."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = HTTPClient(**_client_settings())
+    return _client
+
+
+def get_async_http_client():
+    """Return the process-wide async HTTP client, configured from settings."""
+    global _async_client
+    if _async_client is None:
+        with _client_lock:
+            if _async_client is None:
+                _async_client = AsyncHTTPClient(**_client_settings())
+    return _async_client
+
+
+def http_get(url, **kwargs):
+    return get_http_client().get(url, **kwargs)
+
+
+def http_post(url, **kwargs):
+    return get_http_client().post(url, **kwargs)
+
+
+async def async_http_get(url, **kwargs):
+    return await get_async_http_client().get(url, **kwargs)
+
+
+async def async_http_post(url, **kwargs):
+    return await get_async_http_client().post(url, **kwargs)
@@ -0,0 +1,214 @@
+"""
+Persistent, content-addressed cache for Bol.com invoice specifications.
+
+Issued invoices never change, so once a specification has been downloaded it is kept
+in a small SQLite database: the raw JSON body is zlib-compressed and stored once under
+its SHA-256 digest, and each invoice id points at the digest it was last served with.
+The per-EAN analytics computed from a body are stored next to it under the same digest,
+so they are reused for as long as the specification is unchanged. The store is bounded
+by total compressed size and evicts least recently used bodies. A read refreshes a
+body's access time at most once per touch_interval seconds, so cache hits do not need
+the SQLite write lock.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+import hashlib
+from contextlib import closing
+
+
+class CachedInvoiceSpec:
+    """An invoice specification in the cache; the body is only read and parsed when accessed."""
+
+    def __init__(self, cache, invoice_id, digest, etag=None, last_modified=None):
+        self.invoice_id = invoice_id
+        self.digest = digest
+        self.etag = etag
+        self.last_modified = last_modified
+        self._cache = cache
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = json.loads(zlib.decompress(self._cache.get_body(self.digest)))
+        return self._data
+
+
+class InvoiceSpecCache:
+    """SQLite blob store keyed by content digest, with an invoice id -> digest index."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS blobs (
+            digest TEXT PRIMARY KEY,
+            body BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            accessed_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS invoices (
+            invoice_id TEXT PRIMARY KEY,
+            digest TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            fetched_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS analytics (
+            digest TEXT PRIMARY KEY,
+            results BLOB NOT NULL,
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS blobs_accessed_at ON blobs (accessed_at);
+        CREATE INDEX IF NOT EXISTS invoices_digest ON invoices (digest);
+    """
+
+    def __init__(self, path, max_bytes=200 * 1024 * 1024, touch_interval=300):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self._write_lock = threading.Lock()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, invoice_id):
+        """Return a CachedInvoiceSpec for the invoice, or None if it is not cached."""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT i.digest, i.etag, i.last_modified, b.accessed_at FROM invoices i "
+                "LEFT JOIN blobs b ON b.digest = i.digest WHERE i.invoice_id = ?",
+                (str(invoice_id),),
+            ).fetchone()
+            if row is None:
+                return None
+            digest, etag, last_modified, accessed_at = row
+            now = time.time()
+            if accessed_at is None or now - accessed_at >= self.touch_interval:
+                with conn:
+                    conn.execute("UPDATE blobs SET accessed_at = ? WHERE digest = ?", (now, digest))
+        return CachedInvoiceSpec(self, str(invoice_id), digest, etag, last_modified)
+
+    def get_body(self, digest):
+        """Return the compressed JSON body stored under a digest."""
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT body FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        if row is None:
+            raise KeyError(digest)
+        return row[0]
+
+    def get_analytics(self, digest):
+        """Return the per-EAN analytics stored for a specification digest, or None."""
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT results FROM analytics WHERE digest = ?", (digest,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+
+    def put_analytics(self, digest, results):
+        """Store the per-EAN analytics computed from the specification with this digest."""
+        body = zlib.compress(json.dumps(results).encode("utf-8"), 6)
+        with self._write_lock, closing(self._connect()) as conn, conn:
+            # Only keep analytics for bodies that are still in the store
+            conn.execute(
+                "INSERT OR REPLACE INTO analytics (digest, results, created_at) "
+                "SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM blobs WHERE digest = ?)",
+                (digest, sqlite3.Binary(body), time.time(), digest),
+            )
+
+    def put(self, invoice_id, raw_body, etag=None, last_modified=None):
+        """Store the raw JSON body for an invoice and return its content digest."""
+        if isinstance(raw_body, str):
+            raw_body = raw_body.encode("utf-8")
+        digest = hashlib.sha256(raw_body).hexdigest()
+        compressed = zlib.compress(raw_body, 6)
+        self.put_compressed(invoice_id, digest, compressed, etag=etag, last_modified=last_modified)
+        return digest
+
+    def put_compressed(self, invoice_id, digest, compressed, etag=None, last_modified=None):
+        """
+        Store an already compressed body: bytes, or a binary file (e.g. a spooled download)
+        that is copied into the blob in pieces instead of being read into memory.
+        """
+        now = time.time()
+        with self._write_lock, closing(self._connect()) as conn:
+            with conn:
+                if hasattr(compressed, "read"):
+                    self._insert_blob_from_file(conn, digest, compressed, now)
+                else:
+                    conn.execute(
+                        "INSERT INTO blobs (digest, body, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?) "
+                        "ON CONFLICT(digest) DO UPDATE SET accessed_at = excluded.accessed_at",
+                        (digest, sqlite3.Binary(compressed), len(compressed), now, now),
+                    )
+                conn.execute(
+                    "INSERT OR REPLACE INTO invoices (invoice_id, digest, etag, last_modified, fetched_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (str(invoice_id), digest, etag, last_modified, now),
+                )
+            self._evict(conn)
+
+    def _insert_blob_from_file(self, conn, digest, f, now, piece_size=1024 * 1024):
+        row = conn.execute("SELECT rowid FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        if row is not None:
+            conn.execute("UPDATE blobs SET accessed_at = ? WHERE digest = ?", (now, digest))
+            return
+        size = f.seek(0, os.SEEK_END)
+        f.seek(0)
+        rowid = conn.execute(
+            "INSERT INTO blobs (digest, body, size, created_at, accessed_at) VALUES (?, zeroblob(?), ?, ?, ?)",
+            (digest, size, size, now, now),
+        ).lastrowid
+        with conn.blobopen("blobs", "body", rowid) as blob:
+            while True:
+                piece = f.read(piece_size)
+                if not piece:
+                    break
+                blob.write(piece)
+
+    def touch(self, invoice_id):
+        """Mark a cached invoice as revalidated (304 Not Modified) and recently used."""
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute("UPDATE invoices SET fetched_at = ? WHERE invoice_id = ?", (now, str(invoice_id)))
+            conn.execute(
+                "UPDATE blobs SET accessed_at = ? WHERE digest = "
+                "(SELECT digest FROM invoices WHERE invoice_id = ?)",
+                (now, str(invoice_id)),
+            )
+
+    def delete(self, invoice_id):
+        with self._write_lock, closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM invoices WHERE invoice_id = ?", (str(invoice_id),))
+            conn.execute("DELETE FROM blobs WHERE digest NOT IN (SELECT digest FROM invoices)")
+            conn.execute("DELETE FROM analytics WHERE digest NOT IN (SELECT digest FROM blobs)")
+
+    def _evict(self, conn):
+        """Drop least recently used bodies until the store fits in max_bytes."""
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        victims = []
+        for digest, size in conn.execute("SELECT digest, size FROM blobs ORDER BY accessed_at ASC"):
+            if total <= self.max_bytes:
+                break
+            victims.append((digest,))
+            total -= size
+        with conn:
+            conn.executemany("DELETE FROM invoices WHERE digest = ?", victims)
+            conn.executemany("DELETE FROM blobs WHERE digest = ?", victims)
+            conn.executemany("DELETE FROM analytics WHERE digest = ?", victims)
+
+    def stats(self):
+        with closing(self._connect()) as conn:
+            invoices = conn.execute("SELECT COUNT(*) FROM invoices").fetchone()[0]
+            blobs, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        return {"invoices": invoices, "blobs": blobs, "bytes": size, "max_bytes": self.max_bytes}
@@ -0,0 +1,108 @@
+"""
+Per-EAN invoice totals that can be built up batch by batch.
+
+InvoiceAggregator holds the per-line rules used by utils.calculate_invoice_totals and
+keeps its totals between calls, so a streamed invoice can be added in batches and the
+totals of several invoices can be merged.
+"""
+
+CATEGORIES = ("revenue", "commission", "ads_cost", "shipping", "other")
+
+
+def _line_ean(item):
+    """Explicit EAN property first; only if there is none, the first 13+ digit value."""
+    props = item.get("AdditionalItemProperty", [])
+    for p in props:
+        if p.get("Name", {}).get("value") == "EAN":
+            return p.get("Value", {}).get("value")
+    for p in props:
+        val = p.get("Value", {}).get("value", "")
+        if val and val.isdigit() and len(val) >= 13:
+            return val
+    return "UNKNOWN"
+
+
+def _line_category(item):
+    """Category (one of CATEGORIES) that a line's amount is booked under."""
+    name = item.get("Name", {}).get("value", "").upper()
+    desc_list = item.get("Description", [])
+    description = desc_list[0].get("value", "").lower() if desc_list else ""
+
+    if name in ["TURNOVER", "CORRECTION_TURNOVER"]:
+        return "revenue"
+    if name in ["COMMISSION", "CORRECTION_COMMISSION"]:
+        return "commission"
+    if name in ["PICK_PACK", "OUTBOUND", "DISTRIBUTION_BY_BOLCOM_LABEL", "PLAZA_RETURN_SHIPPING_LABEL"]:
+        return "shipping"
+    if "sponsored products" in description or "advert" in description or name == "SPONSORED_PRODUCTS_ADS":
+        return "ads_cost"
+    if "verzend" in description or "shipping" in description:
+        return "shipping"
+    if "commissie" in description:
+        return "commission"
+    return "other"
+
+
+class InvoiceAggregator:
+    """Accumulates per-EAN category totals over one or more batches of invoice lines."""
+
+    def __init__(self):
+        self._totals = {}
+
+    def __len__(self):
+        return len(self._totals)
+
+    def add_lines(self, lines):
+        """Aggregate a list of invoiceSpecification lines."""
+        totals = self._totals
+        for line in lines:
+            item = line.get("item", {})
+            ean = _line_ean(item)
+            if ean not in totals:
+                totals[ean] = dict.fromkeys(CATEGORIES, 0.0)
+            amount = float(line.get("lineExtensionAmount", {}).get("value", 0.0))
+            category = _line_category(item)
+            # Revenue lines are reported with inverted sign
+            totals[ean][category] += -amount if category == "revenue" else amount
+        return self
+
+    def merge(self, other):
+        """Add another aggregator's totals into this one (EANs keep first-seen order)."""
+        for ean, other_totals in other._totals.items():
+            totals = self._totals.setdefault(ean, dict.fromkeys(CATEGORIES, 0.0))
+            for category in CATEGORIES:
+                totals[category] += other_totals[category]
+        return self
+
+    def results(self, target_ean=None):
+        """Return the rounded per-EAN summaries in calculate_invoice_totals format."""
+        final_output = []
+        for ean_key, data in self._totals.items():
+            if target_ean and ean_key != target_ean:
+                continue
+            net = data["revenue"] - (data["commission"] + data["shipping"] + data["ads_cost"] + data["other"])
+            final_output.append({
+                "ean": ean_key,
+                "revenue": round(data["revenue"], 2),
+                "commission": round(data["commission"], 2),
+                "ads_cost": round(data["ads_cost"], 2),
+                "shipping": round(data["shipping"], 2),
+                "other": round(data["other"], 2),
+                "net_result": round(net, 2)
+            })
+        return final_output
+
+
+class InvoiceEanIndex:
+    """Precomputed analytics for one invoice: the ALL summary plus an EAN -> row lookup."""
+
+    def __init__(self, results):
+        self.results = results
+        self.by_ean = {row["ean"]: row for row in results}
+
+    def lookup(self, target_ean=None):
+        """Return the rows calculate_invoice_totals would return for this target_ean."""
+        if not target_ean:
+            return self.results
+        row = self.by_ean.get(target_ean)
+        return [row] if row is not None else []
@@ -0,0 +1,161 @@
+"""
+Background jobs for long-running Google Sheet writes.
+
+A request stores what has to be done in an UploadJob row (and the uploaded file in a
+spool directory), gets the job id back immediately and polls /jobs/<id>/ for progress.
+Jobs run in a small thread pool (Sheets calls are network-bound), so at most JOB_WORKERS
+jobs talk to Google at the same time. Handlers are registered per job kind by the views.
+
+A running job refreshes its heartbeat every JOB_HEARTBEAT_INTERVAL seconds; one whose
+heartbeat is older than JOB_LEASE_TIMEOUT lost its worker (restart, crash) and is marked
+failed, while jobs other workers are still running are left alone. Background mode
+needs a writable database and spool directory and a process that outlives the request,
+so it is opt-in (JOB_BACKGROUND_ENABLED) and the views write synchronously otherwise.
+"""
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import UploadJob
+
+_handlers = {}
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def register_job_handler(kind):
+    """Decorator: handler(job, progress) runs one job and returns its JSON result."""
+    def decorator(func):
+        _handlers[kind] = func
+        return func
+    return decorator
+
+
+def _spool_dir():
+    from django.conf import settings
+    path = getattr(settings, 'JOB_SPOOL_DIR', None) or os.path.join(tempfile.gettempdir(), 'sitecap_jobs')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                from django.conf import settings
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'JOB_WORKERS', 2), thread_name_prefix='upload-job'
+                )
+                _recover_jobs(_executor)
+    return _executor
+
+
+def _setting(name, default):
+    from django.conf import settings
+    return getattr(settings, name, default)
+
+
+def background_jobs_enabled():
+    return _setting('JOB_BACKGROUND_ENABLED', False)
+
+
+def _fail_stale_jobs():
+    """Mark running jobs whose worker stopped sending heartbeats as failed."""
+    cutoff = timezone.now() - timedelta(seconds=_setting('JOB_LEASE_TIMEOUT', 120))
+    stale = Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True, started_at__lt=cutoff)
+    return UploadJob.objects.filter(stale, status=UploadJob.RUNNING).update(
+        status=UploadJob.FAILED, error='Interrupted: the server stopped while running this job.',
+        finished_at=timezone.now(),
+    )
+
+
+def _recover_jobs(executor):
+    """On startup: fail jobs whose worker died, and schedule queued ones (the claim in run_job stops doubles)."""
+    _fail_stale_jobs()
+    for job_id in UploadJob.objects.filter(status=UploadJob.QUEUED).values_list('id', flat=True):
+        executor.submit(run_job, job_id)
+
+
+def enqueue_job(kind, params, upload=None):
+    """
+    Create a job and schedule it. `upload` (a Django UploadedFile) is copied to the spool
+    directory in chunks so the worker can read it after the request has finished.
+    """
+    if kind not in _handlers:
+        raise ValueError(f'Unknown job kind: {kind}')
+    executor = _get_executor()  # recovers left-over jobs first, so the new one is not submitted twice
+    job = UploadJob(kind=kind, params=params)
+    if upload is not None:
+        ext = os.path.splitext(upload.name or '')[1].lower()
+        job.file_path = os.path.join(_spool_dir(), f"{job.id}{ext}")
+        with open(job.file_path, 'wb') as out:
+            for chunk in upload.chunks():
+                out.write(chunk)
+    job.save()
+    executor.submit(run_job, job.id)
+    return job
+
+
+def run_job(job_id):
+    """Worker entry point: run the handler for one job and record the outcome."""
+    close_old_connections()
+    try:
+        # Claim the job atomically so it never runs twice
+        now = timezone.now()
+        claimed = UploadJob.objects.filter(pk=job_id, status=UploadJob.QUEUED).update(
+            status=UploadJob.RUNNING, started_at=now, heartbeat_at=now
+        )
+        if not claimed:
+            return
+        job = UploadJob.objects.get(pk=job_id)
+
+        def progress(rows_done):
+            UploadJob.objects.filter(pk=job_id).update(rows_done=rows_done, heartbeat_at=timezone.now())
+
+        stop = threading.Event()
+        threading.Thread(target=_heartbeat, args=(job_id, stop), name='upload-job-heartbeat', daemon=True).start()
+        try:
+            result = _handlers[job.kind](job, progress)
+        except Exception as e:
+            job.status = UploadJob.FAILED
+            job.error = str(e)
+        else:
+            job.result = result
+            job.status = UploadJob.SUCCEEDED if result.get('success', True) else UploadJob.FAILED
+            job.error = '' if job.status == UploadJob.SUCCEEDED else result.get('error', '')
+        finally:
+            stop.set()
+        job.finished_at = timezone.now()
+        job.save(update_fields=['status', 'result', 'error', 'finished_at'])
+        if job.file_path and os.path.exists(job.file_path):
+            os.remove(job.file_path)
+    except Exception as e:
+        print(f"Job Error: {e}")
+    finally:
+        close_old_connections()
+
+
+def _heartbeat(job_id, stop):
+    interval = _setting('JOB_HEARTBEAT_INTERVAL', 15)
+    try:
+        while not stop.wait(interval):
+            UploadJob.objects.filter(pk=job_id, status=UploadJob.RUNNING).update(heartbeat_at=timezone.now())
+    except Exception as e:
+        print(f"Job Heartbeat Error: {e}")
+    finally:
+        close_old_connections()
+
+
+def get_job(job_id):
+    _fail_stale_jobs()
+    try:
+        return UploadJob.objects.get(pk=job_id)
+    except UploadJob.DoesNotExist:
+        return None
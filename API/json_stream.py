@@ -0,0 +1,99 @@
+"""
+Incremental JSON parsing for large API responses.
+
+iter_json_array_items() yields the elements of one array inside a JSON document while
+the body is still being downloaded, so only a single element (plus one network chunk)
+has to be held in memory at a time instead of the whole parsed document.
+"""
+import codecs
+import json
+import re
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_AFTER_SCALAR = ",] \t\n\r"
+_TRUNCATION_MARGIN = 10  # longest literal prefix that fails "Expecting value" at its start (-Infinit)
+_MAX_CONSUMED = 64 * 1024
+
+
+class JSONStreamError(ValueError):
+    """The streamed document ended early or is not valid JSON."""
+
+
+def iter_json_array_items(chunks, key):
+    """
+    Yield the items of the array stored under `key` from an iterable of bytes chunks.
+
+    The key is located by its first occurrence as an object key ("key": [), which is
+    unambiguous for the API documents we parse (the array sits at the top level).
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    needle = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+    buf = ""
+    eof = False
+
+    def read_more():
+        nonlocal buf, eof
+        for chunk in chunks:
+            text = utf8.decode(chunk)
+            if text:
+                buf += text
+                return True
+        buf += utf8.decode(b"", final=True)
+        eof = True
+        return False
+
+    # 1. Find the start of the array
+    while True:
+        match = needle.search(buf)
+        if match:
+            pos = match.end()
+            break
+        if eof or not read_more():
+            return  # key not present: no items
+        if len(buf) > 1024 * 1024:
+            # Keep only a tail long enough to contain a key split across chunks
+            buf = buf[-(len(key) + 64):]
+
+    # 2. Decode one element at a time
+    while True:
+        pos = _WHITESPACE.match(buf, pos).end()
+        if pos >= len(buf):
+            if eof or not read_more():
+                raise JSONStreamError(f"Unexpected end of document inside '{key}'")
+            continue
+        char = buf[pos]
+        if char == "]":
+            return
+        if char == ",":
+            pos += 1
+            continue
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError as e:
+            # An element cut off at the end of the buffer fails near its end (or inside an
+            # unterminated string); an error earlier on is invalid input, whatever follows
+            truncated = e.msg.startswith("Unterminated string") or e.pos >= len(buf) - _TRUNCATION_MARGIN
+            if eof or not truncated:
+                raise JSONStreamError(f"Invalid JSON inside '{key}': {e}")
+            # Decode again only once the unparsed text has doubled, so an element spanning
+            # many chunks costs linear rather than quadratic time
+            target = len(buf) + max(len(buf) - pos, 1)
+            while len(buf) < target and read_more():
+                pass
+            continue
+        if not isinstance(item, (str, dict, list)) and (end == len(buf) or buf[end] not in _AFTER_SCALAR):
+            # A number or literal only ends at a delimiter: "1." or "2.5e" may continue in
+            # the next chunk (raw_decode returns the valid prefix, 1 or 2.5)
+            if not eof:
+                read_more()
+                continue
+            if end < len(buf):
+                raise JSONStreamError(f"Invalid JSON inside '{key}': unexpected {buf[end]!r} at {end}")
+        yield item
+        # Drop consumed text once it outgrows a chunk, so the buffer stays around one chunk in size
+        if end > _MAX_CONSUMED:
+            buf = buf[end:]
+            end = 0
+        pos = end
@@ -0,0 +1,62 @@
+"""
+Load-test the same endpoint served through the WSGI and the ASGI stack and report
+requests per second. Run both servers first, e.g.
+
+    python manage.py runserver 8000                      (WSGI)
+    uvicorn Sitecapture.asgi:application --port 8001     (ASGI)
+
+then compare /api/invoice/<id>/ with /api/async/invoice/<id>/:
+
+    python manage.py bench_views http://127.0.0.1:8000/api/invoice/123/ \
+        http://127.0.0.1:8001/api/async/invoice/123/
+"""
+import asyncio
+import json
+import time
+
+import httpx
+from django.core.management.base import BaseCommand
+
+
+async def _run(url, total, concurrency, timeout):
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = {}
+    async with httpx.AsyncClient(timeout=timeout, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def one():
+            async with semaphore:
+                try:
+                    code = (await client.get(url)).status_code
+                except httpx.HTTPError as e:
+                    code = type(e).__name__
+                statuses[code] = statuses.get(code, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(total)))
+        elapsed = time.perf_counter() - started
+    return {
+        "url": url,
+        "requests": total,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(total / elapsed, 1) if elapsed else None,
+        "statuses": statuses,
+    }
+
+
+class Command(BaseCommand):
+    help = "Compare request throughput of a WSGI and an ASGI endpoint"
+
+    def add_arguments(self, parser):
+        parser.add_argument("wsgi_url")
+        parser.add_argument("asgi_url")
+        parser.add_argument("--total", type=int, default=200, help="requests per endpoint")
+        parser.add_argument("--concurrency", type=int, default=50)
+        parser.add_argument("--timeout", type=float, default=60)
+
+    def handle(self, *args, **options):
+        results = {}
+        for name in ("wsgi", "asgi"):
+            results[name] = asyncio.run(_run(
+                options[f"{name}_url"], options["total"], options["concurrency"], options["timeout"],
+            ))
+        self.stdout.write(json.dumps(results, indent=2))
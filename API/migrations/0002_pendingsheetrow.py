@@ -0,0 +1,34 @@
+# Generated by Django 5.0.7 on 2026-10-18 12:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('API', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingSheetRow',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sheet_id', models.CharField(max_length=200)),
+                ('gid', models.BigIntegerField(blank=True, null=True)),
+                ('row', models.JSONField()),
+                ('sheet_columns', models.JSONField(default=list)),
+                ('dedupe', models.BooleanField(default=False)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent')], db_index=True, default='pending', max_length=16)),
+                ('batch', models.UUIDField(blank=True, null=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['sheet_id', 'gid', 'status'], name='API_pending_sheet_i_ce67c9_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.7 on 2026-10-18 12:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('API', '0002_pendingsheetrow'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pendingsheetrow',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='pendingsheetrow',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('skipped', 'Skipped')], db_index=True, default='pending', max_length=16),
+        ),
+    ]
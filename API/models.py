@@ -1,3 +1,96 @@
+import uuid
+
 from django.db import models
 
-# Create your models here.
+
+class UploadJob(models.Model):
+    """A Google Sheet write (file upload or voucher save) processed in the background (API/jobs.py)."""
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=32)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    params = models.JSONField(default=dict)
+    file_path = models.CharField(max_length=500, blank=True)  # spooled upload, deleted when the job ends
+    rows_done = models.PositiveIntegerField(default=0)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)  # refreshed while a worker runs the job
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.kind} {self.id} ({self.status})"
+
+    def as_dict(self):
+        return {
+            'job_id': str(self.id),
+            'kind': self.kind,
+            'status': self.status,
+            'rows_done': self.rows_done,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+class PendingSheetRow(models.Model):
+    """A voucher row waiting in the write buffer to be appended to a sheet (API/sheet_writer.py)."""
+
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    SKIPPED = 'skipped'  # dedupe found the row already in the sheet
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (SKIPPED, 'Skipped'),
+    ]
+    DONE = (SENT, SKIPPED)
+
+    sheet_id = models.CharField(max_length=200)
+    gid = models.BigIntegerField(null=True, blank=True)
+    row = models.JSONField()
+    sheet_columns = models.JSONField(default=list)
+    dedupe = models.BooleanField(default=False)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    batch = models.UUIDField(null=True, blank=True)  # set when a flush claims the row
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [models.Index(fields=['sheet_id', 'gid', 'status'])]
+
+    def __str__(self):
+        return f"{self.sheet_id}#{self.gid} row {self.id} ({self.status})"
+
+    def as_dict(self):
+        return {
+            'row_id': self.id,
+            'status': self.status,
+            'attempts': self.attempts,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'sent_at': self.sent_at.isoformat() if self.sent_at else None,
+        }
@@ -87,7 +87,7 @@ def extract_travel_to_haram(pdf_file_path):
     if not text.strip():
         # Fallback to OCR.space API!
         try:
-            import requests
+            from .http_client import http_post
             url = "https://api.ocr.space/parse/image"
             
             # Reset seek position of the file stream to read it from start
@@ -101,7 +101,7 @@ def extract_travel_to_haram(pdf_file_path):
                 'filetype': 'pdf'
             }
             # Upload the file stream
-            response = requests.post(url, data=payload, files={'file': pdf_file_path}, timeout=25)
+            response = http_post(url, data=payload, files={'file': pdf_file_path}, timeout=25)
             if response.status_code == 200:
                 result = response.json()
                 parsed_results = result.get("ParsedResults", [])
@@ -0,0 +1,412 @@
+"""
+Date-indexed view of the pilgrim schedule sheet.
+
+ScheduleStore normalises a sheet snapshot once (month name, day numbers) and builds hash
+indexes from a date to the row positions of each of the four movement types, so the
+rows for a day are a dictionary lookup instead of four boolean filters over the table.
+Lookups return exactly the rows, in sheet order, that the original filters selected.
+
+ScheduleResultCache memoises the rendered results per (sheet digest, date, format).
+"""
+import re
+import threading
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+# Movement types in the order the schedules are printed
+JED_MAKKAH = "jed_makkah"
+MAKKAH_MADINAH = "makkah_madinah"
+MADINAH_AIRPORT = "madinah_airport"
+MAKKAH_JED = "makkah_jed"
+MOVEMENTS = (JED_MAKKAH, MAKKAH_MADINAH, MADINAH_AIRPORT, MAKKAH_JED)
+
+# Text layout of each schedule: (title, column mapping, static_time, static_route).
+# "pickup" may be a column name or a column position (schedule 4 uses column V).
+SCHEDULE_FORMATS = {
+    JED_MAKKAH: (
+        "SCHEDULE 1 – JED → MAKKAH",
+        {
+            "booking": "TR / مواصلات",
+            "time": "ETA/ موعدالوصول",
+            "drop": "MAKKA HOTEL / مكة فندق",
+            "client": "FAMILY NAME",
+            "mobile": "MOBILE NO.",
+            "agent": "AGENT NAME / اسم وكيل",
+            "flight": "FLIGHT/ رقم رحلة\n"
+        },
+        None,
+        "JED → MAKKAH",
+    ),
+    MAKKAH_MADINAH: (
+        "SCHEDULE 2 – MAKKAH → MADINAH",
+        {
+            "booking": "TR / مواصلات",
+            "pickup": "MAKKA HOTEL / مكة فندق",
+            "drop": "MEDINAH HOTEL / مدينه فندق",
+            "client": "FAMILY NAME",
+            "mobile": "MOBILE NO.",
+            "agent": "AGENT NAME / اسم وكيل"
+        },
+        "10:00 AM",
+        "MAKKAH → MADINAH",
+    ),
+    MADINAH_AIRPORT: (
+        "SCHEDULE 3 – MADINAH → AIRPORT",
+        {
+            "booking": "TR / مواصلات",
+            "pickup": "MEDINAH HOTEL / مدينه فندق",
+            "time": "TIME  TO GO AIRPOT / التوقيت ",
+            "flight": "FLIGHT TIME / الوقت الرحلة/DEP",
+            "drop": "FROM / من/AIRPORT",
+            "client": "FAMILY NAME",
+            "mobile": "MOBILE NO.",
+            "agent": "AGENT NAME / اسم وكيل",
+        },
+        None,
+        "MADINAH → AIRPORT",
+    ),
+    MAKKAH_JED: (
+        "SCHEDULE 4 – MAKKAH → JED",
+        {
+            "booking": "TR / مواصلات",
+            "pickup": 21,  # column V
+            "time": "TIME  TO GO AIRPOT / التوقيت ",
+            "drop": "FROM / من/AIRPORT",
+            "client": "FAMILY NAME",
+            "mobile": "MOBILE NO.",
+            "agent": "AGENT NAME / اسم وكيل",
+            "flight": "FLIGHT TIME / الوقت الرحلة/DEP"
+        },
+        "TO GO AIRPORT",
+        "MAKKAH → JED",
+    ),
+}
+
+# Filters 2-4 match the day and month parsed from these columns (13-Jan, 13-JAN, JAN-13 ...)
+DATE_COLUMNS = {
+    MAKKAH_MADINAH: "CH OUT / خروج",
+    MADINAH_AIRPORT: "CHECKOUT",
+    MAKKAH_JED: "CH OUT",
+}
+
+
+def parse_schedule_date(input_date_raw):
+    """Return (month, day) for inputs like 13-Jan or JAN-13, e.g. ("Jan", 13)."""
+    m = re.search(r"(\d{1,2})", input_date_raw)
+    if not m:
+        raise ValueError("Invalid input date. Use like: 13-Jan or JAN-13")
+
+    m2 = re.search(r"([A-Za-z]+)", input_date_raw)
+    if not m2:
+        raise ValueError("Month missing in input")
+
+    return m2.group(1)[:3].title(), int(m.group(1))
+
+
+def date_label(month, day):
+    """Canonical label for a parsed date, e.g. 13-Jan."""
+    return f"{day}-{month}"
+
+
+def extract_day(series):
+    """First 1-2 digit number in each cell as float (NaN when there is none)."""
+    return (
+        series
+        .str.strip()
+        .str.extract(r"(\d{1,2})")[0]
+        .astype(float)
+    )
+
+
+def extract_month(series):
+    """First word of each cell as a 3-letter month (Jan), like parse_schedule_date (NaN when there is none)."""
+    return (
+        series
+        .str.extract(r"([A-Za-z]+)")[0]
+        .str[:3]
+        .str.title()
+    )
+
+
+def _column(df, key):
+    return df.iloc[:, key] if isinstance(key, int) else df[key]
+
+
+def _cell_text(column):
+    """Cells as the f-string template printed them: str() of the value, missing values as "nan"."""
+    return column.astype(str).fillna("nan")
+
+
+def _mobile_display(mobile):
+    """Mobile numbers get a + prefix unless they already have one or are empty/nan/none."""
+    needs_plus = ~mobile.str.lower().isin(['nan', 'none', '']) & ~mobile.str.startswith('+')
+    return mobile.where(~needs_plus, "+" + mobile)
+
+
+def render_schedule(df_f, title, m, static_time=None, static_route=None):
+    """
+    Render one schedule block in the WhatsApp text format.
+
+    Each field is resolved to a column once and formatted with vectorized string
+    operations over the whole block; the output is identical to formatting row by row.
+    """
+    if df_f.empty:
+        return f"\n {title} \n\nNO MOVEMENTS\n"
+
+    def text(field):
+        return _cell_text(_column(df_f, m[field]))
+
+    # Time: column value plus static_time when the mapping has a time column, else static_time only
+    if 'time' in m:
+        time_display = text('time') + f" {static_time if static_time else ''}"
+    else:
+        time_display = static_time if static_time else ""
+
+    # Flight line is left out only for empty cells (a missing value prints as "nan")
+    if 'flight' in m:
+        raw = _column(df_f, m['flight'])
+        flight_info = ("Flight    : " + text('flight') + "\n").where(raw != "", "")
+    else:
+        flight_info = ""
+
+    pickup_info = "Pickup    : " + text('pickup') + "\n" if 'pickup' in m else ""
+
+    mobile_display = _mobile_display(text('mobile')) if 'mobile' in m else ""
+
+    blocks = (
+        f"""
+Route     : *{static_route}*
+Booking   : """ + text('booking') + """
+Time      : """ + time_display + """
+""" + flight_info + pickup_info + """Drop      : """ + text('drop') + """
+Client    : """ + text('client') + """
+Mobile    : """ + mobile_display + """
+Agent     : """ + text('agent') + """
+----------------------------------
+"""
+    )
+    return f"\n {title} \n" + "".join(blocks.tolist())
+
+
+def render_schedules(movements):
+    """Render the four schedule blocks for one day from ScheduleStore.movements()."""
+    return "".join(
+        render_schedule(movements[movement], *SCHEDULE_FORMATS[movement])
+        for movement in MOVEMENTS
+    )
+
+
+RECORD_FIELDS = ("date", "movement", "route", "booking", "time", "flight", "pickup", "drop", "client", "mobile", "agent")
+
+
+def schedule_records(movements, date):
+    """
+    Structured rows for one day (one per movement, in print order) with RECORD_FIELDS columns.
+    Taken straight from the filtered frames: time is the sheet value, or the fixed time for
+    schedules without a time column; empty cells are None.
+    """
+    frames = []
+    for movement in MOVEMENTS:
+        df_f = movements[movement]
+        if df_f.empty:
+            continue
+        _, m, static_time, static_route = SCHEDULE_FORMATS[movement]
+        records = pd.DataFrame({"date": date, "movement": movement, "route": static_route}, index=df_f.index)
+        for field in RECORD_FIELDS[3:]:
+            if field in m:
+                records[field] = _column(df_f, m[field]).astype(object)
+            elif field == "time":
+                records[field] = static_time
+            else:
+                records[field] = None
+        if "mobile" in m:
+            mobile = records["mobile"]
+            records["mobile"] = _mobile_display(_cell_text(mobile)).where(mobile.notna() & (mobile != ""), mobile)
+        frames.append(records)
+    if not frames:
+        return pd.DataFrame(columns=list(RECORD_FIELDS))
+    records = pd.concat(frames, ignore_index=True).astype(object)
+    return records.where(records.notna() & (records != ""), None)
+
+
+def diff_schedule_records(old, new):
+    """Return (added, removed) between two record lists from schedule_records(), as multisets."""
+    def key(record):
+        return tuple(record[field] for field in RECORD_FIELDS)
+
+    remaining = Counter(key(record) for record in old)
+    added = []
+    for record in new:
+        k = key(record)
+        if remaining[k]:
+            remaining[k] -= 1
+        else:
+            added.append(record)
+    removed = []
+    for record in old:
+        k = key(record)
+        if remaining[k]:
+            remaining[k] -= 1
+            removed.append(record)
+    return added, removed
+
+
+class ScheduleStore:
+    """Normalised sheet plus date -> row position indexes for the four movement types."""
+
+    def __init__(self, dataframe):
+        df = dataframe.copy()
+        df["MONTH_CLEAN"] = (
+            df["MONTH"]
+            .str.strip()
+            .str[:3]
+            .str.title()
+        )
+        df["DAY_MAIN"] = extract_day(df["DATE / التاريخ"])
+        df["DAY_CHOUT_1"] = df["CH OUT / خروج"]
+        df["DAY_CHECKOUT"] = df["CHECKOUT"]
+        df["DAY_CHOUT_2"] = df["CH OUT"]
+        df["DAY_DP"] = extract_day(df["DP DATE / مغادره تاريخ"])
+        self.frame = df
+
+        # Rows with a missing key never matched the original filters, and groupby drops them too
+        self._arrivals = df.groupby(["MONTH_CLEAN", "DAY_MAIN"], sort=False).indices
+        # Filters 2-4: every date cell is parsed once per snapshot into (month, day)
+        self._by_date = {
+            movement: df.groupby(
+                [extract_month(df[column]), extract_day(df[column])], sort=False
+            ).indices
+            for movement, column in DATE_COLUMNS.items()
+        }
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        return cls(snapshot.dataframe)
+
+    def positions(self, movement, input_date_raw):
+        """Row positions (in sheet order) of one movement type on the given date."""
+        key = parse_schedule_date(input_date_raw)
+        if movement == JED_MAKKAH:
+            return self._arrivals.get(key, [])
+        return self._by_date[movement].get(key, [])
+
+    def rows(self, movement, input_date_raw):
+        return self.frame.iloc[self.positions(movement, input_date_raw)]
+
+    def movements(self, input_date_raw):
+        """Return {movement type: DataFrame of its rows} for one date, in print order."""
+        parse_schedule_date(input_date_raw)  # reject invalid input before any lookup
+        return {movement: self.rows(movement, input_date_raw) for movement in MOVEMENTS}
+
+    def counts(self, input_date_raw):
+        """Number of movements of each type on one date (for fleet planning)."""
+        return {movement: len(self.positions(movement, input_date_raw)) for movement in MOVEMENTS}
+
+
+def get_schedule_store(snapshot):
+    """Return the ScheduleStore for a sheet snapshot, building it on first use."""
+    return snapshot.derived("schedule_store", ScheduleStore.from_snapshot)
+
+
+def expand_date_range(start_raw, end_raw, max_days=62, year=None):
+    """
+    Return the day labels (13-Jan, 14-Jan, ...) from start to end inclusive.
+    A range that runs past the end of the year (28-Dec to 3-Jan) continues into January.
+    The labels carry no year: the range is laid out in `year` when given, else in the
+    current year, or the nearest year in which both days exist (29-Feb needs a leap year).
+    """
+    start_month, start_day = parse_schedule_date(start_raw)
+    end_month, end_day = parse_schedule_date(end_raw)
+    try:
+        start_month_no = datetime.strptime(start_month, "%b").month
+        end_month_no = datetime.strptime(end_month, "%b").month
+    except ValueError:
+        raise ValueError("Invalid date range. Use like: 13-Jan to 20-Jan")
+    wraps = (end_month_no, end_day) < (start_month_no, start_day)
+    if year is not None:
+        years = [int(year)]
+    else:
+        this_year = datetime.now().year
+        years = [this_year + offset for offset in (0, 1, -1, 2, -2, 3, -3, 4)]
+    for candidate in years:
+        try:
+            start = datetime(candidate, start_month_no, start_day)
+            end = datetime(candidate + wraps, end_month_no, end_day)
+            break
+        except ValueError:
+            continue
+    else:
+        raise ValueError("Invalid date range. Use like: 13-Jan to 20-Jan")
+    days = (end - start).days + 1
+    if days > max_days:
+        raise ValueError(f"Date range is too long ({days} days, maximum {max_days})")
+    return [date_label(d.strftime('%b'), d.day) for d in (start + timedelta(days=i) for i in range(days))]
+
+
+class ScheduleResultCache:
+    """
+    LRU cache of rendered schedule results keyed by (sheet digest, date, output format).
+
+    Results of an older sheet can never be served again, so everything is dropped as soon
+    as a newer snapshot is seen. Cached values are shared between requests: do not mutate.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def date_key(input_date_raw):
+        # The filters only see the parsed (month, day); the text header prints input.upper()
+        return input_date_raw.upper()
+
+    def get_or_compute(self, snapshot, input_date_raw, output_format, compute):
+        key = (snapshot.digest, self.date_key(input_date_raw), output_format)
+        with self._lock:
+            if self._version is None or snapshot.version > self._version:
+                self._entries.clear()
+                self._version = snapshot.version
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = compute()
+        with self._lock:
+            # A request still working on an older snapshot must not repopulate the cache
+            if snapshot.version == self._version:
+                self._entries[key] = value
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries,
+                    "hits": self.hits, "misses": self.misses, "sheet_version": self._version}
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_schedule_result_cache():
+    """Return the process-wide schedule result cache, configured from settings."""
+    global _result_cache
+    if _result_cache is None:
+        with _result_cache_lock:
+            if _result_cache is None:
+                from django.conf import settings
+                _result_cache = ScheduleResultCache(getattr(settings, 'SCHEDULE_RESULT_CACHE_SIZE', 256))
+    return _result_cache
@@ -0,0 +1,204 @@
+"""
+In-process cache of Google Sheet CSV exports (pilgrim schedule sheet).
+
+The sheet is downloaded and parsed once into a DataFrame snapshot that is reused until
+it is older than the TTL. A SHA-256 of the CSV body detects whether the sheet actually
+changed, so an unchanged download is not parsed again. Within the stale window an old
+snapshot is served immediately while a single background thread fetches a new one
+(stale-while-revalidate); refresh(force=True) fetches right away ("refresh now").
+"""
+import hashlib
+import io
+import threading
+import time
+
+import pandas as pd
+
+from .http_client import http_get
+
+
+class SheetSnapshot:
+    """One parsed version of the sheet. Treat the DataFrame as read-only; copy before mutating."""
+
+    def __init__(self, dataframe, digest, fetched_at, version):
+        self.dataframe = dataframe
+        self.digest = digest
+        self.fetched_at = fetched_at
+        self.version = version
+        self._derived = {}
+        self._derived_lock = threading.Lock()
+
+    def age(self):
+        return time.time() - self.fetched_at
+
+    def derived(self, key, factory):
+        """Return factory(snapshot), computed once per snapshot (indexes built from the sheet)."""
+        with self._derived_lock:
+            if key not in self._derived:
+                self._derived[key] = factory(self)
+            return self._derived[key]
+
+
+class SheetSnapshotCache:
+    """Snapshot cache for one CSV URL with TTL, change detection and background refresh."""
+
+    def __init__(self, url, ttl=60, stale_ttl=600):
+        self.url = url
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._snapshot = None
+        self._refresh_lock = threading.Lock()
+        self._refreshing = False
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "stale_hits": 0, "misses": 0, "fetches": 0, "changes": 0, "refresh_failures": 0}
+
+    def _record(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def current(self):
+        """Return the snapshot in memory (possibly stale) without fetching, or None."""
+        return self._snapshot
+
+    def get(self):
+        """Return a snapshot, fetching the sheet only when there is none or it is too old."""
+        snapshot = self._snapshot
+        if snapshot is not None:
+            age = snapshot.age()
+            if age < self.ttl:
+                self._record("hits")
+                return snapshot
+            if age < self.ttl + self.stale_ttl:
+                self._record("stale_hits")
+                self._refresh_in_background()
+                return snapshot
+        self._record("misses")
+        return self.refresh()
+
+    def refresh(self, force=False):
+        """Download the sheet and return the (new or revalidated) snapshot."""
+        with self._refresh_lock:
+            snapshot = self._snapshot
+            # Another thread may have refreshed while we were waiting for the lock
+            if not force and snapshot is not None and snapshot.age() < self.ttl:
+                return snapshot
+            resp = http_get(self.url)
+            resp.raise_for_status()
+            body = resp.content
+            self._record("fetches")
+            digest = hashlib.sha256(body).hexdigest()
+            now = time.time()
+            if snapshot is not None and snapshot.digest == digest:
+                snapshot.fetched_at = now
+                return snapshot
+            dataframe = pd.read_csv(io.BytesIO(body), dtype=str)
+            version = snapshot.version + 1 if snapshot is not None else 1
+            self._snapshot = SheetSnapshot(dataframe, digest, now, version)
+            self._record("changes")
+            return self._snapshot
+
+    def _refresh_in_background(self):
+        with self._stats_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                self._record("refresh_failures")
+                print(f"Sheet Refresh Error: {e}")
+            finally:
+                with self._stats_lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, name="sheet-refresh", daemon=True).start()
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        snapshot = self._snapshot
+        stats.update({
+            "version": snapshot.version if snapshot else None,
+            "digest": snapshot.digest if snapshot else None,
+            "age": round(snapshot.age(), 1) if snapshot else None,
+            "rows": len(snapshot.dataframe) if snapshot else 0,
+        })
+        return stats
+
+
+class SheetPoller:
+    """
+    A single background thread that keeps a SheetSnapshotCache fresh while there are
+    subscribers (the schedule page's live updates) and publishes the current sheet
+    version in .version; the async streams compare it on the event loop rather than
+    blocking a thread on it. The thread exits when the last subscriber leaves.
+    """
+
+    def __init__(self, cache, interval=30):
+        self.cache = cache
+        self.interval = interval
+        self.version = None
+        self._subscribers = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        with self._lock:
+            self._subscribers += 1
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="sheet-poller", daemon=True)
+                self._thread.start()
+
+    def unsubscribe(self):
+        with self._lock:
+            self._subscribers -= 1
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._subscribers <= 0:
+                    self._thread = None
+                    return
+            try:
+                snapshot = self.cache.refresh()  # only downloads once the TTL has passed
+            except Exception as e:
+                print(f"Sheet Poll Error: {e}")
+            else:
+                self.version = snapshot.version
+            time.sleep(self.interval)
+
+
+_caches = {}
+_pollers = {}
+_caches_lock = threading.Lock()
+
+
+def get_sheet_cache(url):
+    """Return the process-wide snapshot cache for a CSV URL, configured from settings."""
+    cache = _caches.get(url)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(url)
+            if cache is None:
+                from django.conf import settings
+                cache = _caches[url] = SheetSnapshotCache(
+                    url,
+                    ttl=getattr(settings, 'SCHEDULE_SHEET_TTL', 60),
+                    stale_ttl=getattr(settings, 'SCHEDULE_SHEET_STALE_TTL', 600),
+                )
+    return cache
+
+
+def get_sheet_poller(url):
+    """Return the process-wide poller for a CSV URL (one thread no matter how many subscribers)."""
+    poller = _pollers.get(url)
+    if poller is None:
+        cache = get_sheet_cache(url)
+        with _caches_lock:
+            poller = _pollers.get(url)
+            if poller is None:
+                from django.conf import settings
+                poller = _pollers[url] = SheetPoller(cache, getattr(settings, 'SCHEDULE_SSE_POLL_INTERVAL', 30))
+    return poller
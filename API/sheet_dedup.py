@@ -0,0 +1,176 @@
+"""
+Idempotent appends to Google Sheets (File Upload and Voucher Data Entry pages), used
+when the page asks for it with dedupe=1.
+
+Every row gets a key: a hash of the whole row, or the value of the first
+SHEET_DEDUP_KEY_COLUMNS column the sheet has when that setting names a column holding
+a unique booking id (empty by default). The keys of the rows already in a sheet are
+read once with a single values call and kept per (sheet id, gid) for
+SHEET_DEDUP_INDEX_TTL seconds. A booking id that is already in the sheet (or earlier
+in the same upload) is skipped. Identical rows without an id can be legitimate, so
+hashed rows are counted: an upload skips only as many copies of a row as the sheet
+has beyond the ones this upload wrote itself, which makes retrying a whole upload (or
+resuming it, see observe()) safe. Keys are added to the index only after their append
+succeeded. A failed append drops the index, because the rows may have reached the
+sheet before the error (a timeout), so a retry re-reads the sheet.
+
+Filtering, appending and committing a batch happen under a per-(sheet id, gid) lock,
+so concurrent uploads in one process never both append the same rows; each batch is
+checked against the live index, which includes the rows other uploads have written.
+"""
+import hashlib
+import math
+import threading
+import time
+from collections import Counter
+
+from .google_sheets import invalidate_headers
+
+
+def _normalize_cell(value):
+    """Cell text as comparable between what we send and what the sheet returns."""
+    text = '' if value is None else str(value).strip()
+    try:
+        number = float(text.replace(',', ''))
+    except ValueError:
+        return text
+    # USER_ENTERED turns "0123" / "5.0" into numbers, so compare numbers by value
+    return repr(number) if math.isfinite(number) else text
+
+
+def row_key(row, key_position=None):
+    """('id', booking id) when the key column has a value, else ('row', hash of the row)."""
+    if key_position is not None and key_position < len(row):
+        key = _normalize_cell(row[key_position])
+        if key:
+            return ('id', key)
+    cells = [_normalize_cell(v) for v in row]
+    while cells and cells[-1] == '':
+        cells.pop()  # the sheet does not return trailing empty cells
+    return ('row', hashlib.sha1('\x1f'.join(cells).encode('utf-8')).hexdigest())
+
+
+def key_column_position(header):
+    """Position of the first configured key column in a header row, or None."""
+    from django.conf import settings
+    for column in getattr(settings, 'SHEET_DEDUP_KEY_COLUMNS', []):
+        if column in header:
+            return list(header).index(column)
+    return None
+
+
+class SheetKeyIndex:
+    """Keys (with counts) of the rows already in one worksheet."""
+
+    def __init__(self, keys, key_column, built_at, header=()):
+        self.keys = keys
+        self.key_column = key_column
+        self.header = list(header)
+        self.built_at = built_at
+        self.lock = threading.Lock()
+
+    @classmethod
+    def build(cls, ws):
+        values = ws.get_all_values()
+        header = values[0] if values else []
+        position = key_column_position(header)
+        keys = Counter(row_key(row, position) for row in values[1:])
+        return cls(keys, header[position] if position is not None else None, time.time(), header)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_key_index(ws, sheet_id, gid):
+    """Cached key index of a worksheet, rebuilt after SHEET_DEDUP_INDEX_TTL seconds."""
+    from django.conf import settings
+    ttl = getattr(settings, 'SHEET_DEDUP_INDEX_TTL', 300)
+    key = (sheet_id, gid)
+    with _indexes_lock:
+        index = _indexes.get(key)
+    if index is not None and time.time() - index.built_at < ttl:
+        return index
+    index = SheetKeyIndex.build(ws)
+    with _indexes_lock:
+        _indexes[key] = index
+    return index
+
+
+def invalidate_key_index(sheet_id, gid=None):
+    with _indexes_lock:
+        for key in list(_indexes):
+            if key[0] == sheet_id and (gid is None or key[1] == gid):
+                del _indexes[key]
+
+
+_append_locks = {}
+
+
+def append_lock(sheet_id, gid):
+    """Lock held while filtering, appending and committing rows of one worksheet."""
+    with _indexes_lock:
+        return _append_locks.setdefault((sheet_id, gid), threading.Lock())
+
+
+class RowDeduplicator:
+    """
+    Filters the batches of one upload (rows in sheet_header_order, from the top of the
+    file) against a worksheet's key index. Hold append_lock around new_rows(), the
+    append and committed() / failed().
+    """
+
+    def __init__(self, ws, sheet_id, gid, sheet_header_order):
+        self.ws = ws
+        self.sheet_id = sheet_id
+        self.gid = gid
+        self.append_lock = append_lock(sheet_id, gid)
+        self.index = get_key_index(ws, sheet_id, gid)
+        if self.index.header and self.index.header != list(sheet_header_order):
+            # The sheet's header row no longer matches the columns these rows were mapped
+            # to, so the cached header rows are out of date: the next page load reads it again
+            invalidate_headers(sheet_id, gid)
+        column = self.index.key_column
+        self.key_position = list(sheet_header_order).index(column) if column in sheet_header_order else None
+        self.skipped = 0
+        self._seen = Counter()
+        self._written = Counter()  # rows this upload has appended (or a resumed earlier attempt did)
+        self._pending = Counter()
+
+    def observe(self, rows):
+        """Count rows an interrupted attempt of this upload already appended (resume_from)."""
+        for row in rows:
+            key = row_key(row, self.key_position)
+            self._seen[key] += 1
+            self._written[key] += 1
+
+    def new_rows(self, rows):
+        # The index may have been rebuilt (TTL, failure) or grown by other uploads meanwhile
+        self.index = get_key_index(self.ws, self.sheet_id, self.gid)
+        fresh = []
+        with self.index.lock:
+            in_sheet = self.index.keys
+            for row in rows:
+                key = row_key(row, self.key_position)
+                self._seen[key] += 1
+                if key[0] == 'id':
+                    duplicate = in_sheet[key] > 0 or self._seen[key] > 1
+                else:
+                    # copies of this row in the sheet that this upload did not write
+                    duplicate = self._seen[key] <= in_sheet[key] - self._written[key]
+                if duplicate:
+                    self.skipped += 1
+                    continue
+                self._pending[key] += 1
+                fresh.append(row)
+        return fresh
+
+    def committed(self):
+        with self.index.lock:
+            self.index.keys.update(self._pending)
+        self._written.update(self._pending)
+        self._pending = Counter()
+
+    def failed(self):
+        self._pending = Counter()
+        invalidate_key_index(self.sheet_id, self.gid)
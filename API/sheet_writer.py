@@ -0,0 +1,237 @@
+"""
+Write coalescer for voucher saves (opt-in with VOUCHER_BUFFERED_SAVES).
+
+save_voucher stores the row in the PendingSheetRow table (SQLite, so a crash or restart
+loses nothing) and returns at once. A single background thread per process appends the
+buffered rows of each (sheet id, gid) with one append_rows call once the oldest row has
+waited VOUCHER_FLUSH_WINDOW seconds or VOUCHER_FLUSH_MAX_ROWS rows are waiting, which
+keeps a clerk entering vouchers far below the Sheets per-minute write quota. This needs
+a writable database and a long-lived process, so it is off by default, and save_voucher
+appends inline when a row cannot be queued.
+
+Rows are claimed with a batch id and claim time before sending, so several processes
+never send the same row. A failed flush puts the rows back and retries with exponential
+backoff; a claim older than VOUCHER_CLAIM_TIMEOUT seconds (its process died mid-flight)
+is taken back and sent again. Rows that dedupe finds already in the sheet end up
+SKIPPED rather than SENT.
+"""
+import threading
+import time
+import uuid
+from contextlib import nullcontext
+from datetime import timedelta
+
+from django.db import close_old_connections
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from .google_sheets import WRITE_SCOPES, invalidate_sheet, open_worksheet
+from .models import PendingSheetRow
+from .sheet_dedup import RowDeduplicator, append_lock, invalidate_key_index
+
+
+class SheetWriteCoalescer:
+    """Buffers rows per (sheet id, gid) in the database and appends them in batches."""
+
+    def __init__(self, window=5, max_rows=50, max_backoff=600, retention=86400, claim_timeout=300):
+        self.window = window
+        self.max_rows = max_rows
+        self.max_backoff = max_backoff
+        self.retention = retention
+        self.claim_timeout = claim_timeout
+        self._condition = threading.Condition()
+        self._thread = None
+        self._backoff = {}  # (sheet_id, gid) -> (failures, retry_at)
+        self._last_flush = {}  # (sheet_id, gid) -> summary of the last flush
+        self._last_prune = 0.0
+
+    def start(self):
+        """Start the flush thread (once per process)."""
+        with self._condition:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._reclaim_stale()
+            self._thread = threading.Thread(target=self._run, name='sheet-writer', daemon=True)
+            self._thread.start()
+
+    def enqueue(self, sheet_id, gid, row, sheet_columns=None, dedupe=False):
+        """Buffer one row; it is appended by the next flush of its sheet."""
+        self.start()
+        pending = PendingSheetRow.objects.create(
+            sheet_id=sheet_id, gid=gid, row=row, sheet_columns=sheet_columns or [], dedupe=dedupe
+        )
+        with self._condition:
+            self._condition.notify_all()  # the flush thread re-checks the row count
+        return pending
+
+    def _reclaim_stale(self):
+        """Put back rows whose claim is older than claim_timeout (the claiming process died)."""
+        return PendingSheetRow.objects.filter(
+            status=PendingSheetRow.SENDING, claimed_at__lt=timezone.now() - timedelta(seconds=self.claim_timeout)
+        ).update(status=PendingSheetRow.PENDING, batch=None, claimed_at=None)
+
+    def _run(self):
+        while True:
+            close_old_connections()
+            try:
+                self._reclaim_stale()
+                wait = self._flush_due()
+                self._prune()
+            except Exception as e:
+                print(f"Voucher Flush Error: {e}")
+                wait = self.window
+            finally:
+                close_old_connections()
+            with self._condition:
+                self._condition.wait(timeout=wait)
+
+    def _pending_groups(self):
+        return (
+            PendingSheetRow.objects.filter(status=PendingSheetRow.PENDING)
+            .values('sheet_id', 'gid')
+            .annotate(count=Count('id'), oldest=Min('created_at'))
+        )
+
+    def _flush_due(self):
+        """Flush every sheet whose window has passed or buffer is full; return seconds until the next check."""
+        now = timezone.now()
+        wait = 60.0
+        for group in self._pending_groups():
+            key = (group['sheet_id'], group['gid'])
+            retry_at = self._backoff.get(key, (0, 0))[1]
+            if time.time() < retry_at:
+                wait = min(wait, retry_at - time.time())
+                continue
+            age = (now - group['oldest']).total_seconds()
+            if group['count'] >= self.max_rows or age >= self.window:
+                self.flush(*key)
+                wait = min(wait, self.window)
+            else:
+                wait = min(wait, self.window - age)
+        return max(wait, 0.05)
+
+    def flush(self, sheet_id, gid):
+        """Append up to max_rows buffered rows of one sheet with a single append_rows call."""
+        batch = uuid.uuid4()
+        ids = list(
+            PendingSheetRow.objects.filter(sheet_id=sheet_id, gid=gid, status=PendingSheetRow.PENDING)
+            .values_list('id', flat=True)[:self.max_rows]
+        )
+        PendingSheetRow.objects.filter(id__in=ids, status=PendingSheetRow.PENDING).update(
+            status=PendingSheetRow.SENDING, batch=batch, claimed_at=timezone.now()
+        )
+        claimed = list(PendingSheetRow.objects.filter(batch=batch, status=PendingSheetRow.SENDING))
+        if not claimed:
+            return {'rows': 0, 'skipped': 0}
+        key = (sheet_id, gid)
+        dedupe = any(p.dedupe for p in claimed)
+        skipped_ids = []
+        try:
+            ws = open_worksheet(sheet_id, gid, WRITE_SCOPES)
+            rows = []
+            with append_lock(sheet_id, gid) if dedupe else nullcontext():
+                for p in claimed:
+                    if p.dedupe:
+                        # every save is its own one-row upload: a resent voucher is skipped
+                        deduplicator = RowDeduplicator(ws, sheet_id, gid, p.sheet_columns)
+                        fresh = deduplicator.new_rows([p.row])
+                        deduplicator.committed()
+                        if not fresh:
+                            skipped_ids.append(p.id)
+                            continue
+                    rows.append(p.row)
+                if rows:
+                    ws.append_rows(rows, value_input_option='USER_ENTERED')
+        except Exception as e:
+            if dedupe:
+                invalidate_key_index(sheet_id, gid)  # keys of the rows that were not written
+            invalidate_sheet(sheet_id)
+            failures = self._backoff.get(key, (0, 0))[0] + 1
+            self._backoff[key] = (failures, time.time() + min(self.window * 2 ** failures, self.max_backoff))
+            for p in claimed:
+                p.status, p.batch, p.claimed_at = PendingSheetRow.PENDING, None, None
+                p.attempts, p.error = p.attempts + 1, str(e)
+            PendingSheetRow.objects.bulk_update(claimed, ['status', 'batch', 'claimed_at', 'attempts', 'error'])
+            self._last_flush[key] = {'at': timezone.now().isoformat(), 'rows': 0, 'error': str(e)}
+            print(f"Voucher Flush Error: {e}")
+            return {'rows': 0, 'skipped': 0, 'error': str(e)}
+        now = timezone.now()
+        PendingSheetRow.objects.filter(batch=batch, id__in=skipped_ids).update(
+            status=PendingSheetRow.SKIPPED, sent_at=now, error=''
+        )
+        PendingSheetRow.objects.filter(batch=batch, status=PendingSheetRow.SENDING).update(
+            status=PendingSheetRow.SENT, sent_at=now, error=''
+        )
+        self._backoff.pop(key, None)
+        skipped = len(skipped_ids)
+        self._last_flush[key] = {'at': timezone.now().isoformat(), 'rows': len(rows), 'skipped': skipped, 'error': ''}
+        return {'rows': len(rows), 'skipped': skipped}
+
+    def flush_now(self):
+        """Flush every buffered row right away, ignoring the window and any backoff."""
+        self.start()
+        results = []
+        for group in self._pending_groups():
+            key = (group['sheet_id'], group['gid'])
+            self._backoff.pop(key, None)
+            while True:
+                result = self.flush(*key)
+                results.append({'sheet_id': key[0], 'gid': key[1], **result})
+                if result.get('error') or result['rows'] + result['skipped'] < self.max_rows:
+                    break
+        return results
+
+    def _prune(self):
+        if time.time() - self._last_prune < 3600:
+            return
+        self._last_prune = time.time()
+        PendingSheetRow.objects.filter(
+            status__in=PendingSheetRow.DONE, sent_at__lt=timezone.now() - timedelta(seconds=self.retention)
+        ).delete()
+
+    def status(self):
+        """Buffered rows per sheet, with the last flush and any retry backoff."""
+        sheets = {}
+        counts = (
+            PendingSheetRow.objects.exclude(status__in=PendingSheetRow.DONE)
+            .values('sheet_id', 'gid', 'status')
+            .annotate(count=Count('id'), oldest=Min('created_at'))
+        )
+        for group in counts:
+            key = (group['sheet_id'], group['gid'])
+            entry = sheets.setdefault(key, {'sheet_id': key[0], 'gid': key[1], 'pending': 0, 'sending': 0})
+            entry[group['status']] = group['count']
+            if group['status'] == PendingSheetRow.PENDING:
+                entry['oldest_pending'] = group['oldest'].isoformat()
+        for key, last in self._last_flush.items():
+            sheets.setdefault(key, {'sheet_id': key[0], 'gid': key[1], 'pending': 0, 'sending': 0})['last_flush'] = last
+        for key, (failures, retry_at) in self._backoff.items():
+            if key in sheets:
+                sheets[key]['failures'] = failures
+                sheets[key]['retry_in'] = max(round(retry_at - time.time(), 1), 0)
+        return {
+            'window': self.window,
+            'max_rows': self.max_rows,
+            'running': self._thread is not None and self._thread.is_alive(),
+            'sheets': list(sheets.values()),
+        }
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_sheet_writer():
+    """Return the process-wide voucher write coalescer, configured from settings."""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                from django.conf import settings
+                _writer = SheetWriteCoalescer(
+                    window=getattr(settings, 'VOUCHER_FLUSH_WINDOW', 5),
+                    max_rows=getattr(settings, 'VOUCHER_FLUSH_MAX_ROWS', 50),
+                    retention=getattr(settings, 'VOUCHER_SENT_RETENTION', 86400),
+                    claim_timeout=getattr(settings, 'VOUCHER_CLAIM_TIMEOUT', 300),
+                )
+    return _writer
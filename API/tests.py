@@ -1,3 +1,857 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import os
+import tempfile
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.signing import get_cookie_signer
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory
+
+from . import file_staging, google_sheets, jobs, sheet_dedup, sheet_writer, utils, views, voucher_bulk
+from .invoice_cache import InvoiceSpecCache
+from .invoice_engine import InvoiceAggregator, InvoiceEanIndex
+from .json_stream import JSONStreamError, iter_json_array_items
+from .models import PendingSheetRow, UploadJob
+from .schedule import MAKKAH_JED, MOVEMENTS, SCHEDULE_FORMATS, expand_date_range, render_schedule
+from .sheet_cache import SheetSnapshot
+from .sheet_upload import iter_file_chunks, sniff_file
+from .sheet_writer import SheetWriteCoalescer
+from .token_manager import FileTokenBackend, TokenManager
+
+
+class CsvChunkTests(SimpleTestCase):
+    """Chunked CSV reads must return the rows a full read_csv(on_bad_lines='skip') does."""
+
+    def make_csv(self, bad_rows=(), rows=1234):
+        lines = ['name,mobile,flight']
+        for i in range(rows):
+            if i in bad_rows:
+                lines.append(f'bad{i},1,2,3')  # one field too many
+            lines.append(f'pax{i},"+31 6 {i:04d}",PK{i % 7}')
+        lines[5] = 'pax4,NA,'  # NA value and a missing cell
+        lines[9] = 'pax8,"a, ""quoted"" value",PK1'
+        lines[12] = 'pax11'  # short row
+        lines.insert(20, '')  # blank line
+        return '\n'.join(lines).encode('utf-8')
+
+    def read_chunked(self, data, chunksize):
+        chunks = list(iter_file_chunks(io.BytesIO(data), 'upload.csv', chunksize=chunksize))
+        return pd.concat(chunks, ignore_index=True)
+
+    def test_bad_line_on_chunk_boundary(self):
+        data = self.make_csv(bad_rows=(1000,))
+        full = pd.read_csv(io.BytesIO(data), dtype=str, encoding='utf-8', on_bad_lines='skip')
+        chunked = self.read_chunked(data, chunksize=100)
+        self.assertEqual(len(full), 1234)
+        pd.testing.assert_frame_equal(chunked, full)
+
+    def test_bad_lines_at_every_position(self):
+        data = self.make_csv(bad_rows=(99, 100, 101, 599, 1233), rows=1234)
+        full = pd.read_csv(io.BytesIO(data), dtype=str, encoding='utf-8', on_bad_lines='skip')
+        for chunksize in (1, 7, 100, 5000):
+            with self.subTest(chunksize=chunksize):
+                pd.testing.assert_frame_equal(self.read_chunked(data, chunksize), full)
+
+    def test_bad_first_row_is_skipped(self):
+        # read_csv takes a long first row as an index column and shifts every row after it
+        data = self.make_csv(bad_rows=(0,))
+        chunked = self.read_chunked(data, chunksize=100)
+        self.assertEqual(len(chunked), 1234)
+        self.assertEqual(list(chunked.iloc[0]), ['pax0', '+31 6 0000', 'PK0'])
+
+    def test_row_count_matches_sniff(self):
+        data = self.make_csv(bad_rows=(0, 1000))
+        sniffed = sniff_file(io.BytesIO(data), 'upload.csv')
+        chunked = self.read_chunked(data, chunksize=100)
+        self.assertEqual(list(chunked.columns), sniffed['columns'])
+        self.assertEqual(len(chunked), sniffed['row_count'])
+
+
+def build_schedule(df_f, title, m, static_time=None, static_route=None):
+    """The row-by-row schedule builder render_schedule replaced, kept as the reference."""
+    if df_f.empty:
+        return f"\n {title} \n\nNO MOVEMENTS\n"
+
+    out = [f"\n {title} \n"]
+    for idx, (_, r) in enumerate(df_f.iterrows(), 1):
+        if 'time' in m:
+            time_display = f"{r[m['time']]} {static_time if static_time else ''}"
+        else:
+            time_display = static_time if static_time else ""
+
+        flight_info = f"Flight    : {r[m['flight']]}\n" if 'flight' in m and r[m['flight']] else ""
+
+        if 'pickup' in m:
+            pickup_value = r.iloc[m['pickup']] if isinstance(m['pickup'], int) else r[m['pickup']]
+            pickup_info = f"Pickup    : {pickup_value}\n"
+        else:
+            pickup_info = ""
+
+        if 'mobile' in m:
+            mobile_value = r[m['mobile']]
+            if mobile_value and str(mobile_value).lower() not in ['nan', 'none', '']:
+                mobile_display = f"+{mobile_value}" if not str(mobile_value).startswith('+') else str(mobile_value)
+            else:
+                mobile_display = mobile_value
+        else:
+            mobile_display = ""
+
+        out.append(
+            f"""
+Route     : *{static_route}*
+Booking   : {r[m['booking']]}
+Time      : {time_display}
+{flight_info}{pickup_info}Drop      : {r[m['drop']]}
+Client    : {r[m['client']]}
+Mobile    : {mobile_display}
+Agent     : {r[m['agent']]}
+----------------------------------
+"""
+        )
+    return "".join(out)
+
+
+class RenderScheduleTests(SimpleTestCase):
+    """render_schedule must print exactly what build_schedule printed."""
+
+    def make_sheet(self):
+        columns = []
+        for _, m, _, _ in SCHEDULE_FORMATS.values():
+            columns.extend(c for c in m.values() if isinstance(c, str) and c not in columns)
+        while len(columns) < 21:
+            columns.append(f"EXTRA {len(columns)}")
+        columns.append("PICKUP V")  # column 21, schedule 4 reads the pickup by position
+        mobiles = ["966501234567", "+966509876543", np.nan, "none", "None", "", "  31612345678"]
+        flights = ["SV 123", "", np.nan, "XY 9", "", "PK 740", ""]
+        rows = []
+        for i, (mobile, flight) in enumerate(zip(mobiles, flights)):
+            row = {c: f"{c[:6]} {i}" for c in columns}
+            row["MOBILE NO."] = mobile
+            row["FLIGHT/ رقم رحلة\n"] = flight
+            row["FLIGHT TIME / الوقت الرحلة/DEP"] = flight
+            row["PICKUP V"] = f"Hotel V {i}" if i % 3 else np.nan
+            row["ETA/ موعدالوصول"] = np.nan if i == 4 else f"{10 + i}:30"
+            rows.append(row)
+        return pd.DataFrame(rows, columns=columns, dtype=object)
+
+    def assert_same_output(self, df):
+        for movement in MOVEMENTS:
+            with self.subTest(movement=movement, dtype=str(df.dtypes.iloc[0]), rows=len(df)):
+                self.assertEqual(
+                    render_schedule(df, *SCHEDULE_FORMATS[movement]),
+                    build_schedule(df, *SCHEDULE_FORMATS[movement]),
+                )
+
+    def test_matches_build_schedule(self):
+        self.assert_same_output(self.make_sheet())
+
+    def test_matches_build_schedule_for_str_columns(self):
+        # sheet snapshots are read with read_csv(dtype=str)
+        self.assert_same_output(self.make_sheet().astype(str))
+
+    def test_single_row_and_empty_frame(self):
+        sheet = self.make_sheet()
+        self.assert_same_output(sheet.iloc[2:3])
+        self.assert_same_output(sheet.iloc[0:0])
+        self.assertIn("NO MOVEMENTS", render_schedule(sheet.iloc[0:0], *SCHEDULE_FORMATS[MAKKAH_JED]))
+
+
+def fake_voucher_parser(pdf):
+    """Stands in for the OCR parser: b'ok:<name>' parses, b'bad' fails, b'slow' takes 2 s."""
+    data = pdf.read()
+    if data == b'bad':
+        raise ValueError('not a voucher')
+    if data == b'slow':
+        time.sleep(2)
+    return {'lead_pax': data.decode().partition(':')[2]}
+
+
+@mock.patch.dict(voucher_bulk.PARSERS, {'Test': fake_voucher_parser})
+class ParseVouchersTests(SimpleTestCase):
+    """parse_vouchers returns one result per file, in order, with or without a process pool."""
+
+    def files(self, *contents):
+        return [(f'v{i}.pdf', data, None) for i, data in enumerate(contents)]
+
+    def parse_in_pool(self, files, timeout=30):
+        # A thread pool behaves like the process pool here and can see the fake parser
+        with ThreadPoolExecutor(max_workers=2) as pool, \
+                mock.patch.object(voucher_bulk, '_get_pool', return_value=pool), \
+                mock.patch.object(voucher_bulk, '_pool_workers', 2):
+            return voucher_bulk.parse_vouchers(iter(files), 'Test', timeout=timeout)
+
+    def test_success_keeps_order(self):
+        results = self.parse_in_pool(self.files(*[f'ok:pax{i}'.encode() for i in range(9)]))
+        self.assertEqual([r['data']['lead_pax'] for r in results], [f'pax{i}' for i in range(9)])
+        self.assertEqual([r['filename'] for r in results], [f'v{i}.pdf' for i in range(9)])
+
+    def test_failure_is_reported_per_file(self):
+        files = self.files(b'ok:a', b'bad', b'ok:c') + [('big.pdf', None, 'File is larger than 20 MB.')]
+        results = self.parse_in_pool(files)
+        self.assertEqual(results[0]['data'], {'lead_pax': 'a'})
+        self.assertEqual(results[1], {'filename': 'v1.pdf', 'error': 'Parsing error: not a voucher'})
+        self.assertEqual(results[2]['data'], {'lead_pax': 'c'})
+        self.assertEqual(results[3], {'filename': 'big.pdf', 'error': 'File is larger than 20 MB.'})
+
+    def test_timeout_only_fails_the_slow_file(self):
+        results = self.parse_in_pool(self.files(b'ok:a', b'slow', b'ok:c'), timeout=0.5)
+        self.assertEqual(results[0]['data'], {'lead_pax': 'a'})
+        self.assertEqual(results[1], {'filename': 'v1.pdf', 'error': 'Timed out after 0.5 seconds.'})
+        self.assertEqual(results[2]['data'], {'lead_pax': 'c'})
+
+    def test_single_file_is_parsed_inline(self):
+        with mock.patch.object(voucher_bulk, '_get_pool') as get_pool:
+            results = voucher_bulk.parse_vouchers(self.files(b'ok:solo'), 'Test')
+        get_pool.assert_not_called()
+        self.assertEqual(results, [{'filename': 'v0.pdf', 'data': {'lead_pax': 'solo'}}])
+
+    def test_falls_back_to_inline_parsing_without_a_pool(self):
+        # e.g. no /dev/shm on serverless hosts: creating the pool raises OSError
+        with mock.patch.object(voucher_bulk, '_pool', None), \
+                mock.patch.object(voucher_bulk, '_pool_unavailable', False), \
+                mock.patch.object(voucher_bulk, 'ProcessPoolExecutor', side_effect=OSError('no /dev/shm')) as executor:
+            results = voucher_bulk.parse_vouchers(self.files(b'ok:a', b'bad', b'ok:c'), 'Test')
+            again = voucher_bulk.parse_vouchers(self.files(b'ok:d', b'ok:e'), 'Test')
+            self.assertTrue(voucher_bulk._pool_unavailable)
+        self.assertEqual(executor.call_count, 1)  # the failure is remembered
+        self.assertEqual(
+            [r.get('data') or r.get('error') for r in results],
+            [{'lead_pax': 'a'}, 'Parsing error: not a voucher', {'lead_pax': 'c'}],
+        )
+        self.assertEqual([r['data']['lead_pax'] for r in again], ['d', 'e'])
+
+
+class JsonStreamTests(SimpleTestCase):
+    """iter_json_array_items must yield json.loads()'s items however the body is chunked."""
+
+    DOCUMENT = json.dumps({
+        "invoiceId": "1",
+        "invoiceSpecification": [
+            1.5, -2.5e3, 0, 10, -0.25e-2, 123456789012345, True, False, None,
+            "quote \" backslash \\ tab \t unicode é \u20ac 😀",
+            {"item": {"Name": {"value": "TURNOVER"}, "Description": [{"value": "a, b ] c"}]},
+             "lineExtensionAmount": {"value": 12.75}},
+            [[1, 2.5], {"nested": {"deeper": [None, "x"]}}],
+            "",
+        ],
+        "after": [9],
+    }, ensure_ascii=False).encode("utf-8")
+
+    def items(self, chunks):
+        return list(iter_json_array_items(iter(chunks), "invoiceSpecification"))
+
+    def test_every_single_split(self):
+        expected = json.loads(self.DOCUMENT)["invoiceSpecification"]
+        for cut in range(len(self.DOCUMENT) + 1):
+            with self.subTest(cut=cut):
+                self.assertEqual(self.items([self.DOCUMENT[:cut], self.DOCUMENT[cut:]]), expected)
+
+    def test_small_chunks(self):
+        expected = json.loads(self.DOCUMENT)["invoiceSpecification"]
+        for size in (1, 2, 3, 7):
+            with self.subTest(size=size):
+                chunks = [self.DOCUMENT[i:i + size] for i in range(0, len(self.DOCUMENT), size)]
+                self.assertEqual(self.items(chunks), expected)
+
+    def test_numbers_split_at_the_dot_or_exponent(self):
+        for document in (b'{"a":[1.5]}', b'{"a":[2.5e3]}', b'{"a":[-0.5E-2, 7]}'):
+            expected = json.loads(document)["a"]
+            for size in (1, 2):
+                chunks = [document[i:i + size] for i in range(0, len(document), size)]
+                with self.subTest(document=document, size=size):
+                    self.assertEqual(list(iter_json_array_items(chunks, "a")), expected)
+
+    def test_invalid_input(self):
+        for document in (
+            b'{"a": [1, {"b" 1}, 2]}',  # missing colon
+            b'{"a": [1.5x]}',  # junk after a number
+            b'{"a": ["\\x"]}',  # invalid escape
+            b'{"a": [1, 2',  # truncated
+            b'{"a": [{"b": 1}',  # truncated after an element
+        ):
+            for size in (1, 4, len(document)):
+                chunks = [document[i:i + size] for i in range(0, len(document), size)]
+                with self.subTest(document=document, size=size):
+                    with self.assertRaises(JSONStreamError):
+                        list(iter_json_array_items(chunks, "a"))
+
+    def test_invalid_element_fails_without_reading_the_rest(self):
+        read = []
+
+        def chunks():
+            yield b'{"a": [{"b" 1}, '
+            for i in range(1000):
+                read.append(i)
+                yield b'{"c": 1}, ' * 100
+
+        with self.assertRaises(JSONStreamError):
+            list(iter_json_array_items(chunks(), "a"))
+        self.assertLess(len(read), 3)
+
+
+class InvoiceSpecCacheTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = InvoiceSpecCache(os.path.join(tmp.name, "specs.sqlite3"))
+
+    def accessed_at(self, invoice_id):
+        return self.cache._connect().execute(
+            "SELECT accessed_at FROM blobs b JOIN invoices i ON i.digest = b.digest WHERE i.invoice_id = ?",
+            (invoice_id,),
+        ).fetchone()[0]
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get("1"))
+        self.cache.put("1", b'{"invoiceSpecification": [1]}', etag='"v1"', last_modified="Mon, 01 Jan 2024 00:00:00 GMT")
+        entry = self.cache.get("1")
+        self.assertEqual(entry.data, {"invoiceSpecification": [1]})
+        self.assertEqual(entry.etag, '"v1"')
+        self.assertEqual(entry.last_modified, "Mon, 01 Jan 2024 00:00:00 GMT")
+        self.assertIsNone(self.cache.get("2"))
+
+    def test_identical_bodies_are_stored_once(self):
+        self.cache.put("1", b'{"x": 1}')
+        self.cache.put("2", b'{"x": 1}')
+        self.assertEqual(self.cache.stats()["invoices"], 2)
+        self.assertEqual(self.cache.stats()["blobs"], 1)
+
+    def test_read_refreshes_access_time_at_most_once_per_interval(self):
+        self.cache.put("1", b'{"x": 1}')
+        stored = self.accessed_at("1")
+        self.cache.get("1")
+        self.assertEqual(self.accessed_at("1"), stored)
+
+        self.cache.touch_interval = 0
+        self.cache.get("1")
+        self.assertGreater(self.accessed_at("1"), stored)
+
+    def test_evicts_least_recently_used_at_max_bytes(self):
+        bodies = {str(i): json.dumps({"id": i, "pad": os.urandom(200).hex()}).encode() for i in range(3)}
+        self.cache.max_bytes = 2 * len(zlib.compress(bodies["0"], 6)) + 50
+        self.cache.touch_interval = 0
+        self.cache.put("0", bodies["0"])
+        time.sleep(0.01)
+        self.cache.put("1", bodies["1"])
+        time.sleep(0.01)
+        self.cache.get("0")  # "1" is now the least recently used
+        time.sleep(0.01)
+        self.cache.put("2", bodies["2"])
+
+        self.assertIsNone(self.cache.get("1"))
+        self.assertIsNotNone(self.cache.get("0"))
+        self.assertIsNotNone(self.cache.get("2"))
+        self.assertLessEqual(self.cache.stats()["bytes"], self.cache.max_bytes)
+
+    def test_etag_revalidation(self):
+        self.cache.put("1", b'{"invoiceSpecification": []}', etag='"v1"')
+        cached = self.cache.get("1")
+        not_modified = mock.Mock(status_code=304)
+        with mock.patch.object(utils, "get_invoice_cache", return_value=self.cache), \
+                mock.patch.object(utils, "http_get", return_value=not_modified) as http_get:
+            data = utils.fetch_invoice_spec("1", "token", cached=cached)
+        self.assertEqual(data, {"invoiceSpecification": []})
+        self.assertEqual(http_get.call_args.kwargs["headers"]["If-None-Match"], '"v1"')
+
+        changed = mock.Mock(status_code=200, headers={"ETag": '"v2"'}, content=b'{"invoiceSpecification": [1]}')
+        changed.json.return_value = {"invoiceSpecification": [1]}
+        with mock.patch.object(utils, "get_invoice_cache", return_value=self.cache), \
+                mock.patch.object(utils, "http_get", return_value=changed):
+            data = utils.fetch_invoice_spec("1", "token", cached=cached)
+        self.assertEqual(data, {"invoiceSpecification": [1]})
+        self.assertEqual(self.cache.get("1").etag, '"v2"')
+        self.assertEqual(self.cache.get("1").data, {"invoiceSpecification": [1]})
+
+
+class FakeWorksheet:
+    """In-memory stand-in for a gspread worksheet (get_all_values / append_rows only)."""
+
+    def __init__(self, values):
+        self.values = [list(row) for row in values]
+
+    def get_all_values(self):
+        return [list(row) for row in self.values]
+
+    def append_rows(self, rows, value_input_option=None):
+        self.values.extend(list(row) for row in rows)
+
+
+class HeaderInvalidationTests(SimpleTestCase):
+    def setUp(self):
+        sheet_dedup.invalidate_key_index("sheet")
+        google_sheets.get_header_cache().invalidate()
+
+    def cache_headers(self, headers):
+        cache = google_sheets.get_header_cache()
+        for key in (("api", "sheet", None), ("csv", "sheet", 0)):
+            cache.get(key, lambda: headers)
+
+    def cached(self):
+        return sorted(key[0] for key in google_sheets.get_header_cache()._headers)
+
+    def test_write_with_a_changed_header_row_drops_cached_headers(self):
+        self.cache_headers(["Name", "Booking"])
+        ws = FakeWorksheet([["Name", "Booking", "Hotel"]])
+        sheet_dedup.RowDeduplicator(ws, "sheet", None, ["Name", "Booking"])
+        self.assertEqual(self.cached(), [])
+
+    def test_write_with_the_cached_header_row_keeps_them(self):
+        self.cache_headers(["Name", "Booking"])
+        ws = FakeWorksheet([["Name", "Booking"]])
+        sheet_dedup.RowDeduplicator(ws, "sheet", None, ["Name", "Booking"])
+        self.assertEqual(self.cached(), ["api", "csv"])
+
+
+class FailingTokenBackend:
+    def load(self):
+        raise OSError("backend down")
+
+    def store(self, entry):
+        raise OSError("backend down")
+
+    def clear(self):
+        raise OSError("backend down")
+
+
+class TokenManagerTests(SimpleTestCase):
+    def counting_fetcher(self, delay=0):
+        calls = []
+
+        def fetch():
+            calls.append(time.time())
+            time.sleep(delay)
+            return f"token-{len(calls)}", 299
+        return fetch, calls
+
+    def test_concurrent_callers_share_one_token_post(self):
+        response = mock.Mock()
+        response.json.return_value = {"access_token": "abc", "expires_in": 299}
+
+        def slow_post(*args, **kwargs):
+            time.sleep(0.05)
+            return response
+
+        manager = TokenManager(utils._request_bol_token)
+        with mock.patch.object(utils, "http_post", side_effect=slow_post) as http_post:
+            with ThreadPoolExecutor(max_workers=16) as pool:
+                tokens = list(pool.map(lambda _: manager.get_token(), range(32)))
+        self.assertEqual(set(tokens), {"abc"})
+        self.assertEqual(http_post.call_count, 1)
+        self.assertEqual(manager.metrics.snapshot()["refreshes"], 1)
+
+    def test_refreshes_in_background_before_expiry(self):
+        fetch, calls = self.counting_fetcher()
+        manager = TokenManager(fetch, expiry_margin=30, refresh_ahead=60)
+        manager._entry = {"access_token": "old", "expires_at": time.time() + 45}
+
+        self.assertEqual(manager.get_token(), "old")  # still valid: served while the refresh runs
+        deadline = time.time() + 5
+        while manager._entry["access_token"] == "old" and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(manager.get_token(), "token-1")
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(manager.metrics.snapshot()["background_refreshes"], 1)
+
+    def test_refreshes_inside_the_expiry_margin(self):
+        fetch, calls = self.counting_fetcher()
+        manager = TokenManager(fetch, expiry_margin=30)
+        manager._entry = {"access_token": "old", "expires_at": time.time() + 10}
+        self.assertEqual(manager.get_token(), "token-1")
+        self.assertEqual(len(calls), 1)
+
+    def test_failing_backend_falls_back_to_memory(self):
+        fetch, calls = self.counting_fetcher()
+        manager = TokenManager(fetch, backend=FailingTokenBackend())
+        self.assertEqual(manager.get_token(), "token-1")
+        self.assertEqual(manager.get_token(), "token-1")
+        manager.invalidate()
+        self.assertEqual(manager.get_token(), "token-2")
+        self.assertEqual(len(calls), 2)
+
+    def test_file_backend_shares_the_token(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "token.json")
+        fetch, calls = self.counting_fetcher()
+        first = TokenManager(fetch, backend=FileTokenBackend(path))
+        second = TokenManager(fetch, backend=FileTokenBackend(path))
+        self.assertEqual(first.get_token(), "token-1")
+        self.assertEqual(second.get_token(), "token-1")
+        self.assertEqual(len(calls), 1)
+
+    def test_fetch_failure_returns_none(self):
+        manager = TokenManager(lambda: None)
+        self.assertIsNone(manager.get_token())
+        self.assertEqual(manager.metrics.snapshot()["refresh_failures"], 1)
+
+
+def invoice_line(name, ean, amount, description=""):
+    return {
+        "item": {
+            "Name": {"value": name},
+            "Description": [{"value": description}],
+            "AdditionalItemProperty": [{"Name": {"value": "EAN"}, "Value": {"value": ean}}],
+        },
+        "lineExtensionAmount": {"value": str(amount)},
+    }
+
+
+INVOICE = {"invoiceSpecification": [
+    invoice_line("TURNOVER", "8720000000001", -100),
+    invoice_line("COMMISSION", "8720000000001", 15),
+    invoice_line("OUTBOUND", "8720000000001", 4.5),
+    invoice_line("TURNOVER", "8720000000002", -40),
+    invoice_line("OTHER_COST", "8720000000002", 2, "Sponsored products campagne"),
+    invoice_line("OTHER_COST", "8720000000002", 1.25, "Opslagkosten"),
+]}
+
+
+class InvoiceEanIndexTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = InvoiceSpecCache(os.path.join(tmp.name, "specs.sqlite3"))
+        patcher = mock.patch.object(utils, "get_invoice_cache", return_value=self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        utils._ean_indexes.clear()
+        self.addCleanup(utils._ean_indexes.clear)
+
+    def test_lookup_matches_calculate_invoice_totals(self):
+        index = InvoiceEanIndex(utils.calculate_invoice_totals(INVOICE))
+        for ean in (None, "8720000000001", "8720000000002", "0000000000000"):
+            with self.subTest(ean=ean):
+                self.assertEqual(index.lookup(ean), utils.calculate_invoice_totals(INVOICE, ean))
+        self.assertEqual(index.lookup("8720000000001")[0]["net_result"], 80.5)
+        self.assertEqual(index.lookup("8720000000002")[0]["ads_cost"], 2.0)
+
+    def test_index_is_computed_once_per_specification(self):
+        self.cache.put("1", json.dumps(INVOICE))
+        index = utils.get_invoice_ean_index("1")
+        self.assertEqual(index.results, utils.calculate_invoice_totals(INVOICE))
+
+        utils._ean_indexes.clear()  # e.g. another worker process: the stored analytics are reused
+        with mock.patch.object(utils, "calculate_invoice_totals") as calculate:
+            again = utils.get_invoice_ean_index("1")
+            self.assertIs(utils.get_invoice_ean_index("1"), again)  # then served from memory
+        calculate.assert_not_called()
+        self.assertEqual(again.results, index.results)
+
+    def test_changed_specification_gets_a_new_index(self):
+        self.cache.put("1", json.dumps(INVOICE))
+        before = utils.get_invoice_ean_index("1")
+        changed = {"invoiceSpecification": INVOICE["invoiceSpecification"][:3]}
+        self.cache.put("1", json.dumps(changed))
+        after = utils.get_invoice_ean_index("1")
+        self.assertNotEqual(before.results, after.results)
+        self.assertEqual(after.lookup("8720000000002"), [])
+
+
+class InvoiceBatchAnalyticsTests(SimpleTestCase):
+    def post(self, body):
+        request = APIRequestFactory().post("/api/invoices/analytics/", body, format="json")
+        response = views.InvoiceBatchAnalyticsView.as_view()(request)
+        return [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+
+    def test_duplicate_invoice_ids_are_loaded_and_counted_once(self):
+        specs = {
+            "1": {"invoiceSpecification": INVOICE["invoiceSpecification"][:3]},
+            "2": {"invoiceSpecification": INVOICE["invoiceSpecification"][3:]},
+        }
+        loaded = []
+
+        def load(invoice_id, token):
+            loaded.append(invoice_id)
+            return InvoiceAggregator().add_lines(specs[invoice_id]["invoiceSpecification"])
+
+        with mock.patch.object(views, "get_cached_invoice_spec", return_value=object()), \
+                mock.patch.object(views, "get_bol_access_token") as get_token, \
+                mock.patch.object(views, "load_invoice_aggregator", side_effect=load):
+            lines = self.post({"invoice_ids": ["1", "2", "1", "2,1"]})
+
+        get_token.assert_not_called()  # everything is cached: no token needed
+        self.assertEqual(sorted(loaded), ["1", "2"])
+        invoices = [line for line in lines if line["type"] == "invoice"]
+        self.assertEqual(sorted(line["invoice_id"] for line in invoices), ["1", "2"])
+        summary = lines[-1]
+        self.assertEqual(summary["type"], "summary")
+        self.assertEqual(summary["invoice_count"], 2)
+        self.assertEqual(summary["results"], utils.calculate_invoice_totals(INVOICE))
+
+
+class RowDeduplicatorTests(SimpleTestCase):
+    HEADER = ["Name", "Booking", "Amount"]
+
+    def setUp(self):
+        sheet_dedup.invalidate_key_index("dedupe")
+
+    def upload(self, ws, rows, resume_from=0):
+        deduplicator = sheet_dedup.RowDeduplicator(ws, "dedupe", None, self.HEADER)
+        deduplicator.observe(rows[:resume_from])
+        with deduplicator.append_lock:
+            fresh = deduplicator.new_rows(rows[resume_from:])
+            ws.append_rows(fresh)
+            deduplicator.committed()
+        return fresh, deduplicator.skipped
+
+    def test_identical_rows_are_counted(self):
+        a, b = ["Ali", "", "5"], ["Sara", "", "7"]
+        ws = FakeWorksheet([self.HEADER, a])
+        fresh, skipped = self.upload(ws, [a, a, b])
+        self.assertEqual((fresh, skipped), ([a, b], 1))  # only the copy already in the sheet is skipped
+        self.assertEqual(ws.values[1:], [a, a, b])
+
+        # Retrying the same upload adds nothing, even though the sheet holds two copies of a
+        fresh, skipped = self.upload(ws, [a, a, b])
+        self.assertEqual((fresh, skipped), ([], 3))
+
+    def test_resumed_upload_does_not_skip_its_own_rows(self):
+        a = ["Ali", "", "5"]
+        ws = FakeWorksheet([self.HEADER])
+        self.upload(ws, [a])  # an interrupted attempt wrote the first row
+        fresh, skipped = self.upload(ws, [a, a, a], resume_from=1)
+        self.assertEqual((fresh, skipped), ([a, a], 0))
+        self.assertEqual(ws.values[1:], [a, a, a])
+
+    def test_cells_compare_like_the_sheet_returns_them(self):
+        ws = FakeWorksheet([self.HEADER, ["Ali", "", "5"]])
+        fresh, skipped = self.upload(ws, [["Ali", "", "5.0", ""]])
+        self.assertEqual((fresh, skipped), ([], 1))
+
+    def test_booking_id_column_skips_every_repeat(self):
+        with self.settings(SHEET_DEDUP_KEY_COLUMNS=["Booking"]):
+            ws = FakeWorksheet([self.HEADER, ["Ali", "B-1", "5"]])
+            fresh, skipped = self.upload(ws, [["Ali", "B-1", "6"], ["Sara", "B-2", "7"], ["Sara", "B-2", "7"]])
+        self.assertEqual((fresh, skipped), ([["Sara", "B-2", "7"]], 2))
+
+
+class StagedFileTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        override = self.settings(FILE_STAGING_DIR=os.path.join(tmp.name, "staging"))
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_npz_chunk_round_trip(self):
+        chunk = pd.DataFrame({
+            "Name": ["Ali", "Zoë", np.nan, "Ali", ""],  # parsed chunks hold str or NaN
+            "Amount": ["5", np.nan, np.nan, "0123", "5.0"],
+            7: ["x", "x", "x", "x", "x"],
+            "Empty": [np.nan] * 5,
+        }, dtype=object)
+        path = os.path.join(self.dir, "chunk.npz")
+        file_staging._write_chunk(path, chunk)
+        restored = file_staging._read_chunk(path, list(chunk.columns))
+        self.assertEqual(list(restored.columns), ["Name", "Amount", 7, "Empty"])
+        pd.testing.assert_frame_equal(restored, chunk)
+        with np.load(path, allow_pickle=False) as data:
+            self.assertNotEqual(data["values0"].dtype, object)  # loadable without pickle
+
+    def test_staged_file_reads_back_like_the_original(self):
+        rows = "".join(f"{i},name {i % 7},{'' if i % 5 else 'x'}\n" for i in range(12000))
+        content = ("id,name,flag\n" + rows).encode()
+        staged = file_staging.stage_upload(SimpleUploadedFile("rows.csv", content))
+        expected = pd.concat(iter_file_chunks(io.BytesIO(content), "rows.csv"), ignore_index=True)
+
+        chunks = list(staged.iter_chunks())
+        self.assertGreater(len(chunks), 1)
+        pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), expected, check_dtype=False)
+
+        # A later request reads the column chunks, not the CSV, and skips whole chunks on resume
+        again = file_staging.get_staged_file(staged.token)
+        with mock.patch.object(file_staging, "iter_file_chunks", side_effect=AssertionError("parsed again")):
+            tail = pd.concat(again.iter_chunks(skip_rows=7000), ignore_index=True)
+        pd.testing.assert_frame_equal(tail, expected.iloc[7000:].reset_index(drop=True), check_dtype=False)
+
+
+@override_settings(JOB_LEASE_TIMEOUT=120)
+class StaleJobTests(TestCase):
+    def running_job(self, started_ago, heartbeat_ago=None):
+        now = timezone.now()
+        return UploadJob.objects.create(
+            kind="sheet_upload",
+            status=UploadJob.RUNNING,
+            started_at=now - timedelta(seconds=started_ago),
+            heartbeat_at=now - timedelta(seconds=heartbeat_ago) if heartbeat_ago is not None else None,
+        )
+
+    def test_only_jobs_without_a_recent_heartbeat_are_failed(self):
+        stale = self.running_job(started_ago=600, heartbeat_ago=300)
+        alive = self.running_job(started_ago=600, heartbeat_ago=10)  # long job, worker still beating
+        never_beat = self.running_job(started_ago=600)
+        just_started = self.running_job(started_ago=5)
+
+        self.assertEqual(jobs.get_job(alive.id).status, UploadJob.RUNNING)
+        for job in (stale, never_beat):
+            job.refresh_from_db()
+            self.assertEqual(job.status, UploadJob.FAILED)
+            self.assertIsNotNone(job.finished_at)
+            self.assertIn("Interrupted", job.error)
+        just_started.refresh_from_db()
+        self.assertEqual(just_started.status, UploadJob.RUNNING)
+
+    def test_heartbeat_keeps_a_running_job_alive(self):
+        job = self.running_job(started_ago=600, heartbeat_ago=300)
+        stop = mock.Mock()
+        stop.wait.side_effect = [False, True]  # one beat, then stop
+        with mock.patch.object(jobs, "close_old_connections"):
+            jobs._heartbeat(job.id, stop)
+        self.assertEqual(jobs._fail_stale_jobs(), 0)
+        job.refresh_from_db()
+        self.assertEqual(job.status, UploadJob.RUNNING)
+        self.assertGreater(job.heartbeat_at, timezone.now() - timedelta(seconds=5))
+
+
+class FailingWorksheet(FakeWorksheet):
+    def append_rows(self, rows, value_input_option=None):
+        raise ConnectionError("quota exceeded")
+
+
+class SheetWriteCoalescerTests(TestCase):
+    def setUp(self):
+        self.writer = SheetWriteCoalescer(window=5, max_rows=3, claim_timeout=300)
+        self.ws = FakeWorksheet([["Name", "Amount"]])
+        patcher = mock.patch.object(sheet_writer, "open_worksheet", side_effect=lambda *args: self.ws)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        sheet_dedup.invalidate_key_index("coalesce")
+
+    def buffer(self, *rows, **fields):
+        return [PendingSheetRow.objects.create(sheet_id="coalesce", gid=None, row=row, **fields) for row in rows]
+
+    def statuses(self):
+        return list(PendingSheetRow.objects.values_list("status", flat=True))
+
+    def test_flush_claims_at_most_max_rows_and_sends_them_in_one_append(self):
+        self.buffer(["a", "1"], ["b", "2"], ["c", "3"], ["d", "4"])
+        with mock.patch.object(self.ws, "append_rows", wraps=self.ws.append_rows) as append:
+            self.assertEqual(self.writer.flush("coalesce", None), {"rows": 3, "skipped": 0})
+        append.assert_called_once()
+        self.assertEqual(self.ws.values[1:], [["a", "1"], ["b", "2"], ["c", "3"]])
+        self.assertEqual(self.statuses(), [PendingSheetRow.SENT] * 3 + [PendingSheetRow.PENDING])
+
+    def test_rows_claimed_by_another_flush_are_left_alone(self):
+        other = uuid.uuid4()
+        self.buffer(["a", "1"], status=PendingSheetRow.SENDING, batch=other, claimed_at=timezone.now())
+        self.buffer(["b", "2"])
+        self.writer.flush("coalesce", None)
+        self.assertEqual(self.ws.values[1:], [["b", "2"]])
+        self.assertEqual(PendingSheetRow.objects.get(batch=other).status, PendingSheetRow.SENDING)
+
+    def test_failed_append_releases_the_claim(self):
+        self.ws = FailingWorksheet([["Name", "Amount"]])
+        self.buffer(["a", "1"], ["b", "2"])
+        with mock.patch.object(sheet_writer, "invalidate_sheet"):
+            result = self.writer.flush("coalesce", None)
+        self.assertIn("quota", result["error"])
+        for row in PendingSheetRow.objects.all():
+            self.assertEqual((row.status, row.batch, row.claimed_at, row.attempts),
+                             (PendingSheetRow.PENDING, None, None, 1))
+        self.assertEqual(self.writer._backoff[("coalesce", None)][0], 1)
+
+    def test_claims_of_a_dead_process_are_reclaimed(self):
+        old = timezone.now() - timedelta(seconds=600)
+        self.buffer(["a", "1"], status=PendingSheetRow.SENDING, batch=uuid.uuid4(), claimed_at=old)
+        self.buffer(["b", "2"], status=PendingSheetRow.SENDING, batch=uuid.uuid4(), claimed_at=timezone.now())
+        self.assertEqual(self.writer._reclaim_stale(), 1)
+        self.assertEqual(self.statuses(), [PendingSheetRow.PENDING, PendingSheetRow.SENDING])
+        self.writer.flush("coalesce", None)
+        self.assertEqual(self.ws.values[1:], [["a", "1"]])
+
+    def test_dedupe_marks_rows_already_in_the_sheet_skipped(self):
+        self.ws.values.append(["a", "1"])
+        columns = ["Name", "Amount"]
+        self.buffer(["a", "1"], ["b", "2"], sheet_columns=columns, dedupe=True)
+        self.assertEqual(self.writer.flush("coalesce", None), {"rows": 1, "skipped": 1})
+        self.assertEqual(self.statuses(), [PendingSheetRow.SKIPPED, PendingSheetRow.SENT])
+        self.assertEqual(self.ws.values[1:], [["a", "1"], ["b", "2"]])
+
+
+SCHEDULE_COLUMNS = [
+    "MONTH", "DATE / التاريخ", "TR / مواصلات", "FAMILY NAME", "MOBILE NO.", "AGENT NAME / اسم وكيل",
+    "ETA/ موعدالوصول", "FLIGHT/ رقم رحلة\n", "MAKKA HOTEL / مكة فندق", "CH OUT / خروج",
+    "MEDINAH HOTEL / مدينه فندق", "CHECKOUT", "CH OUT", "TIME  TO GO AIRPOT / التوقيت ",
+    "FLIGHT TIME / الوقت الرحلة/DEP", "FROM / من/AIRPORT", "DP DATE / مغادره تاريخ",
+    "X1", "X2", "X3", "X4", "PICKUP V",
+]
+
+
+def schedule_snapshot(family, version):
+    """A sheet snapshot with one arrival per day on 1-Jan .. 3-Jan for the given family."""
+    rows = []
+    for day in (1, 2, 3):
+        row = dict.fromkeys(SCHEDULE_COLUMNS, "")
+        row.update({"MONTH": "Jan", "DATE / التاريخ": str(day), "TR / مواصلات": f"TR{day}", "FAMILY NAME": family})
+        rows.append(row)
+    return SheetSnapshot(pd.DataFrame(rows, columns=SCHEDULE_COLUMNS, dtype=str), f"digest-{version}", time.time(), version)
+
+
+class ScheduleCsvTests(SimpleTestCase):
+    def test_range_is_rendered_from_one_snapshot(self):
+        cache = mock.Mock()
+        cache.get.side_effect = [schedule_snapshot("OLD", 1), schedule_snapshot("NEW", 2)]
+        with mock.patch.object(views, "get_sheet_cache", return_value=cache):
+            response = views.PilgrimScheduleView()._schedule_csv_response(["1-Jan", "2-Jan", "3-Jan"])
+            # The sheet changes after the download started
+            records = list(csv.DictReader(io.StringIO(b"".join(response.streaming_content).decode())))
+        self.assertEqual(cache.get.call_count, 1)
+        self.assertEqual([r["booking"] for r in records], ["TR1", "TR2", "TR3"])
+        self.assertEqual({r["client"] for r in records}, {"OLD"})
+
+
+class ExpandDateRangeTests(SimpleTestCase):
+    def test_leap_day_picks_a_leap_year(self):
+        # Valid whatever the current year is
+        self.assertEqual(expand_date_range("29-Feb", "2-Mar"), ["29-Feb", "1-Mar", "2-Mar"])
+        self.assertEqual(expand_date_range("27-Feb", "29-Feb"), ["27-Feb", "28-Feb", "29-Feb"])
+
+    def test_explicit_year(self):
+        self.assertEqual(expand_date_range("28-Feb", "1-Mar", year=2028), ["28-Feb", "29-Feb", "1-Mar"])
+        self.assertEqual(expand_date_range("28-Feb", "1-Mar", year="2027"), ["28-Feb", "1-Mar"])
+        with self.assertRaises(ValueError):
+            expand_date_range("29-Feb", "1-Mar", year=2027)
+
+    def test_range_over_new_year(self):
+        self.assertEqual(expand_date_range("DEC-30", "2-Jan"), ["30-Dec", "31-Dec", "1-Jan", "2-Jan"])
+
+    def test_invalid_and_too_long_ranges(self):
+        for start, end in (("30-Feb", "1-Mar"), ("13-Foo", "14-Jan"), ("1-Jan", "1-Jun")):
+            with self.subTest(start=start, end=end), self.assertRaises(ValueError):
+                expand_date_range(start, end)
+
+
+class JobStatusViewTests(TestCase):
+    def unlock(self):
+        self.client.cookies["unlocked"] = get_cookie_signer(salt="unlocked" + "pilgrim_secret").sign("true")
+
+    def test_voucher_jobs_need_the_unlock_cookie(self):
+        job = UploadJob.objects.create(kind="voucher_save", params={"rows": [["secret"]]})
+        response = self.client.get(f"/jobs/{job.id}/")
+        self.assertEqual(response.status_code, 403)
+        self.assertNotIn("secret", response.content.decode())
+
+        self.unlock()
+        response = self.client.get(f"/jobs/{job.id}/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["status"], UploadJob.QUEUED)
+
+    def test_file_upload_jobs_are_open_like_their_page(self):
+        job = UploadJob.objects.create(kind="sheet_upload")
+        self.assertEqual(self.client.get(f"/jobs/{job.id}/").status_code, 200)
+
+    def test_unknown_job(self):
+        self.unlock()
+        self.assertEqual(self.client.get(f"/jobs/{uuid.uuid4()}/").status_code, 404)
@@ -0,0 +1,230 @@
+"""
+OAuth access token caching for outbound integrations (Bol.com).
+
+The manager keeps the current token in memory until shortly before it expires,
+refreshes it in a background thread when it gets close to expiry, and makes sure
+only one refresh runs at a time no matter how many threads ask for a token.
+Tokens can be shared between worker processes through a pluggable backend.
+"""
+import json
+import os
+import threading
+import time
+
+
+class TokenMetrics:
+    """Thread-safe counters for token cache hits, misses and refreshes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.shared_hits = 0
+            self.misses = 0
+            self.refreshes = 0
+            self.background_refreshes = 0
+            self.refresh_failures = 0
+            self.refresh_time_total = 0.0
+            self.last_refresh_latency = None
+
+    def record(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def record_refresh(self, latency, ok, background=False):
+        with self._lock:
+            self.refresh_time_total += latency
+            self.last_refresh_latency = latency
+            if ok:
+                self.refreshes += 1
+                if background:
+                    self.background_refreshes += 1
+            else:
+                self.refresh_failures += 1
+
+    def snapshot(self):
+        with self._lock:
+            attempts = self.refreshes + self.refresh_failures
+            return {
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "background_refreshes": self.background_refreshes,
+                "refresh_failures": self.refresh_failures,
+                "last_refresh_latency_ms": (
+                    round(self.last_refresh_latency * 1000, 1)
+                    if self.last_refresh_latency is not None else None
+                ),
+                "avg_refresh_latency_ms": (
+                    round(self.refresh_time_total / attempts * 1000, 1) if attempts else None
+                ),
+            }
+
+
+class DjangoCacheTokenBackend:
+    """Shares the token through a Django cache (e.g. Redis/Memcached configured in CACHES)."""
+
+    def __init__(self, alias="default", key="bol_access_token"):
+        self.alias = alias
+        self.key = key
+
+    def _cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def load(self):
+        return self._cache().get(self.key)
+
+    def store(self, entry):
+        timeout = max(1, int(entry["expires_at"] - time.time()))
+        self._cache().set(self.key, entry, timeout)
+
+    def clear(self):
+        self._cache().delete(self.key)
+
+
+class FileTokenBackend:
+    """Shares the token between worker processes on the same machine through a JSON file."""
+
+    def __init__(self, path):
+        self.path = str(path)
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+    def store(self, entry):
+        # Write to a temp file first so readers never see a half-written token
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            json.dump(entry, fh)
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class TokenManager:
+    """
+    Caches an access token returned by `fetcher` and refreshes it ahead of expiry.
+
+    `fetcher` is called without arguments and must return (access_token, expires_in)
+    or None on failure. Tokens are treated as expired `expiry_margin` seconds early,
+    and a background refresh starts once less than `refresh_ahead` seconds remain.
+    """
+
+    def __init__(self, fetcher, backend=None, expiry_margin=30, refresh_ahead=60):
+        self._fetcher = fetcher
+        self._backend = backend
+        self.expiry_margin = expiry_margin
+        self.refresh_ahead = refresh_ahead
+        self._entry = None
+        self._refresh_lock = threading.Lock()
+        self.metrics = TokenMetrics()
+
+    @staticmethod
+    def _remaining(entry):
+        if not entry or not entry.get("access_token"):
+            return 0
+        return entry.get("expires_at", 0) - time.time()
+
+    def get_token(self):
+        """Return a valid access token, or None if Bol.com could not be reached."""
+        entry = self._entry
+        remaining = self._remaining(entry)
+        if remaining > self.expiry_margin:
+            self.metrics.record("hits")
+            if remaining <= self.refresh_ahead:
+                self._refresh_in_background()
+            return entry["access_token"]
+
+        entry = self._load_shared()
+        if entry:
+            self.metrics.record("shared_hits")
+            return entry["access_token"]
+
+        self.metrics.record("misses")
+        with self._refresh_lock:
+            # Another thread may have refreshed the token while we were waiting
+            entry = self._entry
+            if self._remaining(entry) > self.expiry_margin:
+                return entry["access_token"]
+            entry = self._refresh()
+        return entry["access_token"] if entry else None
+
+    def invalidate(self):
+        """Drop the cached token, e.g. after the API rejected it with 401."""
+        self._entry = None
+        if self._backend is not None:
+            try:
+                self._backend.clear()
+            except Exception as e:
+                print(f"Token cache clear error: {e}")
+
+    def _load_shared(self):
+        if self._backend is None:
+            return None
+        try:
+            entry = self._backend.load()
+        except Exception as e:
+            print(f"Token cache read error: {e}")
+            return None
+        if self._remaining(entry) > self.expiry_margin:
+            self._entry = entry
+            return entry
+        return None
+
+    def _refresh_in_background(self):
+        if not self._refresh_lock.acquire(blocking=False):
+            return  # a refresh is already in flight
+
+        def run():
+            try:
+                self._refresh(background=True)
+            finally:
+                self._refresh_lock.release()
+
+        threading.Thread(target=run, name="token-refresh", daemon=True).start()
+
+    def _refresh(self, background=False):
+        started = time.perf_counter()
+        try:
+            result = self._fetcher()
+        except Exception as e:
+            print(f"Token refresh error: {e}")
+            result = None
+        latency = time.perf_counter() - started
+        self.metrics.record_refresh(latency, ok=bool(result), background=background)
+        if not result:
+            return None
+
+        access_token, expires_in = result
+        entry = {"access_token": access_token, "expires_at": time.time() + float(expires_in)}
+        self._entry = entry
+        if self._backend is not None:
+            try:
+                self._backend.store(entry)
+            except Exception as e:
+                print(f"Token cache write error: {e}")
+        return entry
+
+
+def build_token_backend(name, path=None, cache_alias="default", key="bol_access_token"):
+    """Create the shared backend configured in settings ("memory", "django" or "file")."""
+    name = (name or "memory").lower()
+    if name == "django":
+        return DjangoCacheTokenBackend(alias=cache_alias, key=key)
+    if name == "file" and path:
+        return FileTokenBackend(path)
+    return None
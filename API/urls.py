@@ -1,8 +1,15 @@
 from django.urls import path
-from .views import InvoiceAnalyticsView, OnOfficeImagesView
+from .views import (
+    InvoiceAnalyticsView, InvoiceBatchAnalyticsView, OnOfficeImagesView,
+    AsyncInvoiceAnalyticsView, AsyncOnOfficeImagesView,
+)
 
 urlpatterns = [
     # Example: /api/invoice/3914706511912/
     path('invoice/<str:invoice_id>/', InvoiceAnalyticsView.as_view(), name='invoice-analytics'),
+    path('invoices/analytics/', InvoiceBatchAnalyticsView.as_view(), name='invoice-batch-analytics'),
     path('onoffice/images/<int:estate_id>/', OnOfficeImagesView.as_view(), name='onoffice-images'),
+    # Async (ASGI) variants of the two views above
+    path('async/invoice/<str:invoice_id>/', AsyncInvoiceAnalyticsView.as_view(), name='invoice-analytics-async'),
+    path('async/onoffice/images/<int:estate_id>/', AsyncOnOfficeImagesView.as_view(), name='onoffice-images-async'),
 ]
\ No newline at end of file
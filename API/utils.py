@@ -1,138 +1,344 @@
 import requests
+import httpx
 import os
+import threading
+import hashlib
+import tempfile
+import zlib
+from asgiref.sync import sync_to_async
 from requests.auth import HTTPBasicAuth
+from .http_client import http_get, http_post, async_http_get
+from collections import OrderedDict
+from .invoice_cache import InvoiceSpecCache
+from .json_stream import iter_json_array_items, JSONStreamError
+from .invoice_engine import InvoiceAggregator, InvoiceEanIndex
+from .token_manager import TokenManager, build_token_backend
 
 # Best practice: Load these from environment variables or settings.py
 # For now, you can set them here or use os.getenv()
 CLIENT_ID = "56073c0b-f4f9-4ee7-a42d-841eec482231" 
 CLIENT_SECRET = "bZEcc(Cjkuz2wrLAVhMDvKwHjlxjk3c)1msu!QP1ItzMkPDhUaYHqcSxnkEWNiLO"
 
-def get_bol_access_token():
-    """Fetches a fresh OAuth token from Bol.com"""
+def _request_bol_token():
+    """Performs the client-credentials grant. Returns (access_token, expires_in) or None"""
     token_url = "https://login.bol.com/token?grant_type=client_credentials"
     auth = HTTPBasicAuth(CLIENT_ID, CLIENT_SECRET)
     
     try:
-        response = requests.post(
+        response = http_post(
             token_url, 
             auth=auth, 
-            headers={"Accept": "application/json"}
+            headers={"Accept": "application/json"},
+            idempotent=True,  # a repeated client-credentials grant just issues another token
         )
         response.raise_for_status()
-        return response.json()["access_token"]
+        data = response.json()
+        return data["access_token"], data.get("expires_in", 299)
     except requests.RequestException as e:
         print(f"Auth Error: {e}")
         return None
 
-def fetch_invoice_spec(invoice_id, access_token):
-    """Downloads the JSON specification for the invoice"""
+_token_manager = None
+_token_manager_lock = threading.Lock()
+
+def get_bol_token_manager():
+    """Returns the process-wide Bol.com token manager, configured from settings"""
+    global _token_manager
+    if _token_manager is None:
+        with _token_manager_lock:
+            if _token_manager is None:
+                from django.conf import settings
+                backend = build_token_backend(
+                    getattr(settings, 'BOL_TOKEN_CACHE_BACKEND', 'memory'),
+                    path=getattr(settings, 'BOL_TOKEN_CACHE_PATH', None),
+                )
+                _token_manager = TokenManager(
+                    _request_bol_token,
+                    backend=backend,
+                    expiry_margin=getattr(settings, 'BOL_TOKEN_EXPIRY_MARGIN', 30),
+                    refresh_ahead=getattr(settings, 'BOL_TOKEN_REFRESH_AHEAD', 60),
+                )
+    return _token_manager
+
+def get_bol_access_token():
+    """Returns a cached OAuth token from Bol.com, fetching a fresh one only when needed"""
+    return get_bol_token_manager().get_token()
+
+_invoice_cache = None
+_invoice_cache_lock = threading.Lock()
+_INVOICE_CACHE_UNAVAILABLE = object()  # the cache could not be opened; not retried by this process
+
+def get_invoice_cache():
+    """Returns the persistent invoice specification cache, or None when it is disabled or unavailable"""
+    global _invoice_cache
+    from django.conf import settings
+    if not getattr(settings, 'INVOICE_CACHE_ENABLED', True):
+        return None
+    if _invoice_cache is None:
+        with _invoice_cache_lock:
+            if _invoice_cache is None:
+                path = getattr(settings, 'INVOICE_CACHE_PATH', None) or os.path.join(tempfile.gettempdir(), 'sitecap_invoice_specs.sqlite3')
+                try:
+                    _invoice_cache = InvoiceSpecCache(
+                        path,
+                        max_bytes=getattr(settings, 'INVOICE_CACHE_MAX_BYTES', 200 * 1024 * 1024),
+                        touch_interval=getattr(settings, 'INVOICE_CACHE_TOUCH_INTERVAL', 300),
+                    )
+                except Exception as e:
+                    print(f"Invoice Cache Error: {e} (cache disabled for this process)")
+                    _invoice_cache = _INVOICE_CACHE_UNAVAILABLE
+    return None if _invoice_cache is _INVOICE_CACHE_UNAVAILABLE else _invoice_cache
+
+def get_cached_invoice_spec(invoice_id):
+    """Returns the cached specification entry for the invoice (no network I/O), or None"""
+    cache = get_invoice_cache()
+    if cache is None:
+        return None
+    try:
+        return cache.get(invoice_id)
+    except Exception as e:
+        print(f"Invoice Cache Error: {e}")
+        return None
+
+def _invoice_spec_request(invoice_id, access_token, cached=None):
+    """URL and headers for the invoice specification call (with cache validators if any)"""
     url = f"https://api.bol.com/retailer/invoices/{invoice_id}/specification"
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Accept": "application/vnd.retailer.v10+json"
     }
+    if cached is not None:
+        if cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
+    return url, headers
+
+def _store_invoice_spec(invoice_id, body, response_headers):
+    """Writes a downloaded specification body to the invoice cache (if enabled)"""
+    cache = get_invoice_cache()
+    if cache is not None:
+        try:
+            cache.put(
+                invoice_id,
+                body,
+                etag=response_headers.get("ETag"),
+                last_modified=response_headers.get("Last-Modified"),
+            )
+        except Exception as e:
+            print(f"Invoice Cache Error: {e}")
+
+def fetch_invoice_spec(invoice_id, access_token, cached=None):
+    """
+    Downloads the JSON specification for the invoice and stores it in the invoice cache.
+    If a cached entry is passed, its ETag / Last-Modified are sent so Bol.com can answer
+    304 Not Modified and the cached copy is returned instead.
+    """
+    url, headers = _invoice_spec_request(invoice_id, access_token, cached)
     
     try:
-        response = requests.get(url, headers=headers)
+        response = http_get(url, headers=headers)
+        if response.status_code == 401:
+            # Token was revoked before its expiry - force a fresh one next time
+            get_bol_token_manager().invalidate()
+        if response.status_code == 304 and cached is not None:
+            get_invoice_cache().touch(invoice_id)
+            return cached.data
         response.raise_for_status()
-        return response.json()
+        data = response.json()
     except requests.RequestException as e:
         print(f"Fetch Error: {e}")
         return None
 
+    _store_invoice_spec(invoice_id, response.content, response.headers)
+    return data
+
+async def afetch_invoice_spec(invoice_id, access_token, cached=None):
+    """Async variant of fetch_invoice_spec on the shared async HTTP client"""
+    url, headers = _invoice_spec_request(invoice_id, access_token, cached)
+
+    try:
+        response = await async_http_get(url, headers=headers)
+        if response.status_code == 401:
+            get_bol_token_manager().invalidate()
+        if response.status_code == 304 and cached is not None:
+            await sync_to_async(get_invoice_cache().touch, thread_sensitive=False)(invoice_id)
+            return await sync_to_async(lambda: cached.data, thread_sensitive=False)()
+        response.raise_for_status()
+        data = response.json()
+    except (httpx.HTTPError, ValueError) as e:
+        print(f"Fetch Error: {e}")
+        return None
+
+    await sync_to_async(_store_invoice_spec, thread_sensitive=False)(invoice_id, response.content, response.headers)
+    return data
+
+def stream_invoice_aggregator(invoice_id, access_token, batch_size=5000):
+    """
+    Streaming variant of fetch_invoice_spec + calculate_invoice_totals for very large invoices.
+    invoiceSpecification lines are parsed from the response body as it arrives and fed to an
+    InvoiceAggregator in batches, so the full document is never materialised. When the
+    invoice cache is enabled the body is compressed on the fly into a temporary file, which
+    is then copied into the cache together with its analytics. Returns the
+    InvoiceAggregator, or None on error.
+    """
+    url = f"https://api.bol.com/retailer/invoices/{invoice_id}/specification"
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Accept": "application/vnd.retailer.v10+json"
+    }
+    cache = get_invoice_cache()
+    hasher = hashlib.sha256()
+    compressor = zlib.compressobj(6) if cache is not None else None
+    spool = tempfile.TemporaryFile(prefix='invoice-') if cache is not None else None
+    response = None
+
+    try:
+        response = http_get(url, headers=headers, stream=True)
+        if response.status_code == 401:
+            get_bol_token_manager().invalidate()
+        response.raise_for_status()
+
+        def body_chunks():
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                hasher.update(chunk)
+                if compressor is not None:
+                    spool.write(compressor.compress(chunk))
+                yield chunk
+
+        chunks = body_chunks()
+        aggregator = InvoiceAggregator()
+        batch = []
+        for line in iter_json_array_items(chunks, "invoiceSpecification"):
+            batch.append(line)
+            if len(batch) >= batch_size:
+                aggregator.add_lines(batch)
+                batch = []
+        aggregator.add_lines(batch)
+        for _ in chunks:
+            pass  # read the rest of the body so the digest covers the whole document
+    except (requests.RequestException, JSONStreamError) as e:
+        print(f"Fetch Error: {e}")
+        if spool is not None:
+            spool.close()
+        return None
+    finally:
+        if response is not None:
+            response.close()
+
+    if cache is not None:
+        try:
+            digest = hasher.hexdigest()
+            spool.write(compressor.flush())
+            cache.put_compressed(
+                invoice_id,
+                digest,
+                spool,
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+            )
+            cache.put_analytics(digest, aggregator.results())
+        except Exception as e:
+            print(f"Invoice Cache Error: {e}")
+        finally:
+            spool.close()
+    return aggregator
+
+def list_invoice_ids(period_start, period_end, access_token):
+    """Returns the ids of all invoices in a period (YYYY-MM-DD dates, Bol allows up to 31 days)"""
+    url = "https://api.bol.com/retailer/invoices"
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Accept": "application/vnd.retailer.v10+json"
+    }
+    params = {"period-start-date": period_start, "period-end-date": period_end}
+
+    try:
+        response = http_get(url, headers=headers, params=params)
+        response.raise_for_status()
+        items = response.json().get("invoiceListItems", [])
+        return [str(item["invoiceId"]) for item in items if item.get("invoiceId")]
+    except (requests.RequestException, ValueError) as e:
+        print(f"Invoice List Error: {e}")
+        return None
+
+def load_invoice_aggregator(invoice_id, access_token=None):
+    """
+    Aggregates one invoice into an InvoiceAggregator, reading the specification from the
+    invoice cache when possible and downloading it with access_token otherwise.
+    Returns None if the invoice could not be loaded.
+    """
+    from django.conf import settings
+    cached = get_cached_invoice_spec(invoice_id)
+    if cached is not None and not getattr(settings, 'INVOICE_CACHE_REVALIDATE', False):
+        invoice_data = cached.data
+    elif access_token and cached is None and getattr(settings, 'BOL_INVOICE_STREAMING', False):
+        return stream_invoice_aggregator(
+            invoice_id, access_token, batch_size=getattr(settings, 'BOL_INVOICE_STREAM_BATCH', 5000)
+        )
+    elif access_token:
+        invoice_data = fetch_invoice_spec(invoice_id, access_token, cached=cached)
+    else:
+        invoice_data = None
+    if not invoice_data:
+        return None
+    return InvoiceAggregator().add_lines(invoice_data.get("invoiceSpecification", []))
+
+_ean_indexes = OrderedDict()
+_ean_indexes_lock = threading.Lock()
+EAN_INDEX_MEMORY_SIZE = 64
+
+def get_invoice_ean_index(invoice_id, invoice_data=None, cached=None):
+    """
+    Returns the InvoiceEanIndex (all EAN totals plus the ALL summary) for an invoice.
+    The index is computed once per specification - keyed by the content digest of the
+    cached body - and stored next to it, so later ?ean= queries are a dictionary lookup.
+    Pass invoice_data when the specification was just downloaded, or the cached entry.
+    """
+    if cached is None or invoice_data is not None:
+        cached = get_cached_invoice_spec(invoice_id)
+    digest = cached.digest if cached is not None else None
+
+    if digest:
+        with _ean_indexes_lock:
+            index = _ean_indexes.get(digest)
+            if index is not None:
+                _ean_indexes.move_to_end(digest)
+                return index
+
+    cache = get_invoice_cache()
+    results = None
+    if digest and cache is not None:
+        try:
+            results = cache.get_analytics(digest)
+        except Exception as e:
+            print(f"Invoice Cache Error: {e}")
+    if results is None:
+        if invoice_data is None:
+            if cached is None:
+                return None
+            invoice_data = cached.data
+        results = calculate_invoice_totals(invoice_data)
+        if digest and cache is not None:
+            try:
+                cache.put_analytics(digest, results)
+            except Exception as e:
+                print(f"Invoice Cache Error: {e}")
+
+    index = InvoiceEanIndex(results)
+    if digest:
+        with _ean_indexes_lock:
+            _ean_indexes[digest] = index
+            while len(_ean_indexes) > EAN_INDEX_MEMORY_SIZE:
+                _ean_indexes.popitem(last=False)
+    return index
+
 def calculate_invoice_totals(invoice_data, target_ean=None):
     """
     Parses the invoice JSON and calculates totals.
     If target_ean is provided, filters for that EAN.
     If not, returns totals for ALL EANs found.
+    The per-line rules live in invoice_engine, shared with the streaming and cached paths.
     """
-    
-    # Storage for results: { "EAN123": { "revenue": 0, "commission": 0 ... } }
-    results = {}
-
     lines = invoice_data.get("invoiceSpecification", [])
-
-    for line in lines:
-        item = line.get("item", {})
-        
-        # --- 1. EXTRACT EAN ---
-        ean = "UNKNOWN"
-        props = item.get("AdditionalItemProperty", [])
-        
-        # Try to find explicit EAN property
-        for p in props:
-            if p.get("Name", {}).get("value") == "EAN":
-                ean = p.get("Value", {}).get("value")
-                break
-        
-        # Fallback to looking for 13-digit number
-        if ean == "UNKNOWN":
-            for p in props:
-                val = p.get("Value", {}).get("value", "")
-                if val and val.isdigit() and len(val) >= 13:
-                    ean = val
-                    break
-        
-        # Filter if a specific EAN was requested
-        if target_ean and ean != target_ean:
-            continue
-            
-        # Initialize dictionary for this EAN if new
-        if ean not in results:
-            results[ean] = {
-                "revenue": 0.0,
-                "commission": 0.0,
-                "ads_cost": 0.0,
-                "shipping": 0.0,
-                "other": 0.0
-            }
-
-        # --- 2. EXTRACT AMOUNT ---
-        amount = float(line.get("lineExtensionAmount", {}).get("value", 0.0))
-        
-        # --- 3. CLASSIFY ---
-        name = item.get("Name", {}).get("value", "").upper()
-        desc_list = item.get("Description", [])
-        description = desc_list[0].get("value", "").lower() if desc_list else ""
-
-        # Revenue (Invert Logic)
-        if name in ["TURNOVER", "CORRECTION_TURNOVER"]:
-            results[ean]["revenue"] += -amount
-            
-        # Commission
-        elif name in ["COMMISSION", "CORRECTION_COMMISSION"]:
-            results[ean]["commission"] += amount
-            
-        # Shipping
-        elif name in ["PICK_PACK", "OUTBOUND", "DISTRIBUTION_BY_BOLCOM_LABEL", "PLAZA_RETURN_SHIPPING_LABEL"]:
-            results[ean]["shipping"] += amount
-            
-        # Ads
-        elif "sponsored products" in description or "advert" in description or name == "SPONSORED_PRODUCTS_ADS":
-            results[ean]["ads_cost"] += amount
-            
-        # Other
-        else:
-            if "verzend" in description or "shipping" in description:
-                results[ean]["shipping"] += amount
-            elif "commissie" in description:
-                results[ean]["commission"] += amount
-            else:
-                results[ean]["other"] += amount
-
-    # --- 4. CALCULATE NET FOR ALL ---
-    final_output = []
-    for ean_key, data in results.items():
-        net = data["revenue"] - (data["commission"] + data["shipping"] + data["ads_cost"] + data["other"])
-        
-        final_output.append({
-            "ean": ean_key,
-            "revenue": round(data["revenue"], 2),
-            "commission": round(data["commission"], 2),
-            "ads_cost": round(data["ads_cost"], 2),
-            "shipping": round(data["shipping"], 2),
-            "other": round(data["other"], 2),
-            "net_result": round(net, 2)
-        })
-
-    return final_output
\ No newline at end of file
+    return InvoiceAggregator().add_lines(lines).results(target_ean)
\ No newline at end of file
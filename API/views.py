@@ -3,10 +3,36 @@ from rest_framework.response import Response
 from rest_framework import status
 from django.views import View
 from django.shortcuts import render
-from django.http import JsonResponse
-from .utils import get_bol_access_token, fetch_invoice_spec, calculate_invoice_totals
+from django.http import JsonResponse, StreamingHttpResponse
+from django.conf import settings
+from .utils import (
+    get_bol_access_token, get_bol_token_manager, get_cached_invoice_spec,
+    fetch_invoice_spec, get_invoice_ean_index, list_invoice_ids, load_invoice_aggregator,
+    stream_invoice_aggregator, afetch_invoice_spec,
+)
+from .invoice_engine import InvoiceAggregator, InvoiceEanIndex
 from .pdf_parsers import extract_travel_to_haram
-import pandas as pd
+from .sheet_upload import stream_file_to_worksheet, sniff_file, SheetUploadError
+from .file_staging import stage_upload, get_staged_file
+from .sheet_dedup import RowDeduplicator
+from .sheet_writer import get_sheet_writer
+from .voucher_bulk import PARSERS as VOUCHER_PARSERS, iter_voucher_files, parse_vouchers, voucher_row
+from .models import PendingSheetRow
+from .jobs import background_jobs_enabled, enqueue_job, get_job, register_job_handler
+from .google_sheets import (
+    READ_SCOPES, WRITE_SCOPES, get_google_creds, open_worksheet, invalidate_sheet, invalidate_headers,
+    get_header_cache, get_sheet_headers,
+    extract_google_sheet_id, extract_gid,
+)
+from .http_client import http_get, http_post, async_http_post
+from .sheet_cache import get_sheet_cache, get_sheet_poller
+from .schedule import (
+    get_schedule_store, get_schedule_result_cache, expand_date_range, parse_schedule_date, date_label,
+    render_schedules, schedule_records, diff_schedule_records, MOVEMENTS, RECORD_FIELDS,
+)
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+import asyncio
 import re
 import requests
 from datetime import datetime
@@ -17,6 +43,9 @@ import hashlib
 import base64
 import json
 import io
+import csv
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 
 
 class RootView(APIView):
@@ -31,8 +60,12 @@ class RootView(APIView):
             "version": "1.0.0",
             "endpoints": {
                 "invoice_analytics": "/api/invoice/<invoice_id>/",
+                "invoice_batch_analytics": "/api/invoices/analytics/",
                 "admin": "/admin/"
             },
+            "metrics": {
+                "bol_token": get_bol_token_manager().metrics.snapshot()
+            },
             "health": "ok"
         }, status=status.HTTP_200_OK)
 
@@ -41,31 +74,62 @@ class InvoiceAnalyticsView(APIView):
     """
     GET /api/invoice/<invoice_id>/
     Optional Query Param: ?ean=8720929627028
+    Optional Query Param: ?nocache=1 (skip the local invoice cache and re-download)
+    Optional Query Param: ?stream=1 (parse the specification incrementally, for very large invoices)
     """
     
     def get(self, request, invoice_id):
-        # 1. Get Authentication
-        token = get_bol_access_token()
-        if not token:
-            return Response(
-                {"error": "Failed to authenticate with Bol.com"}, 
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
+        # 0. Serve from the local invoice cache unless ?nocache=1
+        bypass_cache = request.query_params.get('nocache', '').lower() in ('1', 'true', 'yes')
+        cached = None if bypass_cache else get_cached_invoice_spec(invoice_id)
+        # Streaming mode (BOL_INVOICE_STREAMING or ?stream=1) for invoices not cached yet
+        streaming = cached is None and (
+            getattr(settings, 'BOL_INVOICE_STREAMING', False)
+            or request.query_params.get('stream', '').lower() in ('1', 'true', 'yes')
+        )
+        invoice_json = None
+        ean_index = None
 
-        # 2. Fetch Data
-        invoice_json = fetch_invoice_spec(invoice_id, token)
-        if not invoice_json:
-            return Response(
-                {"error": "Invoice not found or API error"}, 
-                status=status.HTTP_404_NOT_FOUND
-            )
+        # Issued invoices are immutable - a cached one is served without calling Bol.com,
+        # and its body is only loaded if its analytics index has not been built yet.
+        if cached is None or getattr(settings, 'INVOICE_CACHE_REVALIDATE', False):
+            # 1. Get Authentication
+            token = get_bol_access_token()
+            if not token:
+                return Response(
+                    {"error": "Failed to authenticate with Bol.com"}, 
+                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                )
+
+            # 2. Fetch Data
+            if streaming:
+                # Aggregate invoiceSpecification lines while the body downloads
+                aggregator = stream_invoice_aggregator(
+                    invoice_id, token, batch_size=getattr(settings, 'BOL_INVOICE_STREAM_BATCH', 5000)
+                )
+                if aggregator is None:
+                    return Response(
+                        {"error": "Invoice not found or API error"}, 
+                        status=status.HTTP_404_NOT_FOUND
+                    )
+                ean_index = InvoiceEanIndex(aggregator.results())
+            else:
+                invoice_json = fetch_invoice_spec(invoice_id, token, cached=cached)
+                if not invoice_json:
+                    return Response(
+                        {"error": "Invoice not found or API error"}, 
+                        status=status.HTTP_404_NOT_FOUND
+                    )
 
         # 3. Check for specific EAN filter in URL
         target_ean = request.query_params.get('ean', None)
 
         # 4. Calculate
-        # This function handles the logic we built
-        analytics_data = calculate_invoice_totals(invoice_json, target_ean=target_ean)
+        # Totals for every EAN are computed once per invoice specification and kept as an
+        # EAN-keyed index (same output as calculate_invoice_totals, see invoice_engine)
+        if ean_index is None:
+            ean_index = get_invoice_ean_index(invoice_id, invoice_data=invoice_json, cached=cached)
+        analytics_data = ean_index.lookup(target_ean) if ean_index is not None else []
 
         if not analytics_data:
             return Response(
@@ -81,11 +145,147 @@ class InvoiceAnalyticsView(APIView):
         }, status=status.HTTP_200_OK)
 
 
+def _ndjson(obj):
+    """Serialize one line of a newline-delimited JSON stream."""
+    return json.dumps(obj) + "\n"
+
+
+class InvoiceBatchAnalyticsView(APIView):
+    """
+    POST /api/invoices/analytics/
+    Body: {"invoice_ids": ["3914706511912", ...]}
+      or: {"period_start": "2024-01-01", "period_end": "2024-01-31"}
+    Optional: "ean": "8720929627028"
+
+    Specifications are fetched concurrently (BOL_BATCH_WORKERS) with a single token.
+    The response is newline-delimited JSON: one "invoice" line per invoice as soon as it
+    is done, then a "summary" line with the per-EAN totals merged across all invoices.
+    """
+
+    def post(self, request):
+        data = request.data
+        if hasattr(data, 'getlist'):
+            raw_ids = data.getlist('invoice_ids')
+        else:
+            raw_ids = data.get('invoice_ids') or []
+        if isinstance(raw_ids, str):
+            raw_ids = [raw_ids]
+        invoice_ids = []
+        for value in raw_ids:
+            invoice_ids.extend(i.strip() for i in str(value).split(',') if i.strip())
+        invoice_ids = list(dict.fromkeys(invoice_ids))  # drop duplicates, keep order
+
+        period_start = data.get('period_start')
+        period_end = data.get('period_end')
+        target_ean = data.get('ean') or None
+        if not invoice_ids and not (period_start and period_end):
+            return Response(
+                {"error": "Provide invoice_ids or period_start and period_end."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # 1. One token for the whole batch, only if something has to be downloaded
+        token = None
+        needs_token = (
+            not invoice_ids
+            or getattr(settings, 'INVOICE_CACHE_REVALIDATE', False)
+            or any(get_cached_invoice_spec(i) is None for i in invoice_ids)
+        )
+        if needs_token:
+            token = get_bol_access_token()
+            if not token:
+                return Response(
+                    {"error": "Failed to authenticate with Bol.com"},
+                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                )
+
+        # 2. Resolve a date range to invoice ids
+        if not invoice_ids:
+            invoice_ids = list_invoice_ids(period_start, period_end, token)
+            if invoice_ids is None:
+                return Response(
+                    {"error": "Could not list invoices for the period"},
+                    status=status.HTTP_502_BAD_GATEWAY
+                )
+
+        max_invoices = getattr(settings, 'BOL_BATCH_MAX_INVOICES', 100)
+        if len(invoice_ids) > max_invoices:
+            return Response(
+                {"error": f"Too many invoices ({len(invoice_ids)}), the limit is {max_invoices}."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # 3. Stream results as they complete
+        response = StreamingHttpResponse(
+            self._stream(invoice_ids, token, target_ean),
+            content_type='application/x-ndjson'
+        )
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+    def _stream(self, invoice_ids, token, target_ean):
+        aggregators = {}
+        failed = []
+        workers = max(1, min(getattr(settings, 'BOL_BATCH_WORKERS', 4), len(invoice_ids) or 1))
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            futures = {executor.submit(load_invoice_aggregator, i, token): i for i in invoice_ids}
+            for future in as_completed(futures):
+                invoice_id = futures[future]
+                error = "Invoice not found or API error"
+                try:
+                    aggregator = future.result()
+                except Exception as e:
+                    aggregator, error = None, str(e)
+                if aggregator is None:
+                    failed.append(invoice_id)
+                    yield _ndjson({"type": "invoice", "invoice_id": invoice_id, "success": False, "error": error})
+                    continue
+                aggregators[invoice_id] = aggregator
+                yield _ndjson({
+                    "type": "invoice",
+                    "invoice_id": invoice_id,
+                    "success": True,
+                    "results": aggregator.results(target_ean=target_ean)
+                })
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        # Merge in request order so the totals do not depend on completion order
+        merged = InvoiceAggregator()
+        for invoice_id in invoice_ids:
+            if invoice_id in aggregators:
+                merged.merge(aggregators[invoice_id])
+        yield _ndjson({
+            "type": "summary",
+            "filter_ean": target_ean if target_ean else "ALL",
+            "invoice_count": len(aggregators),
+            "failed": failed,
+            "results": merged.results(target_ean=target_ean)
+        })
+
+
+def _sse(event, data):
+    """Serialize one Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class _Echo:
+    """File-like object whose write() returns the line, so csv.writer rows can be streamed."""
+
+    def write(self, value):
+        return value
+
+
 class PilgrimScheduleView(View):
     """
     Landing page for Pilgrim Travel Schedules with security code protection.
     GET: Display the index page
-    POST: Generate schedules based on input date
+         ?action=poll&date=13-Jan&version=V: that date's schedule and records if the sheet version is not V
+         ?action=subscribe&date=13-Jan: Server-Sent Events stream pushing changes for that date
+                                        (SCHEDULE_SSE_ENABLED, ASGI only)
+    POST: Generate schedules based on input date (or start_date/end_date, or a list of dates),
+          as WhatsApp text or, with output_format=json/csv, as structured records
     """
     
     # Configuration - Easy to change
@@ -99,7 +299,105 @@ class PilgrimScheduleView(View):
     def get(self, request):
         """Display the landing page"""
         unlocked = request.get_signed_cookie('unlocked', default='false', salt='pilgrim_secret') == 'true'
-        return render(request, 'API/pilgrim_schedule.html', {'unlocked': unlocked})
+        if request.GET.get('action') == 'poll':
+            return self._poll(request, unlocked)
+        if request.GET.get('action') == 'subscribe':
+            return self._subscribe(request, unlocked)
+        return render(request, 'API/pilgrim_schedule.html', {
+            'unlocked': unlocked,
+            'live_updates': self._live_updates_available(request),
+            'poll_seconds': getattr(settings, 'SCHEDULE_POLL_SECONDS', 120),
+        })
+    
+    def _live_updates_available(self, request):
+        # A stream holds a WSGI worker for its whole life, so SSE is only served under ASGI
+        return getattr(settings, 'SCHEDULE_SSE_ENABLED', False) and isinstance(request, ASGIRequest)
+    
+    def _poll(self, request, unlocked):
+        """
+        Short request for the page's periodic check of one date: only the version when the
+        sheet has not changed since `version`, else the schedule, counts and records.
+        """
+        if not unlocked:
+            return JsonResponse({'success': False, 'error': 'Locked'}, status=403)
+        input_date_raw = request.GET.get('date', '')
+        try:
+            parse_schedule_date(input_date_raw)
+            snapshot = get_sheet_cache(self.GOOGLE_SHEET_CSV_URL).get()
+        except Exception as e:
+            return JsonResponse({'success': False, 'error': str(e)}, status=400)
+        if request.GET.get('version') == str(snapshot.version):
+            return JsonResponse({'success': True, 'changed': False, 'version': str(snapshot.version)})
+        day = self._schedule_days([input_date_raw], 'json', snapshot)[0]
+        text = self._schedule_days([input_date_raw], 'text', snapshot)[0]
+        return JsonResponse({'success': True, 'changed': True, 'version': str(snapshot.version),
+                             'records': day['records'], 'counts': day['counts'], 'schedule': text['schedule']})
+    
+    def _subscribe(self, request, unlocked):
+        """
+        Keep an SSE connection open for one date. A 'schedule' event is sent first, then an
+        'update' event with the added/removed movements whenever a new version of the sheet
+        changes that date. All connections share one sheet poller thread; the stream is an
+        async generator that sleeps on the event loop, so it holds no worker or thread.
+        """
+        if not unlocked:
+            return JsonResponse({'success': False, 'error': 'Locked'}, status=403)
+        if not self._live_updates_available(request):
+            return JsonResponse({'success': False, 'error': 'Live updates are not enabled; use action=poll.'}, status=404)
+        input_date_raw = request.GET.get('date', '')
+        try:
+            parse_schedule_date(input_date_raw)
+            snapshot = get_sheet_cache(self.GOOGLE_SHEET_CSV_URL).get()
+        except Exception as e:
+            return JsonResponse({'success': False, 'error': str(e)}, status=400)
+        
+        poller = get_sheet_poller(self.GOOGLE_SHEET_CSV_URL)
+        heartbeat = getattr(settings, 'SCHEDULE_SSE_HEARTBEAT', 15)
+        max_seconds = getattr(settings, 'SCHEDULE_SSE_MAX_SECONDS', 300)
+        schedule_days = sync_to_async(self._schedule_days, thread_sensitive=False)
+        
+        async def wait_for_change(version):
+            waited = 0
+            while True:
+                if poller.version is not None and poller.version != version:
+                    return poller.version
+                if waited >= heartbeat:
+                    return None
+                await asyncio.sleep(1)
+                waited += 1
+        
+        async def events():
+            poller.subscribe()
+            try:
+                version = snapshot.version
+                day = (await schedule_days([input_date_raw], 'json', snapshot))[0]
+                text = (await schedule_days([input_date_raw], 'text', snapshot))[0]
+                yield _sse('schedule', {'date': input_date_raw, 'version': version,
+                                        'counts': day['counts'], 'schedule': text['schedule']})
+                # Connections are recycled now and then; EventSource reconnects by itself
+                deadline = time.monotonic() + max_seconds
+                while time.monotonic() < deadline:
+                    new_version = await wait_for_change(version)
+                    if new_version is None:
+                        yield ": keep-alive\n\n"
+                        continue
+                    version = new_version
+                    current = get_sheet_cache(self.GOOGLE_SHEET_CSV_URL).current()
+                    new_day = (await schedule_days([input_date_raw], 'json', current))[0]
+                    added, removed = diff_schedule_records(day['records'], new_day['records'])
+                    day = new_day
+                    if added or removed:
+                        text = (await schedule_days([input_date_raw], 'text', current))[0]
+                        yield _sse('update', {'date': input_date_raw, 'version': current.version,
+                                              'added': added, 'removed': removed,
+                                              'counts': day['counts'], 'schedule': text['schedule']})
+            finally:
+                poller.unsubscribe()
+        
+        response = StreamingHttpResponse(events(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # keep nginx from buffering the stream
+        return response
     
     def post(self, request):
         """Handle security code check and schedule generation"""
@@ -119,215 +417,154 @@ class PilgrimScheduleView(View):
         elif action == 'generate_schedule':
             try:
                 input_date_raw = request.POST.get('date', '')
+                start_date = request.POST.get('start_date', '')
+                end_date = request.POST.get('end_date', '')
+                dates_raw = request.POST.get('dates', '')
+                # text (WhatsApp format), json (records) or csv (streamed download)
+                output_format = request.POST.get('output_format', 'text').lower()
+                if output_format not in ('text', 'json', 'csv'):
+                    return JsonResponse({'success': False, 'error': 'output_format must be text, json or csv'})
                 
-                if not input_date_raw:
+                # Range mode: several days from one load of the sheet
+                range_mode = bool(dates_raw or start_date or end_date)
+                if range_mode:
+                    if dates_raw:
+                        dates = [d.strip() for d in re.split(r"[,\n]", dates_raw) if d.strip()]
+                    elif start_date and end_date:
+                        dates = expand_date_range(
+                            start_date, end_date, getattr(settings, 'SCHEDULE_MAX_RANGE_DAYS', 62),
+                            year=request.POST.get('year') or None,  # optional, e.g. for 28-Feb to 1-Mar
+                        )
+                    else:
+                        return JsonResponse({'success': False, 'error': 'Both start_date and end_date are required'})
+                elif not input_date_raw:
                     return JsonResponse({'success': False, 'error': 'Date is required'})
+                else:
+                    dates = [input_date_raw]
+                
+                if output_format == 'csv':
+                    return self._schedule_csv_response(dates)
+                if output_format == 'json':
+                    result = self._schedule_json(dates)
+                    return JsonResponse({'success': True, **(result if range_mode else result['days'][0])})
+                if range_mode:
+                    return JsonResponse({'success': True, **self._generate_schedules(dates)})
                 
                 # Generate the schedule using the original logic
-                schedule_output = self._generate_schedule(input_date_raw)
+                schedule_output = self._schedule_days(dates, 'text')[0]['schedule']
                 
                 return JsonResponse({'success': True, 'schedule': schedule_output})
             
             except Exception as e:
                 return JsonResponse({'success': False, 'error': str(e)})
         
+        # Action 3: Reload the Google Sheet now instead of waiting for the cache TTL
+        elif action == 'refresh_sheet':
+            try:
+                cache = get_sheet_cache(self.GOOGLE_SHEET_CSV_URL)
+                previous = cache.current()
+                snapshot = cache.refresh(force=True)
+                return JsonResponse({
+                    'success': True,
+                    'changed': previous is None or previous.version != snapshot.version,
+                    'rows': len(snapshot.dataframe),
+                    'fetched_at': datetime.fromtimestamp(snapshot.fetched_at).strftime("%Y-%m-%d %H:%M:%S"),
+                })
+            except Exception as e:
+                return JsonResponse({'success': False, 'error': str(e)})
+        
         return JsonResponse({'success': False, 'error': 'Invalid action'})
     
-    def _generate_schedule(self, input_date_raw):
+    def _get_schedule_store(self):
+        # Cached sheet snapshot, normalised and indexed by date once per version of the sheet
+        return get_schedule_store(get_sheet_cache(self.GOOGLE_SHEET_CSV_URL).get())
+    
+    def _schedule_days(self, dates, output_format, snapshot=None):
         """
-        Generate schedules based on input date.
-        This is the original logic from Jupyter notebook - DO NOT DISTURB
+        Per-day results ('text' schedule or 'json' records, plus movement counts) from one
+        snapshot of the sheet. Each day is memoised per sheet version in the result cache.
         """
-        # Read Google Sheet into pandas
-        df = pd.read_csv(self.GOOGLE_SHEET_CSV_URL, dtype=str)
+        if snapshot is None:
+            snapshot = get_sheet_cache(self.GOOGLE_SHEET_CSV_URL).get()
+        store = get_schedule_store(snapshot)
+        result_cache = get_schedule_result_cache()
         
-        # ==========================
-        # PARSE INPUT DATE (ROBUST)
-        # ==========================
-        m = re.search(r"(\d{1,2})", input_date_raw)
-        if not m:
-            raise ValueError("Invalid input date. Use like: 13-Jan or JAN-13")
-        
-        input_day = int(m.group(1))
-        
-        m2 = re.search(r"([A-Za-z]+)", input_date_raw)
-        if not m2:
-            raise ValueError("Month missing in input")
-        
-        input_month = m2.group(1)[:3].title()   # Jan, Feb, etc.
-        
-        # ==========================
-        # CLEAN MONTH COLUMN
-        # ==========================
-        df["MONTH_CLEAN"] = (
-            df["MONTH"]
-            .str.strip()
-            .str[:3]
-            .str.title()
-        )
-        
-        # ==========================
-        # GENERIC DAY EXTRACTOR
-        # ==========================
-        def extract_day(series):
-            return (
-                series
-                .str.strip()
-                .str.extract(r"(\d{1,2})")[0]
-                .astype(float)
-            )
-        
-        # ==========================
-        # EXTRACT DAY FROM DATE COLUMNS
-        # ==========================
-        df["DAY_MAIN"] = extract_day(df["DATE / التاريخ"])
-        df["DAY_CHOUT_1"] = (df["CH OUT / خروج"])
-        df["DAY_CHECKOUT"] = (df["CHECKOUT"])
-        df["DAY_CHOUT_2"] = (df["CH OUT"])
-        df["DAY_DP"] = extract_day(df["DP DATE / مغادره تاريخ"])
-        
-        # ==========================
-        # SCHEDULE BUILDER
-        # ==========================
-        def build_schedule(df_f, title, m, static_time=None, static_route=None):
-            if df_f.empty:
-                return f"\n {title} \n\nNO MOVEMENTS\n"
-            
-            out = [f"\n {title} \n"]
-            for idx, (_, r) in enumerate(df_f.iterrows(), 1):
-                # Handle time: if 'time' key exists in mapping, use column data
-                # Otherwise use only static_time (for f2 schedule)
-                if 'time' in m:
-                    time_display = f"{r[m['time']]} {static_time if static_time else ''}"
-                else:
-                    time_display = static_time if static_time else ""
-                
-                flight_info = f"Flight    : {r[m['flight']]}\n" if 'flight' in m and r[m['flight']] else ""
-                
-                # Handle pickup - can be string (column name) or int (column index)
-                if 'pickup' in m:
-                    pickup_value = r.iloc[m['pickup']] if isinstance(m['pickup'], int) else r[m['pickup']]
-                    pickup_info = f"Pickup    : {pickup_value}\n"
-                else:
-                    pickup_info = ""
-                
-                # Handle mobile with + prefix, safely handle None/nan values
-                if 'mobile' in m:
-                    mobile_value = r[m['mobile']]
-                    if mobile_value and str(mobile_value).lower() not in ['nan', 'none', '']:
-                        mobile_display = f"+{mobile_value}" if not str(mobile_value).startswith('+') else str(mobile_value)
-                    else:
-                        mobile_display = mobile_value
-                else:
-                    mobile_display = ""
-                
-                out.append(
-                    f"""
-Route     : *{static_route}*
-Booking   : {r[m['booking']]}
-Time      : {time_display}
-{flight_info}{pickup_info}Drop      : {r[m['drop']]}
-Client    : {r[m['client']]}
-Mobile    : {mobile_display}
-Agent     : {r[m['agent']]}
-----------------------------------
-"""
-                )
-            return "".join(out)
+        def compute(input_date_raw):
+            counts = store.counts(input_date_raw)
+            label = date_label(*parse_schedule_date(input_date_raw))
+            day = {'date': label}
+            if output_format == 'text':
+                day['schedule'] = self._generate_schedule(input_date_raw, store=store)
+            else:
+                day['records'] = schedule_records(store.movements(input_date_raw), label).to_dict('records')
+            day.update({'counts': counts, 'total': sum(counts.values())})
+            return day
         
-        # ==========================
-        # FILTER 1 – JED → MAKKAH
-        # ==========================
-        f1 = df[
-            (df["MONTH_CLEAN"] == input_month) &
-            (df["DAY_MAIN"] == input_day)
+        return [
+            result_cache.get_or_compute(snapshot, input_date_raw, output_format, lambda d=input_date_raw: compute(d))
+            for input_date_raw in dates
         ]
+    
+    @staticmethod
+    def _movement_totals(days):
+        totals = dict.fromkeys(MOVEMENTS, 0)
+        for day in days:
+            for movement, count in day['counts'].items():
+                totals[movement] += count
+        return totals
+    
+    def _generate_schedules(self, dates):
+        """
+        Generate the schedules for several dates from one snapshot of the sheet.
+        Returns per-day schedules and movement counts, plus totals and the combined text.
+        """
+        days = self._schedule_days(dates, 'text')
+        return {
+            'days': days,
+            'totals': self._movement_totals(days),
+            'schedule': "".join(day['schedule'] for day in days),
+        }
+    
+    def _schedule_json(self, dates):
+        """Structured records (schedule.RECORD_FIELDS) and movement counts per date."""
+        days = self._schedule_days(dates, 'json')
+        return {'days': days, 'totals': self._movement_totals(days)}
+    
+    def _schedule_csv_response(self, dates):
+        """Stream the structured records for all dates as one CSV file."""
+        # Validate every date and load the sheet up front so errors are still reported as JSON;
+        # every day is rendered from this one snapshot, even if the sheet changes mid-download
+        for input_date_raw in dates:
+            parse_schedule_date(input_date_raw)
+        snapshot = get_sheet_cache(self.GOOGLE_SHEET_CSV_URL).get()
+        get_schedule_store(snapshot)
+        writer = csv.writer(_Echo())
         
-        # ==========================
-        # FILTER 2 – MAKKAH → MADINAH
-        # ==========================
-        f2 = df[df["DAY_CHOUT_1"] == input_date_raw] 
-        
-        # ==========================
-        # FILTER 3 – MADINAH → AIRPORT
-        # ==========================
-        f3 = df[df["DAY_CHECKOUT"] == input_date_raw]
+        def rows():
+            yield writer.writerow(RECORD_FIELDS)
+            for input_date_raw in dates:
+                day = self._schedule_days([input_date_raw], 'json', snapshot)[0]
+                for record in day['records']:
+                    yield writer.writerow([record[field] for field in RECORD_FIELDS])
         
-        # ==========================
-        # FILTER 4 – MAKKAH → JED
-        # ==========================
-        f4 = df[df["DAY_CHOUT_2"] == input_date_raw]
+        label = dates[0] if len(dates) == 1 else f"{dates[0]}_{dates[-1]}"
+        response = StreamingHttpResponse(rows(), content_type='text/csv; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="schedule_{re.sub(r"[^A-Za-z0-9-]+", "_", label)}.csv"'
+        return response
+    
+    def _generate_schedule(self, input_date_raw, store=None):
+        """
+        Generate schedules based on input date.
+        The text output is the original logic from Jupyter notebook - DO NOT DISTURB
+        """
+        if store is None:
+            store = self._get_schedule_store()
         
         # ==========================
-        # BUILD FINAL OUTPUT
+        # FILTERS 1-4 – JED → MAKKAH, MAKKAH → MADINAH, MADINAH → AIRPORT, MAKKAH → JED
+        # BUILD FINAL OUTPUT (layouts in schedule.SCHEDULE_FORMATS)
         # ==========================
-        final_output = (
-            build_schedule(
-                f1,
-                "SCHEDULE 1 – JED → MAKKAH",
-                {
-                    "booking": "TR / مواصلات",
-                    "time": "ETA/ موعدالوصول",
-                    "drop": "MAKKA HOTEL / مكة فندق",
-                    "client": "FAMILY NAME",
-                    "mobile": "MOBILE NO.",
-                    "agent": "AGENT NAME / اسم وكيل",
-                    "flight": "FLIGHT/ رقم رحلة\n"
-                }
-                ,
-                static_route="JED → MAKKAH"
-            )
-            +
-            build_schedule(
-                f2,
-                "SCHEDULE 2 – MAKKAH → MADINAH",
-                {
-                    "booking": "TR / مواصلات",
-                    "pickup": "MAKKA HOTEL / مكة فندق",
-                    "drop": "MEDINAH HOTEL / مدينه فندق",
-                    "client": "FAMILY NAME",
-                    "mobile": "MOBILE NO.",
-                    "agent": "AGENT NAME / اسم وكيل"
-                },
-                static_time="10:00 AM",
-                static_route="MAKKAH → MADINAH"
-            )
-            +
-            build_schedule(
-                f3,
-                "SCHEDULE 3 – MADINAH → AIRPORT",
-                {
-                    "booking": "TR / مواصلات",
-                    "pickup": "MEDINAH HOTEL / مدينه فندق",
-                    "time": "TIME  TO GO AIRPOT / التوقيت ",
-                    "flight": "FLIGHT TIME / الوقت الرحلة/DEP",
-                    "drop": "FROM / من/AIRPORT",
-                    "client": "FAMILY NAME",
-                    "mobile": "MOBILE NO.",
-                    "agent": "AGENT NAME / اسم وكيل",
-                    
-                },
-                static_route="MADINAH → AIRPORT"
-            )
-            +
-            build_schedule(
-                f4,
-                "SCHEDULE 4 – MAKKAH → JED",
-                {
-                    "booking": "TR / مواصلات",
-                    "pickup": 21,#column v 
-                    "time": "TIME  TO GO AIRPOT / التوقيت ",
-                    "drop": "FROM / من/AIRPORT",
-                    "client": "FAMILY NAME",
-                    "mobile": "MOBILE NO.",
-                    "agent": "AGENT NAME / اسم وكيل",
-                    "flight": "FLIGHT TIME / الوقت الرحلة/DEP"
-                },
-                static_time="TO GO AIRPORT",
-                static_route="MAKKAH → JED"
-
-            )
-        )
+        final_output = render_schedules(store.movements(input_date_raw))
         
         # Add header with date
         current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -344,74 +581,16 @@ Agent     : {r[m['agent']]}
 # FILE UPLOAD TO GOOGLE SHEET (separate feature - do not modify above logic)
 # ---------------------------------------------------------------------------
 
-def _get_google_creds(scopes):
-    """Get Google credentials from file path or JSON env var (for Vercel/serverless)."""
-    import os
-    import json
-    from django.conf import settings
-    # Option 1: JSON string in env (for Vercel - paste entire key.json content)
-    json_str = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS_JSON')
-    if json_str:
-        try:
-            info = json.loads(json_str)
-            from google.oauth2.service_account import Credentials
-            return Credentials.from_service_account_info(info, scopes=scopes)
-        except (json.JSONDecodeError, KeyError):
-            pass
-    # Option 2: File path (local / .env)
-    creds_path = getattr(settings, 'GOOGLE_SHEETS_CREDENTIALS_PATH', None) or os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
-    if creds_path and not os.path.isabs(creds_path):
-        base = getattr(settings, 'BASE_DIR', None)
-        if base:
-            creds_path = os.path.join(base, creds_path)
-    if creds_path and os.path.isfile(creds_path):
-        from google.oauth2.service_account import Credentials
-        return Credentials.from_service_account_file(creds_path, scopes=scopes)
-    return None
-
-
-def _extract_google_sheet_id(url):
-    """Extract spreadsheet ID from Google Sheet URL (edit or published)."""
-    import re
-    # Published to web: /d/e/2PACX-xxx...
-    m = re.search(r'/d/e/([a-zA-Z0-9_-]+)', url)
-    if m:
-        return ('published', m.group(1))
-    # Standard edit URL: /d/1xxx...
-    m = re.search(r'/d/([a-zA-Z0-9_-]+)', url)
-    if m:
-        return ('edit', m.group(1))
-    return None
-
-
-def _extract_gid(url):
-    """Extract worksheet gid from Google Sheet URL (?gid=123 or #gid=123). Uses that tab instead of first sheet."""
-    import re
-    if not url:
-        return None
-    m = re.search(r'[?#]gid=(\d+)', url)
-    if m:
-        try:
-            return int(m.group(1))
-        except ValueError:
-            return None
-    return None
-
-
-def _get_worksheet(sh, gid=None):
-    """Return worksheet by gid if given, else first sheet."""
-    if gid is not None:
-        try:
-            return sh.get_worksheet_by_id(gid)
-        except (Exception, AttributeError):
-            pass
-    return sh.sheet1
+def _get_sheet_headers_from_csv_export(sheet_id, gid=0, refresh=False):
+    """First row (headers) of a public Google Sheet via CSV export, cached per (sheet id, gid)."""
+    raw_sid = sheet_id[1] if isinstance(sheet_id, tuple) else sheet_id
+    return get_header_cache().get(
+        ('csv', raw_sid, gid), lambda: _fetch_csv_export_headers(sheet_id, gid), refresh
+    )
 
 
-def _get_sheet_headers_from_csv_export(sheet_id, gid=0):
-    """Fetch first row (headers) from a public Google Sheet via CSV export."""
-    import csv
-    import requests
+def _fetch_csv_export_headers(sheet_id, gid=0):
+    """Read only the first CSV record of the export; the rest of the sheet is never downloaded."""
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
         'Accept': 'text/csv,text/plain,*/*',
@@ -427,13 +606,24 @@ def _get_sheet_headers_from_csv_export(sheet_id, gid=0):
             url = f"https://docs.google.com/spreadsheets/d/{sid}/export?format=csv&gid={gid}"
     else:
         url = f"https://docs.google.com/spreadsheets/d/{sheet_id}/export?format=csv&gid={gid}"
-    resp = requests.get(url, headers=headers, timeout=20)
-    resp.raise_for_status()
-    first_line = resp.text.split('\n')[0].strip()
-    if not first_line:
-        return []
-    reader = csv.reader([first_line])
-    return next(reader)
+    resp = http_get(url, headers=headers, timeout=20, stream=True)
+    try:
+        resp.raise_for_status()
+        return next(csv.reader(_iter_response_lines(resp)), [])
+    finally:
+        resp.close()  # drops the connection instead of draining the remaining rows
+
+
+def _iter_response_lines(resp, chunk_size=8192):
+    """Decoded lines (with line endings) of a streamed response, read chunk by chunk."""
+    buffer = b''
+    for chunk in resp.iter_content(chunk_size):
+        buffer += chunk
+        while b'\n' in buffer:
+            line, buffer = buffer.split(b'\n', 1)
+            yield (line + b'\n').decode('utf-8', errors='replace')
+    if buffer:
+        yield buffer.decode('utf-8', errors='replace')
 
 
 class FileUploadView(View):
@@ -458,26 +648,25 @@ class FileUploadView(View):
             sheet_url = (request.POST.get('sheet_url') or '').strip()
             if not sheet_url:
                 return JsonResponse({'success': False, 'error': 'Google Sheet URL is required.'})
-            sheet_id = _extract_google_sheet_id(sheet_url)
+            sheet_id = extract_google_sheet_id(sheet_url)
             if not sheet_id:
                 return JsonResponse({'success': False, 'error': 'Invalid Google Sheet URL. Could not find spreadsheet ID.'})
             raw_sid = sheet_id[1] if isinstance(sheet_id, tuple) else sheet_id
             if isinstance(sheet_id, tuple) and sheet_id[0] == 'published':
                 return JsonResponse({'success': False, 'error': 'Use the standard edit URL (not Published to web) for Load Sheet.'})
 
-            gid = _extract_gid(sheet_url)
+            gid = extract_gid(sheet_url)
+            if request.POST.get('refresh') == '1':
+                invalidate_headers(raw_sid)  # the columns were changed: forget every cached header row of the sheet
             # Try service account first (works when sheet is shared with it)
-            creds = _get_google_creds(['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive.readonly'])
+            creds = get_google_creds(READ_SCOPES)
             if creds:
                 try:
-                    import gspread
-                    gc = gspread.authorize(creds)
-                    sh = gc.open_by_key(raw_sid)
-                    ws = _get_worksheet(sh, gid)
-                    headers = ws.row_values(1)  # first row
+                    headers = get_sheet_headers(raw_sid, gid, READ_SCOPES)  # first row
                     if headers:
                         return JsonResponse({'success': True, 'columns': headers, 'sheet_id': raw_sid})
                 except Exception as e:
+                    invalidate_sheet(raw_sid)  # the cached handle may be stale (renamed tab, lost access)
                     err = str(e)
                     if 'PERMISSION_DENIED' in err or '403' in err or 'not found' in err.lower():
                         return JsonResponse({
@@ -516,18 +705,30 @@ class FileUploadView(View):
         # -------- Action: get_file_columns --------
         if action == 'get_file_columns':
             f = request.FILES.get('file')
-            if not f:
+            file_token = (request.POST.get('file_token') or '').strip()
+            if not f and not file_token:
                 return JsonResponse({'success': False, 'error': 'No file uploaded.'})
             try:
-                name = (f.name or '').lower()
-                if name.endswith('.csv'):
-                    df = pd.read_csv(f, nrows=0, encoding='utf-8', on_bad_lines='skip')
-                elif name.endswith('.xlsx') or name.endswith('.xls'):
-                    df = pd.read_excel(f, nrows=0, engine='openpyxl' if name.endswith('.xlsx') else None)
+                if f:
+                    name = (f.name or '').lower()
+                    if not name.endswith(('.csv', '.xlsx', '.xls')):
+                        return JsonResponse({'success': False, 'error': 'Unsupported format. Use CSV or Excel (.xlsx, .xls).'})
+                    # Stored once; upload_to_sheet refers to it by file_token (API/file_staging.py)
+                    try:
+                        staged = stage_upload(f)
+                    except OSError as e:
+                        # No writable staging dir: map from the upload itself, the page then sends the file
+                        print(f"File Staging Error: {e}")
+                        f.seek(0)
+                        sniffed = sniff_file(f, f.name)
+                        return JsonResponse({'success': True, 'filename': f.name, 'file_token': None, **sniffed})
                 else:
-                    return JsonResponse({'success': False, 'error': 'Unsupported format. Use CSV or Excel (.xlsx, .xls).'})
-                cols = list(df.columns)
-                return JsonResponse({'success': True, 'columns': cols, 'filename': f.name})
+                    staged = get_staged_file(file_token)
+                    if staged is None:
+                        return JsonResponse({'success': False, 'error': STAGED_FILE_EXPIRED, 'file_expired': True})
+                # Header, row count and a few preview rows only (API/sheet_upload.py)
+                sniffed = staged.sniff()
+                return JsonResponse({'success': True, 'filename': staged.filename, 'file_token': staged.token, **sniffed})
             except Exception as e:
                 return JsonResponse({'success': False, 'error': str(e)})
 
@@ -537,26 +738,32 @@ class FileUploadView(View):
             mapping_json = request.POST.get('mapping')  # JSON: { "Sheet Col A": "File Col 1", ... }
             sheet_columns_json = request.POST.get('sheet_columns')  # Full list of sheet columns in order
             f = request.FILES.get('file')
-            if not mapping_json or not f:
+            file_token = (request.POST.get('file_token') or '').strip()
+            staged = None
+            if not f and file_token:
+                staged = get_staged_file(file_token)
+                if staged is None:
+                    return JsonResponse({'success': False, 'error': STAGED_FILE_EXPIRED, 'file_expired': True})
+            if not mapping_json or not (f or staged):
                 return JsonResponse({'success': False, 'error': 'Missing mapping or file.'})
-            sheet_id = _extract_google_sheet_id(sheet_url) if sheet_url else None
-            gid_upload = _extract_gid(sheet_url) if sheet_url else None
+            filename = staged.filename if staged else f.name
+            sheet_id = extract_google_sheet_id(sheet_url) if sheet_url else None
+            gid_upload = extract_gid(sheet_url) if sheet_url else None
             try:
                 import json
                 mapping = json.loads(mapping_json)  # { "Sheet Column Name": "File Column Name", ... }
             except Exception:
                 return JsonResponse({'success': False, 'error': 'Invalid mapping JSON.'})
 
+            # The file itself is read in chunks while uploading (API/sheet_upload.py)
+            name = (filename or '').lower()
+            if not name.endswith(('.csv', '.xlsx', '.xls')):
+                return JsonResponse({'success': False, 'error': 'Unsupported file format.'})
             try:
-                name = (f.name or '').lower()
-                if name.endswith('.csv'):
-                    df = pd.read_csv(f, dtype=str, encoding='utf-8', on_bad_lines='skip')
-                elif name.endswith('.xlsx') or name.endswith('.xls'):
-                    df = pd.read_excel(f, dtype=str, engine='openpyxl' if name.endswith('.xlsx') else None)
-                else:
-                    return JsonResponse({'success': False, 'error': 'Unsupported file format.'})
-            except Exception as e:
-                return JsonResponse({'success': False, 'error': f'Failed to read file: {e}'})
+                # Data rows already appended by an earlier upload that stopped part way
+                resume_from = max(int(request.POST.get('resume_from') or 0), 0)
+            except ValueError:
+                return JsonResponse({'success': False, 'error': 'Invalid resume_from.'})
 
             # Build rows in the FULL sheet column order - skipped mappings get empty string to avoid misalignment
             if sheet_columns_json:
@@ -574,34 +781,15 @@ class FileUploadView(View):
                     pass
             if not sheet_header_order:
                 try:
-                    creds = _get_google_creds(['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive.readonly'])
+                    creds = get_google_creds(READ_SCOPES)
                     if creds and sheet_id:
                         raw_sid = sheet_id[1] if isinstance(sheet_id, tuple) else sheet_id
-                        import gspread
-                        gc = gspread.authorize(creds)
-                        sh = gc.open_by_key(raw_sid)
-                        ws_fetch = _get_worksheet(sh, gid_upload)
-                        sheet_header_order = ws_fetch.row_values(1)
+                        sheet_header_order = get_sheet_headers(raw_sid, gid_upload, READ_SCOPES)
                 except Exception:
-                    pass
+                    if sheet_id:
+                        invalidate_sheet(sheet_id[1] if isinstance(sheet_id, tuple) else sheet_id)
             if not sheet_header_order:
                 sheet_header_order = list(mapping.keys())  # fallback - may cause misalignment if mappings skipped
-            rows = []
-            for _, r in df.iterrows():
-                row = []
-                for sc in sheet_header_order:
-                    fc = mapping.get(sc)
-                    if fc is None:
-                        val = ''
-                    else:
-                        v = r.get(fc, '')
-                        val = v if isinstance(v, str) else (str(v) if pd.notna(v) else '')
-                    row.append(val)
-                rows.append(row)
-
-            if not rows:
-                return JsonResponse({'success': False, 'error': 'No data rows to upload.'})
-
             # Direct upload to Google Sheet (requires service account - sheet must be shared with it)
             if not sheet_id:
                 return JsonResponse({'success': False, 'error': 'Google Sheet URL is required for direct upload.'})
@@ -609,42 +797,219 @@ class FileUploadView(View):
             if isinstance(sheet_id, tuple) and sheet_id[0] == 'published':
                 return JsonResponse({'success': False, 'error': 'Use the standard edit URL (not Published to web) for direct upload.'})
 
-            creds = _get_google_creds(['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive'])
+            creds = get_google_creds(WRITE_SCOPES)
             if not creds:
                 return JsonResponse({
                     'success': False,
                     'error': 'Direct upload not configured. Set GOOGLE_APPLICATION_CREDENTIALS_JSON (paste full key.json) in Vercel env, or use GOOGLE_APPLICATION_CREDENTIALS (file path) locally. Share your sheet with the service account email (Editor).'
                 })
 
-            try:
-                import gspread
-                gc = gspread.authorize(creds)
-                sh = gc.open_by_key(raw_sheet_id)
-                ws = _get_worksheet(sh, gid_upload)
-                # Append data rows (sheet already has header row)
-                ws.append_rows(rows, value_input_option='USER_ENTERED')
-                return JsonResponse({
-                    'success': True,
-                    'message': f'Successfully uploaded {len(rows)} row(s) directly to your Google Sheet!',
-                    'row_count': len(rows)
-                })
-            except ImportError:
-                return JsonResponse({
-                    'success': False,
-                    'error': 'Install gspread and google-auth: pip install gspread google-auth'
-                })
-            except Exception as e:
-                err = str(e)
-                if 'PERMISSION_DENIED' in err or '403' in err or 'not found' in err.lower():
-                    return JsonResponse({
-                        'success': False,
-                        'error': 'Share your Google Sheet with the service account email (Editor). Find the email in your credentials JSON (client_email).'
-                    })
-                return JsonResponse({'success': False, 'error': err})
+            # Idempotent mode (opt-in): rows already in the sheet (by row hash or booking id) are skipped
+            dedupe = request.POST.get('dedupe') == '1'
+            # Background mode (JOB_BACKGROUND_ENABLED): return a job id right away, the page polls
+            # /jobs/<id>/ for progress; uploads synchronously when the job cannot be queued
+            if request.POST.get('background') == '1' and background_jobs_enabled():
+                try:
+                    job = enqueue_job('sheet_upload', {
+                        'sheet_id': raw_sheet_id,
+                        'gid': gid_upload,
+                        'filename': filename,
+                        'file_token': staged.token if staged else None,
+                        'mapping': mapping,
+                        'sheet_columns': sheet_header_order,
+                        'resume_from': resume_from,
+                        'dedupe': dedupe,
+                    }, upload=None if staged else f)
+                except Exception as e:
+                    print(f"Upload Job Error: {e}")  # e.g. read-only database or spool directory
+                    if f is not None:
+                        f.seek(0)
+                else:
+                    return JsonResponse({'success': True, 'job_id': str(job.id), 'status': job.status})
+            return JsonResponse(_upload_file_to_sheet(
+                raw_sheet_id, gid_upload, f, filename, mapping, sheet_header_order, resume_from,
+                chunks=staged.iter_chunks if staged else None, dedupe=dedupe,
+            ))
 
         return JsonResponse({'success': False, 'error': 'Invalid action.'})
 
 
+STAGED_FILE_EXPIRED = 'The uploaded file has expired. Please choose the file again.'
+
+
+def _upload_file_to_sheet(raw_sheet_id, gid, f, filename, mapping, sheet_header_order,
+                          resume_from=0, progress=None, chunks=None, dedupe=False):
+    """Append the mapped rows of an uploaded (or staged) file to the sheet; returns the JSON response payload."""
+    try:
+        ws = open_worksheet(raw_sheet_id, gid, WRITE_SCOPES)
+        deduplicator = RowDeduplicator(ws, raw_sheet_id, gid, sheet_header_order) if dedupe else None
+        # Append data rows in batches (sheet already has header row)
+        result = stream_file_to_worksheet(
+            ws, f, filename, mapping, sheet_header_order,
+            batch_size=getattr(settings, 'SHEET_UPLOAD_BATCH_ROWS', 5000),
+            resume_from=resume_from,
+            progress=progress,
+            chunks=chunks,
+            dedupe=deduplicator,
+        )
+        skipped = result['rows_skipped']
+        if not result['rows_uploaded'] and not skipped:
+            return {'success': False, 'error': 'No data rows to upload.'}
+        if not result['rows_uploaded']:
+            message = f'All {skipped} row(s) are already in your Google Sheet; nothing was uploaded.'
+        else:
+            message = f'Successfully uploaded {result["rows_uploaded"]} row(s) directly to your Google Sheet!'
+            if skipped:
+                message += f' Skipped {skipped} row(s) already in the sheet.'
+        return {
+            'success': True,
+            'message': message,
+            'row_count': result['rows_uploaded'],
+            'rows_skipped': skipped,
+            'batches': result['batches'],
+            'next_offset': result['next_offset'],
+        }
+    except SheetUploadError as e:
+        invalidate_sheet(raw_sheet_id)
+        err = str(e)
+        if 'PERMISSION_DENIED' in err or '403' in err:
+            err = 'Share your Google Sheet with the service account email (Editor). Find the email in your credentials JSON (client_email).'
+        return {
+            'success': False,
+            'error': f'Upload stopped after {e.resume_from} row(s): {err}',
+            'rows_uploaded': e.rows_uploaded,
+            'resume_from': e.resume_from,
+        }
+    except ImportError:
+        return {
+            'success': False,
+            'error': 'Install gspread and google-auth: pip install gspread google-auth'
+        }
+    except Exception as e:
+        invalidate_sheet(raw_sheet_id)
+        err = str(e)
+        if 'PERMISSION_DENIED' in err or '403' in err or 'not found' in err.lower():
+            return {
+                'success': False,
+                'error': 'Share your Google Sheet with the service account email (Editor). Find the email in your credentials JSON (client_email).'
+            }
+        return {'success': False, 'error': err}
+
+
+@register_job_handler('sheet_upload')
+def _run_sheet_upload_job(job, progress):
+    params = job.params
+    creds = get_google_creds(WRITE_SCOPES)
+    if not creds:
+        return {'success': False, 'error': 'Google Sheet credentials not configured.'}
+    if params.get('file_token'):
+        staged = get_staged_file(params['file_token'])
+        if staged is None:
+            return {'success': False, 'error': STAGED_FILE_EXPIRED, 'file_expired': True}
+        return _upload_file_to_sheet(
+            params['sheet_id'], params['gid'], None, staged.filename, params['mapping'],
+            params['sheet_columns'], params.get('resume_from', 0), progress=progress, chunks=staged.iter_chunks,
+            dedupe=params.get('dedupe', False),
+        )
+    with open(job.file_path, 'rb') as f:
+        return _upload_file_to_sheet(
+            params['sheet_id'], params['gid'], f, params['filename'], params['mapping'],
+            params['sheet_columns'], params.get('resume_from', 0), progress=progress,
+            dedupe=params.get('dedupe', False),
+        )
+
+
+ONOFFICE_API_URL = "https://api.onoffice.de/api/stable/api.php"
+
+
+def _onoffice_categories(raw_categories):
+    """
+    Supports:
+    - ?category=Foto&category=Titelbild
+    - ?category=Foto,Titelbild
+    """
+    if len(raw_categories) == 1 and "," in raw_categories[0]:
+        categories = [c.strip() for c in raw_categories[0].split(",") if c.strip()]
+    else:
+        categories = [c.strip() for c in raw_categories if c.strip()]
+    if not categories:
+        categories = ["Foto"]
+    return categories
+
+
+def _onoffice_payload(token, secret, estate_id, categories):
+    """Build the HMAC-signed onOffice 'get estatepictures' request body."""
+    timestamp = str(int(time.time()))
+    actionid = "urn:onoffice-de-ns:smart:2.5:smartml:action:get"
+    resourcetype = "estatepictures"
+    resourceid = ""
+
+    data = timestamp + token + resourcetype + actionid + resourceid
+
+    signature = base64.b64encode(
+        hmac.new(secret.encode(), data.encode(), hashlib.sha256).digest()
+    ).decode()
+
+    return {
+        "token": token,
+        "request": {
+            "actions": [
+                {
+                    "actionid": actionid,
+                    "resourceid": resourceid,
+                    "resourcetype": resourcetype,
+                    "timestamp": timestamp,
+                    "hmac_version": "2",
+                    "hmac": signature,
+                    "parameters": {
+                        "estateids": [int(estate_id)],
+                        "categories": categories,
+                        "size":"1200x900",
+                    },
+                }
+            ]
+        },
+    }
+
+
+def _onoffice_images_result(estate_id, categories, response_json):
+    """Turn the onOffice response into the webflow_images / images payload."""
+    try:
+        results = (
+            response_json.get("response", {})
+            .get("results", [])[0]
+            .get("data", {})
+            .get("records", [])
+        )
+    except (IndexError, AttributeError):
+        results = []
+
+    image_urls = []
+    for record in results:
+        for element in record.get("elements", []):
+            url = element.get("url")
+            if url:
+                image_urls.append(url)
+
+    webflow_images = [{"url": u} for u in image_urls]
+    flat_images = {f"image{i+1}": u for i, u in enumerate(image_urls)}
+
+    return {
+        "success": True,
+        "estate_id": estate_id,
+        "categories": categories,
+        "count": len(image_urls),
+        "webflow_images": webflow_images,
+        "images": flat_images,
+    }
+
+
+ONOFFICE_CREDENTIALS_ERROR = {
+    "success": False,
+    "error": "ONOFFICE_TOKEN or ONOFFICE_SECRET not set in environment."
+}
+
+
 class OnOfficeImagesView(APIView):
     """
     GET /api/onoffice/images/<estate_id>/
@@ -661,63 +1026,13 @@ class OnOfficeImagesView(APIView):
         token = os.environ.get("ONOFFICE_TOKEN")
         secret = os.environ.get("ONOFFICE_SECRET")
         if not token or not secret:
-            return Response(
-                {
-                    "success": False,
-                    "error": "ONOFFICE_TOKEN or ONOFFICE_SECRET not set in environment."
-                },
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            )
+            return Response(ONOFFICE_CREDENTIALS_ERROR, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        # Supports:
-        # - ?category=Foto&category=Titelbild
-        # - ?category=Foto,Titelbild
-        raw_categories = request.query_params.getlist("category")
-        if len(raw_categories) == 1 and "," in raw_categories[0]:
-            categories = [c.strip() for c in raw_categories[0].split(",") if c.strip()]
-        else:
-            categories = [c.strip() for c in raw_categories if c.strip()]
-        if not categories:
-            categories = ["Foto"]
-
-        timestamp = str(int(time.time()))
-        actionid = "urn:onoffice-de-ns:smart:2.5:smartml:action:get"
-        resourcetype = "estatepictures"
-        resourceid = ""
-
-        data = timestamp + token + resourcetype + actionid + resourceid
-
-        signature = base64.b64encode(
-            hmac.new(secret.encode(), data.encode(), hashlib.sha256).digest()
-        ).decode()
-
-        payload = {
-            "token": token,
-            "request": {
-                "actions": [
-                    {
-                        "actionid": actionid,
-                        "resourceid": resourceid,
-                        "resourcetype": resourcetype,
-                        "timestamp": timestamp,
-                        "hmac_version": "2",
-                        "hmac": signature,
-                        "parameters": {
-                            "estateids": [int(estate_id)],
-                            "categories": categories,
-                            "size":"1200x900",
-                        },
-                    }
-                ]
-            },
-        }
+        categories = _onoffice_categories(request.query_params.getlist("category"))
+        payload = _onoffice_payload(token, secret, estate_id, categories)
 
         try:
-            resp = requests.post(
-                "https://api.onoffice.de/api/stable/api.php",
-                json=payload,
-                timeout=20,
-            )
+            resp = http_post(ONOFFICE_API_URL, json=payload, timeout=20)
             resp.raise_for_status()
             response_json = resp.json()
         except Exception as e:
@@ -726,44 +1041,93 @@ class OnOfficeImagesView(APIView):
                 status=status.HTTP_502_BAD_GATEWAY,
             )
 
-        try:
-            results = (
-                response_json.get("response", {})
-                .get("results", [])[0]
-                .get("data", {})
-                .get("records", [])
-            )
-        except (IndexError, AttributeError):
-            results = []
+        return Response(
+            _onoffice_images_result(estate_id, categories, response_json),
+            status=status.HTTP_200_OK,
+        )
 
-        image_urls = []
-        for record in results:
-            for element in record.get("elements", []):
-                url = element.get("url")
-                if url:
-                    image_urls.append(url)
 
-        webflow_images = [{"url": u} for u in image_urls]
-        flat_images = {f"image{i+1}": u for i, u in enumerate(image_urls)}
+# ---------------------------------------------------------------------------
+# ASYNC (ASGI) VARIANTS - same behaviour as the views above, but outbound calls
+# run on the shared async HTTP client, so under an ASGI server (uvicorn/daphne
+# with Sitecapture.asgi) one process can keep many Bol.com / onOffice requests
+# in flight. Under WSGI they still work, one request per worker as before.
+# ---------------------------------------------------------------------------
 
-        return Response(
-            {
-                "success": True,
-                "estate_id": estate_id,
-                "categories": categories,
-                "count": len(image_urls),
-                "webflow_images": webflow_images,
-                "images": flat_images,
-            },
-            status=status.HTTP_200_OK,
+class AsyncInvoiceAnalyticsView(View):
+    """
+    GET /api/async/invoice/<invoice_id>/
+    Optional Query Params: ?ean=8720929627028, ?nocache=1 (see InvoiceAnalyticsView)
+    """
+
+    async def get(self, request, invoice_id):
+        bypass_cache = request.GET.get('nocache', '').lower() in ('1', 'true', 'yes')
+        cached = None
+        if not bypass_cache:
+            cached = await sync_to_async(get_cached_invoice_spec, thread_sensitive=False)(invoice_id)
+
+        invoice_json = None
+        if cached is None or getattr(settings, 'INVOICE_CACHE_REVALIDATE', False):
+            # The token is normally a cache hit; a refresh runs in a worker thread
+            token = await sync_to_async(get_bol_access_token, thread_sensitive=False)()
+            if not token:
+                return JsonResponse({"error": "Failed to authenticate with Bol.com"}, status=500)
+
+            invoice_json = await afetch_invoice_spec(invoice_id, token, cached=cached)
+            if not invoice_json:
+                return JsonResponse({"error": "Invoice not found or API error"}, status=404)
+
+        target_ean = request.GET.get('ean', None)
+        ean_index = await sync_to_async(get_invoice_ean_index, thread_sensitive=False)(
+            invoice_id, invoice_data=invoice_json, cached=cached
         )
+        analytics_data = ean_index.lookup(target_ean) if ean_index is not None else []
+
+        if not analytics_data:
+            return JsonResponse({"message": "No data found for the criteria."})
+
+        return JsonResponse({
+            "invoice_id": invoice_id,
+            "filter_ean": target_ean if target_ean else "ALL",
+            "results": analytics_data
+        })
+
+
+class AsyncOnOfficeImagesView(View):
+    """
+    GET /api/async/onoffice/images/<estate_id>/
+    Optional Query Param: category (see OnOfficeImagesView)
+    """
+
+    async def get(self, request, estate_id: int):
+        token = os.environ.get("ONOFFICE_TOKEN")
+        secret = os.environ.get("ONOFFICE_SECRET")
+        if not token or not secret:
+            return JsonResponse(ONOFFICE_CREDENTIALS_ERROR, status=500)
+
+        categories = _onoffice_categories(request.GET.getlist("category"))
+        payload = _onoffice_payload(token, secret, estate_id, categories)
+
+        try:
+            resp = await async_http_post(ONOFFICE_API_URL, json=payload, timeout=20)
+            resp.raise_for_status()
+            response_json = resp.json()
+        except Exception as e:
+            return JsonResponse(
+                {"success": False, "error": f"Request to onOffice failed: {e}"},
+                status=502,
+            )
+
+        return JsonResponse(_onoffice_images_result(estate_id, categories, response_json))
 
 
 class VoucherDataEntryView(View):
     """
     Voucher Data Entry page: Select agent, upload PDF, extract data, map & save to Google Sheet.
     GET: Render the data entry form.
-    POST: Action handlers: parse_voucher | save_voucher
+    POST: Action handlers: parse_voucher | save_voucher | parse_vouchers | save_vouchers
+    parse_vouchers takes many PDFs (pdf_files, ZIP archives allowed) and returns one mapped row per
+    parsed file plus per-file errors; save_vouchers appends a list of rows with a single call.
     """
     
     GOOGLE_SHEET_URL = "https://docs.google.com/spreadsheets/d/1F475ZKlJ3OdcMmqnaVJki91OlOikX78mHwKa1fPCD9s/edit?usp=sharing"
@@ -773,19 +1137,16 @@ class VoucherDataEntryView(View):
         columns = []
         error = None
         if unlocked:
-            sheet_id = _extract_google_sheet_id(self.GOOGLE_SHEET_URL)
+            sheet_id = extract_google_sheet_id(self.GOOGLE_SHEET_URL)
             if sheet_id:
                 raw_sid = sheet_id[1] if isinstance(sheet_id, tuple) else sheet_id
-                gid = _extract_gid(self.GOOGLE_SHEET_URL)
-                creds = _get_google_creds(['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive.readonly'])
+                gid = extract_gid(self.GOOGLE_SHEET_URL)
+                creds = get_google_creds(READ_SCOPES)
                 if creds:
                     try:
-                        import gspread
-                        gc = gspread.authorize(creds)
-                        sh = gc.open_by_key(raw_sid)
-                        ws = _get_worksheet(sh, gid)
-                        columns = ws.row_values(1)
+                        columns = get_sheet_headers(raw_sid, gid, READ_SCOPES)
                     except Exception as e:
+                        invalidate_sheet(raw_sid)
                         error = f"Error loading Google Sheet columns: {str(e)}"
                 else:
                     error = "Google Sheet credentials (key.json) not configured."
@@ -796,7 +1157,9 @@ class VoucherDataEntryView(View):
             'unlocked': unlocked,
             'columns': columns,
             'sheet_url': self.GOOGLE_SHEET_URL,
-            'error': error
+            'error': error,
+            # The page sends bulk PDFs in requests of at most this many files (Django's limit)
+            'bulk_batch_files': settings.DATA_UPLOAD_MAX_NUMBER_FILES or 100,
         })
         
     def post(self, request):
@@ -811,26 +1174,25 @@ class VoucherDataEntryView(View):
             sheet_url = (request.POST.get('sheet_url') or '').strip()
             if not sheet_url:
                 return JsonResponse({'success': False, 'error': 'Google Sheet URL is required.'})
-            sheet_id = _extract_google_sheet_id(sheet_url)
+            sheet_id = extract_google_sheet_id(sheet_url)
             if not sheet_id:
                 return JsonResponse({'success': False, 'error': 'Invalid Google Sheet URL.'})
             raw_sid = sheet_id[1] if isinstance(sheet_id, tuple) else sheet_id
-            gid = _extract_gid(sheet_url)
+            gid = extract_gid(sheet_url)
             
-            creds = _get_google_creds(['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive.readonly'])
+            creds = get_google_creds(READ_SCOPES)
             if not creds:
                 return JsonResponse({'success': False, 'error': 'Google credentials not configured.'})
                 
+            if request.POST.get('refresh') == '1':
+                invalidate_headers(raw_sid)
             try:
-                import gspread
-                gc = gspread.authorize(creds)
-                sh = gc.open_by_key(raw_sid)
-                ws = _get_worksheet(sh, gid)
-                headers = ws.row_values(1)
+                headers = get_sheet_headers(raw_sid, gid, READ_SCOPES)
                 if headers:
                     return JsonResponse({'success': True, 'columns': headers})
                 return JsonResponse({'success': False, 'error': 'No columns found in the sheet.'})
             except Exception as e:
+                invalidate_sheet(raw_sid)
                 err = str(e)
                 if 'PERMISSION_DENIED' in err or '403' in err or 'not found' in err.lower():
                     return JsonResponse({
@@ -858,58 +1220,218 @@ class VoucherDataEntryView(View):
             except Exception as e:
                 return JsonResponse({'success': False, 'error': f'Parsing error: {str(e)}'})
                 
-        # -------- Action: save_voucher --------
-        elif action == 'save_voucher':
+        # -------- Action: parse_vouchers (bulk, parsed in a process pool: API/voucher_bulk.py) --------
+        elif action == 'parse_vouchers':
+            agent_name = request.POST.get('agent_name')
+            if agent_name not in VOUCHER_PARSERS:
+                return JsonResponse({'success': False, 'error': f'Unsupported agent: {agent_name}'})
+            uploads = request.FILES.getlist('pdf_files')
+            if not uploads:
+                return JsonResponse({'success': False, 'error': 'No files uploaded.'})
+            try:
+                sheet_columns = json.loads(request.POST.get('sheet_columns', '[]'))
+            except Exception:
+                return JsonResponse({'success': False, 'error': 'Invalid data format.'})
+
+            # Read lazily: each PDF is loaded only when a parser slot is free
+            files = iter_voucher_files(
+                uploads,
+                max_files=getattr(settings, 'VOUCHER_BULK_MAX_FILES', 500),
+                max_file_bytes=getattr(settings, 'VOUCHER_BULK_MAX_FILE_MB', 20) * 2 ** 20,
+            )
+            results = parse_vouchers(files, agent_name, timeout=getattr(settings, 'VOUCHER_PARSE_TIMEOUT', 120))
+            rows = []
+            for result in results:
+                if 'data' in result and sheet_columns:
+                    row = voucher_row(result['data'], sheet_columns, agent_name)
+                    rows.append({'filename': result['filename'], 'row_data': dict(zip(sheet_columns, row))})
+            parsed = sum(1 for r in results if 'data' in r)
+            return JsonResponse({
+                'success': True,
+                'results': results,
+                'rows': rows,
+                'parsed': parsed,
+                'failed': len(results) - parsed,
+            })
+
+        # -------- Action: save_voucher / save_vouchers --------
+        elif action in ('save_voucher', 'save_vouchers'):
             sheet_url = (request.POST.get('sheet_url') or '').strip()
             if not sheet_url:
                 sheet_url = self.GOOGLE_SHEET_URL
                 
-            sheet_id = _extract_google_sheet_id(sheet_url)
+            sheet_id = extract_google_sheet_id(sheet_url)
             if not sheet_id:
                 return JsonResponse({'success': False, 'error': 'Invalid Google Sheet URL.'})
                 
             raw_sheet_id = sheet_id[1] if isinstance(sheet_id, tuple) else sheet_id
-            gid = _extract_gid(sheet_url)
+            gid = extract_gid(sheet_url)
             
             try:
                 sheet_columns = json.loads(request.POST.get('sheet_columns', '[]'))
-                row_dict = json.loads(request.POST.get('row_data', '{}'))
+                row_data = json.loads(request.POST.get('row_data', '[]' if action == 'save_vouchers' else '{}'))
             except Exception:
                 return JsonResponse({'success': False, 'error': 'Invalid data format.'})
+            row_dicts = row_data if action == 'save_vouchers' else [row_data]
+            if not isinstance(row_dicts, list) or not all(isinstance(r, dict) for r in row_dicts):
+                return JsonResponse({'success': False, 'error': 'Invalid data format.'})
+            if not row_dicts:
+                return JsonResponse({'success': False, 'error': 'No voucher rows to save.'})
                 
             if not sheet_columns:
                 return JsonResponse({'success': False, 'error': 'No sheet columns found for mapping.'})
                 
             # Align row values with the sheet columns order
-            row = []
-            for col in sheet_columns:
-                row.append(row_dict.get(col, ''))
+            rows = [[row_dict.get(col, '') for col in sheet_columns] for row_dict in row_dicts]
                 
-            creds = _get_google_creds([
-                'https://www.googleapis.com/auth/spreadsheets',
-                'https://www.googleapis.com/auth/drive'
-            ])
+            creds = get_google_creds(WRITE_SCOPES)
             if not creds:
                 return JsonResponse({'success': False, 'error': 'Google Sheet credentials not configured.'})
-                
-            try:
-                import gspread
-                gc = gspread.authorize(creds)
-                sh = gc.open_by_key(raw_sheet_id)
-                ws = _get_worksheet(sh, gid)
-                ws.append_rows([row], value_input_option='USER_ENTERED')
-                return JsonResponse({
-                    'success': True,
-                    'message': 'Successfully saved voucher data directly to your Google Sheet!'
-                })
-            except Exception as e:
-                err = str(e)
-                if 'PERMISSION_DENIED' in err or '403' in err or 'not found' in err.lower():
+            
+            # Idempotent mode: a voucher already in the sheet (same booking id / same row) is not added again
+            dedupe = request.POST.get('dedupe') == '1'
+            # Buffered mode (VOUCHER_BUFFERED_SAVES): stored in the database and appended with other
+            # vouchers in one call (API/sheet_writer.py); appended right away when it cannot be queued
+            buffered = request.POST.get('buffered') == '1' and action == 'save_voucher'
+            if buffered and getattr(settings, 'VOUCHER_BUFFERED_SAVES', False):
+                writer = get_sheet_writer()
+                try:
+                    pending = writer.enqueue(raw_sheet_id, gid, rows[0], sheet_columns, dedupe)
+                except Exception as e:
+                    print(f"Voucher Buffer Error: {e}")  # e.g. read-only database on serverless hosts
+                else:
                     return JsonResponse({
-                        'success': False,
-                        'error': 'Permission denied. Share your Google Sheet with the service account email (Editor).'
+                        'success': True,
+                        'queued': True,
+                        'row_id': pending.id,
+                        'message': f'Voucher saved. It will be written to your Google Sheet within {writer.window} seconds.',
                     })
-                return JsonResponse({'success': False, 'error': err})
+            # Background mode (JOB_BACKGROUND_ENABLED): return a job id right away, the page polls /jobs/<id>/
+            if request.POST.get('background') == '1' and background_jobs_enabled():
+                try:
+                    job = enqueue_job('voucher_save', {
+                        'sheet_id': raw_sheet_id, 'gid': gid, 'rows': rows,
+                        'sheet_columns': sheet_columns, 'dedupe': dedupe,
+                    })
+                except Exception as e:
+                    print(f"Voucher Job Error: {e}")
+                else:
+                    return JsonResponse({'success': True, 'job_id': str(job.id), 'status': job.status})
+            return JsonResponse(_append_voucher_rows(raw_sheet_id, gid, rows, sheet_columns, dedupe))
                 
         return JsonResponse({'success': False, 'error': 'Invalid action.'})
 
+
+def _append_voucher_rows(raw_sheet_id, gid, rows, sheet_columns=None, dedupe=False):
+    """Append voucher rows to the sheet; returns the JSON response payload."""
+    deduplicator = None
+    try:
+        ws = open_worksheet(raw_sheet_id, gid, WRITE_SCOPES)
+        if dedupe:
+            deduplicator = RowDeduplicator(ws, raw_sheet_id, gid, sheet_columns or [])
+        with deduplicator.append_lock if deduplicator else nullcontext():
+            if deduplicator:
+                new_rows = deduplicator.new_rows(rows)
+                if not new_rows:
+                    return {
+                        'success': True,
+                        'message': ('This voucher is already' if len(rows) == 1 else 'These vouchers are already')
+                        + ' in your Google Sheet; nothing was added.',
+                        'rows_added': 0,
+                        'rows_skipped': deduplicator.skipped,
+                    }
+                rows = new_rows
+            ws.append_rows(rows, value_input_option='USER_ENTERED')
+            if deduplicator:
+                deduplicator.committed()
+        skipped = deduplicator.skipped if deduplicator else 0
+        if len(rows) == 1 and not skipped:
+            message = 'Successfully saved voucher data directly to your Google Sheet!'
+        else:
+            message = f'Successfully saved {len(rows)} voucher(s) to your Google Sheet!'
+            if skipped:
+                message += f' {skipped} already in the sheet were skipped.'
+        return {
+            'success': True,
+            'message': message,
+            'rows_added': len(rows),
+            'rows_skipped': skipped,
+        }
+    except Exception as e:
+        if deduplicator:
+            deduplicator.failed()
+        invalidate_sheet(raw_sheet_id)
+        err = str(e)
+        if 'PERMISSION_DENIED' in err or '403' in err or 'not found' in err.lower():
+            return {
+                'success': False,
+                'error': 'Permission denied. Share your Google Sheet with the service account email (Editor).'
+            }
+        return {'success': False, 'error': err}
+
+
+@register_job_handler('voucher_save')
+def _run_voucher_save_job(job, progress):
+    creds = get_google_creds(WRITE_SCOPES)
+    if not creds:
+        return {'success': False, 'error': 'Google Sheet credentials not configured.'}
+    params = job.params
+    result = _append_voucher_rows(
+        params['sheet_id'], params['gid'], params['rows'], params.get('sheet_columns'), params.get('dedupe', False)
+    )
+    if result['success']:
+        progress(len(params['rows']))
+    return result
+
+
+class VoucherFlushView(View):
+    """
+    GET /voucher-entry/flush/            buffered voucher rows per sheet and the last flush
+    GET /voucher-entry/flush/?row_id=N   status of one buffered row (pending | sending | sent | skipped)
+    POST /voucher-entry/flush/           write everything buffered now
+    """
+
+    def _unlocked(self, request):
+        return request.get_signed_cookie('unlocked', default='false', salt='pilgrim_secret') == 'true'
+
+    def get(self, request):
+        if not self._unlocked(request):
+            return JsonResponse({'success': False, 'error': 'Secure access required. Please unlock first.'}, status=403)
+        row_id = request.GET.get('row_id')
+        if row_id:
+            pending = PendingSheetRow.objects.filter(pk=row_id).first() if row_id.isdigit() else None
+            if pending is None:
+                return JsonResponse({'success': False, 'error': 'Row not found.'}, status=404)
+            return JsonResponse({'success': True, **pending.as_dict()})
+        return JsonResponse({'success': True, **get_sheet_writer().status()})
+
+    def post(self, request):
+        if not self._unlocked(request):
+            return JsonResponse({'success': False, 'error': 'Secure access required. Please unlock first.'}, status=403)
+        results = get_sheet_writer().flush_now()
+        errors = [r['error'] for r in results if r.get('error')]
+        return JsonResponse({
+            'success': not errors,
+            'flushed': results,
+            'error': errors[0] if errors else None,
+        })
+
+
+class JobStatusView(View):
+    """
+    GET /jobs/<job_id>/
+    Status and progress of a background upload / voucher save (see API/jobs.py).
+    A job is guarded like the page that started it: voucher saves need the unlock
+    cookie, file uploads (whose page has no lock) do not.
+    """
+    UNLOCK_REQUIRED = ('voucher_save',)
+
+    def get(self, request, job_id):
+        unlocked = request.get_signed_cookie('unlocked', default='false', salt='pilgrim_secret') == 'true'
+        job = get_job(job_id)
+        if job is None:
+            return JsonResponse({'success': False, 'error': 'Job not found.'}, status=404)
+        if job.kind in self.UNLOCK_REQUIRED and not unlocked:
+            return JsonResponse({'success': False, 'error': 'Secure access required. Please unlock first.'}, status=403)
+        return JsonResponse({'success': True, **job.as_dict()})
+
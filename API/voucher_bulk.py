@@ -0,0 +1,229 @@
+"""
+Bulk voucher ingestion for the Voucher Data Entry page.
+
+Many PDFs (several files and/or ZIP archives) are parsed in a process pool, because
+pypdf text extraction is CPU-bound and would otherwise run one file after another
+in the request thread. The pool uses the spawn start method so workers do not inherit
+the server's background threads. Files are read and handed to the pool as worker slots
+free up, so only a few PDFs are in memory at a time. Where no process pool can be
+created (serverless hosts without /dev/shm) the files are parsed one by one in the
+request process. Every file gets its own result or error, and the extracted data is
+mapped to the sheet's columns the same way the voucher page pre-fills its form, so
+the rows can be shown for review and appended to the sheet in a single call.
+"""
+import io
+import os
+import threading
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from .pdf_parsers import extract_travel_to_haram
+
+PARSERS = {
+    'Travel to Haram': extract_travel_to_haram,
+}
+
+# Sheet column -> extracted field (same as the page's renderMappingForm)
+VOUCHER_COLUMN_MAP = {
+    'FAMILY NAME': 'lead_pax',
+    'MOBILE NO.': 'mobile_no',
+    'MAKKA HOTEL / مكة فندق': 'makkah_hotel',
+    'CH IN / دخول': 'makkah_check_in',
+    'CH OUT / خروج': 'makkah_check_out',
+    'MEDINAH HOTEL / مدينه فندق': 'madinah_hotel',
+    'CH IN / دخول.1': 'madinah_check_in',
+    'CHECKOUT': 'madinah_check_out',
+    'AGENT NAME / اسم وكيل': 'agent_name',
+    'TR / مواصلات': 'vehicles',
+    'ROUT': 'route',
+}
+IGNORED_VOUCHER_COLUMNS = {'CH IN / دخول', 'CH IN / دخول.1', 'CH IN / دخول.2', 'CH IN / دخول.3'}
+
+
+def voucher_row(extracted, sheet_columns, agent_name='Travel to Haram'):
+    """Row values in sheet_columns order, filled like the voucher form pre-fills its inputs."""
+    row = []
+    check_in = extracted.get('makkah_check_in') or ''
+    for col in sheet_columns:
+        value = ''
+        if col not in IGNORED_VOUCHER_COLUMNS:
+            key = VOUCHER_COLUMN_MAP.get(col)
+            if key and extracted.get(key):
+                value = extracted[key]
+            elif col == 'AGENT NAME / اسم وكيل':
+                value = agent_name
+            elif col == 'MONTH' and check_in:
+                parts = check_in.split('/')
+                if len(parts) > 1:
+                    value = parts[1]
+            elif col == 'DATE / التاريخ' and check_in:
+                value = check_in
+            elif col == 'FLIGHT/ رقم رحلة' and extracted.get('flights'):
+                value = ', '.join(extracted['flights'])
+        row.append(value)
+    return row
+
+
+def iter_voucher_files(uploads, max_files=500, max_file_bytes=20 * 2 ** 20):
+    """
+    Yield (filename, pdf_bytes, error) for uploaded PDFs and the PDFs inside uploaded ZIPs.
+    Exactly one of pdf_bytes / error is set.
+    """
+    count = 0
+    for upload in uploads:
+        name = upload.name or 'upload'
+        if name.lower().endswith('.zip'):
+            try:
+                archive = zipfile.ZipFile(upload)
+            except zipfile.BadZipFile:
+                yield name, None, 'Not a valid ZIP archive.'
+                continue
+            with archive:
+                for info in archive.infolist():
+                    inner = info.filename
+                    base = os.path.basename(inner)
+                    if info.is_dir() or inner.startswith('__MACOSX/') or base.startswith('.'):
+                        continue
+                    label = f"{name}/{inner}"
+                    count += 1
+                    if count > max_files:
+                        yield label, None, f'Too many files (limit {max_files}).'
+                        continue
+                    if not base.lower().endswith('.pdf'):
+                        yield label, None, 'Not a PDF file.'
+                    elif info.file_size > max_file_bytes:
+                        yield label, None, f'File is larger than {max_file_bytes // 2 ** 20} MB.'
+                    else:
+                        yield label, archive.read(info), None
+            continue
+        count += 1
+        if count > max_files:
+            yield name, None, f'Too many files (limit {max_files}).'
+        elif not name.lower().endswith('.pdf'):
+            yield name, None, 'Not a PDF file.'
+        elif upload.size > max_file_bytes:
+            yield name, None, f'File is larger than {max_file_bytes // 2 ** 20} MB.'
+        else:
+            yield name, upload.read(), None
+
+
+def parse_voucher_bytes(agent_name, filename, data):
+    """Parse one PDF; runs in a pool worker. Returns {'filename', 'data'} or {'filename', 'error'}."""
+    try:
+        return {'filename': filename, 'data': PARSERS[agent_name](io.BytesIO(data))}
+    except Exception as e:
+        return {'filename': filename, 'error': f'Parsing error: {str(e)}'}
+
+
+_pool = None
+_pool_workers = 0
+_pool_unavailable = False
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    """The shared parser pool, or None when this host cannot run one (then parse inline)."""
+    global _pool, _pool_workers, _pool_unavailable
+    if _pool is None and not _pool_unavailable:
+        with _pool_lock:
+            if _pool is None and not _pool_unavailable:
+                import multiprocessing
+                from django.conf import settings
+                workers = getattr(settings, 'VOUCHER_PARSE_WORKERS', None) or min(4, os.cpu_count() or 1)
+                try:
+                    _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+                    _pool_workers = workers
+                except (OSError, NotImplementedError) as e:
+                    # e.g. no /dev/shm for the pool's semaphores (AWS Lambda / Vercel)
+                    print(f"Voucher Pool Error: {e}")
+                    _pool_unavailable = True
+    return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _collect(pending, results, timeout):
+    """Store the results of the futures that finish within timeout; False if none did."""
+    done, _ = wait(pending, timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+    for future in done:
+        i, filename = pending.pop(future)
+        try:
+            results[i] = future.result()
+        except BrokenProcessPool:
+            _reset_pool()  # a worker died (e.g. out of memory); the next request gets a new pool
+            results[i] = {'filename': filename, 'error': 'Parser process crashed on this file.'}
+        except Exception as e:
+            results[i] = {'filename': filename, 'error': f'Parsing error: {str(e)}'}
+    return bool(done)
+
+
+def parse_vouchers(files, agent_name, timeout=120):
+    """
+    Parse (filename, pdf_bytes, error) items (any iterable, read lazily) and return one
+    result per item, in order. At most two files per worker are in flight; a single file,
+    or every file when no pool is available, is parsed inline. A file that fails or is
+    not done after timeout seconds only gets an error.
+    """
+    deadline = time.monotonic() + timeout
+    results = []
+    pending = {}  # future -> (index, filename)
+    held = None  # first file: parsed inline unless a second one follows
+    first = True
+    pool = None
+
+    def timed_out(i, filename):
+        results[i] = {'filename': filename, 'error': f'Timed out after {timeout} seconds.'}
+
+    def submit(i, filename, data):
+        nonlocal pool
+        if pool is None:
+            pool = _get_pool()
+        if pool is not None:
+            while len(pending) >= 2 * _pool_workers:
+                if not _collect(pending, results, deadline - time.monotonic()):
+                    break  # deadline passed: the files still pending are reported below
+            if len(pending) < 2 * _pool_workers:
+                try:
+                    pending[pool.submit(parse_voucher_bytes, agent_name, filename, data)] = (i, filename)
+                    return
+                except (OSError, RuntimeError) as e:  # RuntimeError: pool broken or shut down
+                    print(f"Voucher Pool Error: {e}")
+                    _reset_pool()
+                    pool = None
+        if time.monotonic() >= deadline:
+            timed_out(i, filename)
+        else:
+            results[i] = parse_voucher_bytes(agent_name, filename, data)
+
+    for i, (filename, data, error) in enumerate(files):
+        results.append(None)
+        if error:
+            results[i] = {'filename': filename, 'error': error}
+        elif time.monotonic() >= deadline:
+            timed_out(i, filename)
+        elif first:
+            held = (i, filename, data)
+            first = False
+        else:
+            if held is not None:
+                submit(*held)
+                held = None
+            submit(i, filename, data)
+
+    if held is not None:
+        i, filename, data = held
+        results[i] = parse_voucher_bytes(agent_name, filename, data)
+    while pending and _collect(pending, results, deadline - time.monotonic()):
+        pass
+    for future, (i, filename) in pending.items():
+        future.cancel()
+        timed_out(i, filename)
+    return results
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 
 # Load .env into environment (for GOOGLE_APPLICATION_CREDENTIALS etc.)
 try:
@@ -161,3 +162,93 @@ elif (BASE_DIR.parent / 'key.json').exists():
     GOOGLE_SHEETS_CREDENTIALS_PATH = str(BASE_DIR.parent / 'key.json')
 else:
     GOOGLE_SHEETS_CREDENTIALS_PATH = None
+
+# Bol.com OAuth token cache
+# "memory" keeps the token per worker process, "django" shares it through the default
+# Django cache (CACHES), "file" shares it between processes through a local JSON file.
+BOL_TOKEN_CACHE_BACKEND = os.environ.get('BOL_TOKEN_CACHE_BACKEND', 'memory')
+BOL_TOKEN_CACHE_PATH = os.environ.get(
+    'BOL_TOKEN_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'sitecap_bol_token.json')
+)
+BOL_TOKEN_EXPIRY_MARGIN = 30  # seconds before expires_in at which a token is considered stale
+BOL_TOKEN_REFRESH_AHEAD = 60  # start a background refresh when less than this many seconds remain
+
+# Outbound HTTP client (API/http_client.py) - pooled keep-alive sessions per host
+HTTP_CLIENT_TIMEOUT = (5, 30)  # (connect, read) seconds, used when a call does not pass its own timeout
+HTTP_CLIENT_MAX_PER_HOST = 8  # pooled connections and concurrent in-flight requests per host
+HTTP_CLIENT_RETRIES = 3  # retries on connection errors, 429 and 5xx responses
+HTTP_CLIENT_BACKOFF_FACTOR = 0.5  # exponential backoff base (seconds), jittered
+
+# Bol.com invoice specification cache (API/invoice_cache.py)
+# Issued invoices never change, so specifications are kept on disk (zlib-compressed, LRU-evicted).
+INVOICE_CACHE_ENABLED = os.environ.get('INVOICE_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+INVOICE_CACHE_PATH = os.environ.get(
+    'INVOICE_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'sitecap_invoice_specs.sqlite3')
+)  # the temp dir is the writable place on serverless hosts; point it at persistent storage where there is some
+INVOICE_CACHE_MAX_BYTES = 200 * 1024 * 1024  # total compressed size before least recently used invoices are evicted
+INVOICE_CACHE_TOUCH_INTERVAL = 300  # seconds; a cache hit updates the LRU timestamp at most this often
+INVOICE_CACHE_REVALIDATE = False  # True: send If-None-Match / If-Modified-Since to Bol.com on every request
+
+# Batch invoice analytics (POST /api/invoices/analytics/)
+BOL_BATCH_WORKERS = 4  # invoice specifications downloaded concurrently per batch request
+BOL_BATCH_MAX_INVOICES = 100
+
+# Stream very large invoice specifications instead of loading the whole JSON document
+# (can also be requested per call with ?stream=1)
+BOL_INVOICE_STREAMING = os.environ.get('BOL_INVOICE_STREAMING', 'false').lower() in ('1', 'true', 'yes')
+BOL_INVOICE_STREAM_BATCH = 5000  # invoice lines aggregated per batch while streaming
+
+# Pilgrim schedule Google Sheet snapshot cache (API/sheet_cache.py)
+SCHEDULE_SHEET_TTL = 60  # seconds a downloaded sheet is reused without asking Google again
+SCHEDULE_SHEET_STALE_TTL = 600  # after the TTL, serve the old copy this long while it is refreshed in the background
+SCHEDULE_MAX_RANGE_DAYS = 62  # longest start_date..end_date range accepted by the schedule page
+SCHEDULE_RESULT_CACHE_SIZE = 256  # rendered schedules kept per sheet version (LRU, per date and output format)
+
+# Live schedule updates. By default the page polls GET /?action=poll&date=13-Jan every SCHEDULE_POLL_SECONDS.
+# Server-Sent Events (GET /?action=subscribe&date=13-Jan) are opt-in and only served under ASGI: under WSGI
+# or on serverless hosts every open stream would hold a worker.
+SCHEDULE_POLL_SECONDS = 120
+SCHEDULE_SSE_ENABLED = os.environ.get('SCHEDULE_SSE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+SCHEDULE_SSE_POLL_INTERVAL = 30  # seconds between checks of the sheet by the shared poller thread
+SCHEDULE_SSE_HEARTBEAT = 15  # keep-alive comment interval, keeps proxies from closing idle streams
+SCHEDULE_SSE_MAX_SECONDS = 300  # connections are closed after this long; the browser reconnects
+
+# File Upload page: rows per append_rows call when streaming a file into a Google Sheet
+SHEET_UPLOAD_BATCH_ROWS = 5000
+
+# Background jobs for sheet uploads / voucher saves (API/jobs.py, status at /jobs/<id>/). Needs a writable
+# database and spool directory and a long-running server process, so it is off by default.
+JOB_BACKGROUND_ENABLED = os.environ.get('JOB_BACKGROUND_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+JOB_WORKERS = 2  # jobs writing to Google Sheets at the same time
+JOB_HEARTBEAT_INTERVAL = 15  # seconds between heartbeats of a running job
+JOB_LEASE_TIMEOUT = 120  # a running job without a heartbeat for this long is marked failed
+JOB_SPOOL_DIR = os.environ.get('JOB_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'sitecap_jobs'))  # uploaded files waiting for a worker
+
+# Cached Google Sheets credentials / client / worksheet handles (API/google_sheets.py)
+GOOGLE_SHEETS_IDLE_TTL = 900  # seconds an unused handle is kept
+GOOGLE_SHEETS_HEADER_TTL = 60  # seconds a sheet's header row is reused
+
+# Upload-once file staging for the File Upload page (API/file_staging.py)
+FILE_STAGING_DIR = os.environ.get('FILE_STAGING_DIR', os.path.join(tempfile.gettempdir(), 'sitecap_staging'))
+FILE_STAGING_TTL = 3600  # seconds a staged file is kept after its last use
+
+# Idempotent appends with dedupe=1 (API/sheet_dedup.py): row key = a hash of the whole row, or the first of
+# these columns the sheet has - list only columns holding a unique booking id
+SHEET_DEDUP_KEY_COLUMNS = []
+SHEET_DEDUP_INDEX_TTL = 300  # seconds the existing-row key index of a sheet is reused
+
+# Voucher write coalescer (API/sheet_writer.py, status at /voucher-entry/flush/). Needs a writable database
+# and a long-running server process, so it is off by default (serverless hosts append each voucher inline).
+VOUCHER_BUFFERED_SAVES = os.environ.get('VOUCHER_BUFFERED_SAVES', 'false').lower() in ('1', 'true', 'yes')
+VOUCHER_FLUSH_WINDOW = 5  # seconds a buffered voucher waits for others to the same sheet
+VOUCHER_FLUSH_MAX_ROWS = 50  # flush right away once this many rows are waiting
+VOUCHER_SENT_RETENTION = 86400  # seconds written rows stay queryable by row_id
+VOUCHER_CLAIM_TIMEOUT = 300  # seconds before rows claimed by a flush that never finished are sent again
+
+# Bulk voucher ingestion (API/voucher_bulk.py): PDFs parsed in a process pool
+VOUCHER_PARSE_WORKERS = None  # parser processes; None = min(4, CPU count)
+VOUCHER_PARSE_TIMEOUT = 120  # seconds a bulk parse may take before the remaining files are reported as timed out
+VOUCHER_BULK_MAX_FILES = 500  # PDFs per request, ZIP contents included
+VOUCHER_BULK_MAX_FILE_MB = 20  # larger PDFs are reported as errors
+# Uploaded files per request stay at Django's DATA_UPLOAD_MAX_NUMBER_FILES (100); the page
+# sends larger selections in several parse_vouchers requests
@@ -2,12 +2,14 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns
-from API.views import RootView, PilgrimScheduleView, FileUploadView, VoucherDataEntryView
+from API.views import RootView, PilgrimScheduleView, FileUploadView, VoucherDataEntryView, VoucherFlushView, JobStatusView
 
 urlpatterns = [
     path('', PilgrimScheduleView.as_view(), name='pilgrim-schedule-home'),
     path('file-upload/', FileUploadView.as_view(), name='file-upload'),
     path('voucher-entry/', VoucherDataEntryView.as_view(), name='voucher-entry'),
+    path('voucher-entry/flush/', VoucherFlushView.as_view(), name='voucher-flush'),
+    path('jobs/<uuid:job_id>/', JobStatusView.as_view(), name='job-status'),
     path('admin/', admin.site.urls),
     path('api/', include('API.urls')),
     path('api-info/', RootView.as_view(), name='root'),  # Old API info endpoint